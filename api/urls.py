@@ -12,4 +12,6 @@ router.register(r"users", views.UserViewSet)
 
 urlpatterns = [
     path("", include(router.urls)),
+    path("loans/checkout/", views.CheckoutView.as_view(), name="checkout"),
+    path("loans/checkin/", views.CheckinView.as_view(), name="checkin"),
 ]
@@ -1,6 +1,9 @@
 from django.contrib.auth import get_user_model
-from rest_framework import viewsets
+from django.core.exceptions import ValidationError
+from rest_framework import status, viewsets
 from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from books.models import Book, Classification, Collection, Location
 from books.serializers import (
@@ -9,6 +12,13 @@ from books.serializers import (
     CollectionHyperlinkedSerializer,
     LocationHyperlinkedSerializer,
 )
+from loans.models import Loan
+from loans.serializers import (
+    CheckinSerializer,
+    CheckoutSerializer,
+    LoanSerializer,
+)
+from notifications.mail import checkin_receipt, checkout_receipt
 from profiles.serializers import UserSerializer
 
 User = get_user_model()
@@ -42,3 +52,46 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [IsAdminUser]
+
+
+class CheckoutView(APIView):
+    """Lend many specimens to a user at once"""
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        serializer = CheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            loans = Loan.objects.checkout(
+                serializer.validated_data["user"],
+                serializer.validated_data["specimens"],
+            )
+        except ValidationError as e:
+            return Response(
+                {"specimens": e.messages}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        checkout_receipt(loans)
+        return Response(
+            LoanSerializer(loans, many=True).data,
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class CheckinView(APIView):
+    """Return the open loans of many specimens at once"""
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        serializer = CheckinSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        loans = Loan.objects.checkin(
+            Loan.objects.filter(
+                specimen__in=serializer.validated_data["specimens"]
+            )
+        )
+
+        checkin_receipt(loans)
+        return Response(LoanSerializer(loans, many=True).data)
@@ -7,8 +7,9 @@ class BarcodeSearchBoxMixin:
 
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
-        extra_context["original_template"] = (
-            super().change_list_template or "admin/change_list.html"
+        extra_context.setdefault(
+            "original_template",
+            super().change_list_template or "admin/change_list.html",
         )
 
         return super().changelist_view(request, extra_context)
@@ -224,3 +224,16 @@ HUEY = {
     "huey_class": "huey.SqliteHuey" if DEBUG else "huey.RedisHuey",
     "consumer": {"workers": 2},
 }
+
+# Shared by all processes, since it holds the versions of the cached
+# configuration singletons
+CACHES = {
+    "default": (
+        {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        if DEBUG
+        else {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": environ.get("REDIS_URL", "redis://127.0.0.1:6379"),
+        }
+    )
+}
@@ -4,6 +4,7 @@ import urllib.parse
 
 from django import forms
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.db import models
 from django.shortcuts import redirect
 from django.urls import reverse
@@ -12,8 +13,6 @@ from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.utils.timezone import localtime
 from django.utils.translation import gettext_lazy as _
-from isbnlib import canonical, clean, ean13, get_isbnlike
-from unidecode import unidecode
 
 from admin_buttons.admin import AdminButtonsMixin
 from alter_field_action.actions import alter_field_action
@@ -25,7 +24,7 @@ from loans.util import loan_link
 from profiles.admin import HiddenAdminMixin
 from public_admin.admin import PublicModelAdminMixin
 
-from . import isbn
+from . import isbn, search
 from .actions import mark_label_printed, remove_label_printed
 from .models import Book, Classification, Collection, Location, Specimen
 from .widgets import ISBNSearchInput
@@ -62,68 +61,39 @@ class ShowBookFilterMixin:
             _("Mostrar livros dessa %(model)s") % {"model": model},
         )
 
-class UnaccentSearchMixin:
-    def get_search_results(self, request, queryset, search_term):
-        qs, has_dups = super().get_search_results(
-            request, queryset, search_term
-        )
 
-        if search_term:
-            if get_isbnlike(search_term, level="strict"):
-                isbn_field = self.canonical_isbn_field
-                isbn_search = ean13(canonical(clean(search_term)))
-                qs |= self.model.objects.filter(**{isbn_field: isbn_search})
-
-            request.search_unaccent = True
-            unaccent_qs, unaccent_dups = super().get_search_results(
-                request, queryset, unidecode(search_term)
-            )
-            request.search_unaccent = False
-
-            qs |= unaccent_qs
-            has_dups = has_dups or unaccent_dups
+class SearchRankChangeList(ChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        qs = super().get_queryset(request, exclude_parameters)
+        if self.query and ORDER_VAR not in self.params:
+            qs = qs.order_by("-_search_rank", *qs.query.order_by)
+        return qs
 
-        return qs, has_dups
 
-    def get_search_fields(self, request):
-        if getattr(request, "search_unaccent", False):
-            return self.unaccent_search_fields
-        return super().get_search_fields(request)
+class IndexedSearchMixin:
+    """Search through the catalogue index (see `books.search`) instead of
+    `search_fields`. `search_prefix` is the path from the model to the
+    book. Results are ranked unless the user picks an ordering
+    """
 
+    search_prefix = ""
 
-class SpecimenIdSearchMixin:
     def get_search_results(self, request, queryset, search_term):
-        qs, has_dups = super().get_search_results(
-            request, queryset, search_term
-        )
+        if not search_term:
+            return queryset, False
 
-        if re.match(r"\d+", search_term):
-            request.search_specimen_id = True
-            new_qs, new_has_dups = super().get_search_results(
-                request, queryset, str(int(search_term, base=10))
-            )
-            request.search_specimen_id = False
-
-            qs |= new_qs
-            has_dups = has_dups or new_has_dups
-
-        return qs, has_dups
+        return search.search(queryset, search_term, self.search_prefix), False
 
-    def get_search_fields(self, request):
-        if getattr(request, "search_specimen_id", False):
-            return [self.specimen_id_field]
-        return super().get_search_fields(request)
+    def get_changelist(self, request, **kwargs):
+        return SearchRankChangeList
 
 
 class SpecimenAdmin(
-    SpecimenIdSearchMixin,
-    UnaccentSearchMixin,
+    IndexedSearchMixin,
     HiddenAdminMixin,
     admin.ModelAdmin,
 ):
-    canonical_isbn_field = "book__canonical_isbn"
-    unaccent_search_fields = ("book__unaccent_title", "book__unaccent_author")
-    specimen_id_field = "id"
+    search_prefix = "book__"
     redirect_related_fields = {
         "change": "book",
         "delete": "book",
@@ -181,8 +151,7 @@ class BookAdminForm(forms.ModelForm):
 
 
 class BookAdmin(
-    SpecimenIdSearchMixin,
-    UnaccentSearchMixin,
+    IndexedSearchMixin,
     AdminButtonsMixin,
     BarcodeSearchBoxMixin,
     admin.ModelAdmin,
@@ -222,8 +191,6 @@ class BookAdmin(
         "code",
         "specimens__id",
     )
-    unaccent_search_fields = ("unaccent_author", "unaccent_title")
-    canonical_isbn_field = "canonical_isbn"
     list_display = (
         "title",
         "author",
@@ -234,6 +201,7 @@ class BookAdmin(
         "short_last_modified",
     )
     ordering = ["-last_modified"]
+    list_select_related = ["classification__location"]
     list_filter = (
         (
             "classification__abbreviation",
@@ -255,12 +223,13 @@ class BookAdmin(
         mark_label_printed,
         remove_label_printed,
     ]
-    specimen_id_field = "specimens__id"
 
     @admin.display(
         description=_("Localização"), ordering="classification__location"
     )
     def location(self, obj):
+        if not obj.classification:
+            return None
         return obj.classification.location.color_icon()
 
     @admin.display(description=_("Exemplares"), ordering="specimens__count")
@@ -323,7 +292,13 @@ class BookAdmin(
 
     def get_queryset(self, *args, **kwargs):
         qs = super().get_queryset(*args, **kwargs)
-        qs = qs.annotate(models.Count("specimens"))
+        available = Specimen.objects.filter(
+            book=models.OuterRef("pk"), available=True
+        )
+        qs = qs.annotate(
+            models.Count("specimens"),
+            _available=models.Exists(available),
+        )
         return qs
 
     admin_buttons_config = [
@@ -364,8 +339,7 @@ class BookAdmin(
     def add_specimen(self, request, obj):
         n = int(request.POST["n_specimens"])
         if obj:
-            for _ in range(n):
-                obj.specimens.create()
+            Specimen.objects.bulk_create_numbered(obj, n)
 
         return redirect(request.META["HTTP_REFERER"])
 
@@ -401,6 +375,7 @@ class BookAdmin(
 
 class ClassificationAdmin(ShowBookFilterMixin, admin.ModelAdmin):
     list_display = ("__str__", "abbreviation", "location", "location_color")
+    list_select_related = ["location"]
     book_filter_data = ("classification__abbreviation", "abbreviation")
 
     @admin.display(description=_("Cor da localização"))
@@ -20,7 +20,7 @@ class CutterSingleton:
     _instance = None
     input_file = settings.BASE_DIR / "books" / "cutter.csv"
 
-    def __init__(self):
+    def load(self):
         with open(self.input_file, encoding="utf-8") as f:
             reader = csv.reader(f)
             next(reader)  # skip header
@@ -34,6 +34,8 @@ class CutterSingleton:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
+            # Load here instead of __init__, which runs on every call
+            cls._instance.load()
         return cls._instance
 
 
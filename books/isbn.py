@@ -1,12 +1,73 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db.models import F
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from isbnlib import ISBNLibException, meta
+from isbnlib import ISBNLibException, canonical, ean13, meta
+from isbnlib.dev import ISBNLibHTTPError, ISBNLibURLError, ServiceIsDownError
 
-from .models import Book
+from .models import Book, ISBNMetadata
 from .validators import validate_isbn
 
 book_fields = [field.name for field in Book._meta.get_fields()]
 
+SOURCES = ["wiki", "goob", "openl"]
+MERGED = "merged"
+
+CACHE_TTL = timedelta(days=getattr(settings, "ISBN_CACHE_TTL_DAYS", 30))
+NOT_FOUND_CACHE_TTL = timedelta(
+    days=getattr(settings, "ISBN_CACHE_NOT_FOUND_TTL_DAYS", 1)
+)
+# Failing to reach a source says nothing about the ISBN, so these
+# errors aren't cached
+UNREACHABLE_ERRORS = (ISBNLibHTTPError, ISBNLibURLError, ServiceIsDownError)
+
+# Seconds to wait for all sources before merging what has arrived
+LOOKUP_TIMEOUT = getattr(settings, "ISBN_LOOKUP_TIMEOUT", 8)
+
+
+class SourceCooldown:
+    """Skip a source for `cooldown` seconds after it fails (or misses
+    the deadline) `max_failures` times in a row
+    """
+
+    def __init__(self, max_failures, cooldown):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = {}
+        self.skip_until = {}
+        self.lock = threading.Lock()
+
+    def available(self, source):
+        with self.lock:
+            return self.skip_until.get(source, 0) <= time.monotonic()
+
+    def failed(self, source):
+        with self.lock:
+            self.failures[source] = self.failures.get(source, 0) + 1
+            if self.failures[source] >= self.max_failures:
+                self.failures[source] = 0
+                self.skip_until[source] = time.monotonic() + self.cooldown
+
+    def succeeded(self, source):
+        with self.lock:
+            self.failures.pop(source, None)
+
+
+cooldown = SourceCooldown(
+    max_failures=getattr(settings, "ISBN_SOURCE_MAX_FAILURES", 3),
+    cooldown=getattr(settings, "ISBN_SOURCE_COOLDOWN", 300),
+)
+# Shared so a lookup doesn't wait on sources that missed its deadline
+executor = ThreadPoolExecutor(
+    max_workers=4 * len(SOURCES), thread_name_prefix="isbn"
+)
+
 
 def lowercase_percentage(string):
     try:
@@ -39,23 +100,131 @@ def preferred(a, b):
     return a
 
 
-def get_isbn_data(isbn):
-    sources = ["wiki", "goob", "openl"]
-
+def merge(results):
     data = {}
-    error_count = 0
+    for result in results:
+        for key, val in result.items():
+            if key not in data:
+                data[key] = val
+            else:
+                data[key] = preferred(data[key], val)
+
+    return data
+
+
+def cache_key(isbn):
+    return ean13(canonical(isbn))
+
+
+def cached(isbn, source):
+    """Return the cache entry of `isbn` from `source`, if still fresh"""
+    entry = ISBNMetadata.objects.filter(isbn=isbn, source=source).first()
+    if entry is None:
+        return None
+
+    ttl = NOT_FOUND_CACHE_TTL if entry.data is None else CACHE_TTL
+    if entry.fetched + ttl <= timezone.now():
+        return None
+
+    return entry
 
-    for source in sources:
+
+def cache_hit(entry):
+    ISBNMetadata.objects.filter(pk=entry.pk).update(hits=F("hits") + 1)
+    return entry.data
+
+
+def cache_store(isbn, source, data):
+    ISBNMetadata.objects.update_or_create(
+        isbn=isbn,
+        source=source,
+        defaults={
+            "data": data,
+            "fetched": timezone.now(),
+            "fetches": F("fetches") + 1,
+        },
+        create_defaults={
+            "data": data,
+            "fetched": timezone.now(),
+            "fetches": 1,
+        },
+    )
+    return data
+
+
+def query(isbn, source):
+    """Get the metadata of `isbn` from `source`, or None if not found.
+    Raises ISBNLibException if the source can't be reached. Runs in the
+    executor, so it must not touch the database
+    """
+    try:
+        return meta(isbn, source) or None
+    except UNREACHABLE_ERRORS:
+        raise
+    except ISBNLibException:
+        return None
+
+
+def query_sources(isbn, sources):
+    """Query `sources` concurrently, until LOOKUP_TIMEOUT. Returns the
+    responses of the sources that answered in time, by source
+    """
+    futures = {
+        executor.submit(query, isbn, source): source for source in sources
+    }
+    done, not_done = wait(futures, timeout=LOOKUP_TIMEOUT)
+
+    responses = {}
+    for future in done:
+        source = futures[future]
         try:
-            for key, val in meta(isbn, source).items():
-                if key not in data:
-                    data[key] = val
-                else:
-                    data[key] = preferred(data[key], val)
+            responses[source] = future.result()
         except ISBNLibException:
-            error_count += 1
+            cooldown.failed(source)
+        else:
+            cooldown.succeeded(source)
+
+    for future in not_done:
+        future.cancel()
+        cooldown.failed(futures[future])
+
+    return responses
+
+
+def get_isbn_data(isbn, refresh=False):
+    """Get the metadata of `isbn` merged from all sources, through the
+    cache. Raises ISBNLibException if no source has it
+    """
+    isbn = cache_key(isbn)
+    entry = None if refresh else cached(isbn, MERGED)
+    if entry is not None:
+        data = cache_hit(entry)
+    else:
+        results = {}
+        pending = []
+        for source in SOURCES:
+            entry = None if refresh else cached(isbn, source)
+            if entry is not None:
+                results[source] = cache_hit(entry)
+            elif cooldown.available(source):
+                pending.append(source)
+
+        if pending:
+            for source, response in query_sources(isbn, pending).items():
+                results[source] = cache_store(isbn, source, response)
+
+        data = (
+            merge(
+                results[source] for source in SOURCES if results.get(source)
+            )
+            or None
+        )
+        # Don't keep a partial result: the next lookup retries the
+        # missing sources, reusing the cached responses of the others
+        if len(results) == len(SOURCES):
+            cache_store(isbn, MERGED, data)
 
-    if error_count == len(sources):
+    if data is None:
         raise ISBNLibException
 
     return data
@@ -1,20 +1,20 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 import pandas as pd
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand
-from django.utils import timezone
+from django.db import IntegrityError, connection, transaction
 from isbnlib import canonical, ean13
 
-from ... import isbn
-from ...models import Book, Classification, Location, Specimen
+from ... import isbn, search
+from ...models import Book, Classification, Collection, Location, Specimen
 from ...validators import validate_isbn
 
-User = get_user_model()
 csv_file = settings.BASE_DIR / "more_books.csv"
-USE_CSV_CODE = False
+CODE_ALLOCATION_ATTEMPTS = 5
 
 
 mandatory_fields = [
@@ -28,6 +28,15 @@ fillable_fields = [
     "autor",
     "editora",
 ]
+incomplete_fields = [
+    "isbn",
+    "busca",
+    "titulo",
+    "editora",
+    "autor",
+    "exemplares",
+    "valid_isbn",
+]
 
 
 def is_valid_isbn(val):
@@ -42,16 +51,18 @@ def is_valid_isbn(val):
 
 def dict_to_row(d):
     return {
-        "titulo": d["title"],
-        "autor": d["author"],
-        "editora": d["publisher"],
+        "titulo": d.get("title"),
+        "autor": d.get("author"),
+        "editora": d.get("publisher"),
     }
 
+
 def get_publisher(raw):
     if pd.isnull(raw):
         return None
     return re.sub(r"[-,\d\s\.]*$", "", raw).title()
 
+
 def get_author_names(raw):
     names = raw.split(";")[0]
     names = re.sub(r"[-,\d\s\.]*$", "", names)
@@ -63,135 +74,195 @@ def get_author_names(raw):
     return [name + "." if len(name) == 1 else name for name in names]
 
 
-def get_code(raw):
-    if not USE_CSV_CODE or pd.isnull(raw):
-        return None
-    words = raw.split()
-    return next(word for word in words if re.search(r"\d+", word))
+def get_units(raw):
+    return 1 if pd.isnull(raw) else int(float(raw))
+
+
+def lookup(value):
+    """Fetch the data of an ISBN. Runs in a worker thread, which gets its
+    own database connection for the cache
+    """
+    try:
+        data, _ = isbn.search(value, split_author=False)
+        return data
+    finally:
+        connection.close()
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
 
 class Command(BaseCommand):
     help = "Import books from csv"
 
-    def fill_incomplete(self, row):
-        if any(pd.isnull(row[f]) for f in fillable_fields):
-            self.stdout.write(
-                f"    Attempting to fetch data for {row['isbn']}..."
-            )
-            data, _ = isbn.search(str(row["isbn"]), split_author=False)
-            if data:
-                for field, value in dict_to_row(data).items():
-                    if pd.isnull(row[field]):
-                        row[field] = value
-
-        is_complete = all(
-            not pd.isnull(row[f]) and row[f].strip() for f in mandatory_fields
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default=csv_file)
+        parser.add_argument(
+            "--incomplete",
+            default="incomplete.csv",
+            help="Where to write the rows that couldn't be imported",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent ISBN lookups",
         )
-        return row, is_complete
 
-    def handle(self, *args, **options):
-        df = pd.read_csv(csv_file)
-        df["valid_isbn"] = df["isbn"].apply(is_valid_isbn)
-        incomplete = []
-        queryset = Book.objects.all()
-
-        if not queryset.exists():
-            existing_isbns = set()
-            existing_titles = set()
-        else:
-            existing_isbns, existing_titles = map(
-                set,
-                zip(
-                    *Book.objects.all().values_list("canonical_isbn", "title")
-                ),
-            )
+    def progress(self, stage, done, total):
+        rate = done / (perf_counter() - self.start)
+        self.stdout.write(f"{stage}: {done}/{total} ({rate:.0f}/s)")
+
+    def is_duplicate(self, row):
+        if pd.isnull(row["isbn"]):
+            title = row["titulo"].strip("/ ").strip()
+            return title in self.existing_titles
+        return ean13(canonical(row["isbn"])) in self.existing_isbns
 
-        n = len(df.index)
-        for i, row in df.iterrows():
-            self.stdout.write(f"{i}/{n}")
+    def filter_rows(self, rows):
+        """Drop the invalid rows and those of books already imported"""
+        valid = []
+        for row in rows:
+            row["valid_isbn"] = is_valid_isbn(row["isbn"])
             if not pd.isnull(row["isbn"]) and not row["valid_isbn"]:
                 self.stdout.write(f"    Invalid ISBN: {row['isbn']}")
-                incomplete.append(row)
-                continue
-
-            if pd.isnull(row["isbn"]) and pd.isnull(row["titulo"]):
-                self.stdout.write(f"    Insuficient data!")
-                incomplete.append(row)
-                continue
-
-            if (
-                pd.isnull(row["isbn"]) and row["titulo"] in existing_titles
-            ) or (
-                not pd.isnull(row["isbn"])
-                and ean13(canonical(row["isbn"])) in existing_isbns
-            ):
+                self.incomplete.append(row)
+            elif pd.isnull(row["isbn"]) and pd.isnull(row["titulo"]):
+                self.stdout.write("    Insuficient data!")
+                self.incomplete.append(row)
+            elif self.is_duplicate(row):
                 self.stdout.write(f"    {row['isbn']} already exists.")
-                continue
+            else:
+                valid.append(row)
 
-            row, is_complete = self.fill_incomplete(row)
-            if not is_complete:
-                self.stdout.write(f"    Insuficient data!")
-                incomplete.append(row)
-                continue
+        return valid
 
-            title = row["titulo"].strip("/ ").strip()
-            self.stdout.write(f"    Importing {title}...")
+    def fill_incomplete(self, rows, workers):
+        """Fill missing fields from the ISBN data, fetched concurrently"""
+        pending = list(
+            {
+                row["isbn"]
+                for row in rows
+                if row["valid_isbn"]
+                and any(pd.isnull(row[f]) for f in fillable_fields)
+            }
+        )
+        if not pending:
+            return
 
-            location, _ = Location.objects.get_or_create(
-                name=row["localizacao"].strip().title()
-            )
-            classification, _ = Classification.objects.get_or_create(
-                abbreviation=row["busca"].strip().title(),
-                location=location,
-            )
+        self.stdout.write(f"Fetching data for {len(pending)} ISBNs...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = {}
+            for i, (value, data) in enumerate(
+                zip(pending, executor.map(lookup, pending)), 1
+            ):
+                results[value] = data
+                if i % 100 == 0 or i == len(pending):
+                    self.progress("ISBN lookups", i, len(pending))
 
-            author_names = get_author_names(row["autor"])
-            book = Book(
-                isbn=(
-                    None
-                    if pd.isnull(row["isbn"]) or not row["isbn"]
-                    else row["isbn"]
-                ),
-                title=title,
-                author_first_names=" ".join(author_names[:-1]),
-                author_last_name=author_names[-1],
-                publisher=get_publisher(row["editora"]),
-                classification=classification,
-                creation_date=timezone.now(),
-                last_modified=timezone.now(),
-            )
+        for row in rows:
+            data = results.get(row["isbn"])
+            if data:
+                for field, value in dict_to_row(data).items():
+                    if pd.isnull(row[field]):
+                        row[field] = value
 
-            book.save()
-            book_code = get_code(row["etiqueta"])
-            existing_titles.add(book.title)
-            if book.isbn:
-                existing_isbns.add(ean13(canonical(book.isbn)))
+    def is_complete(self, row):
+        return all(
+            not pd.isnull(row[f]) and row[f].strip() for f in mandatory_fields
+        ) and bool(get_author_names(row["autor"]))
 
-            for i in range(
-                1 if pd.isnull(row["exemplares"]) else int(row["exemplares"])
-            ):
-                sp = Specimen(book=book)
+    def resolve_classifications(self, rows):
+        """Get or create the classifications (and their locations) of
+        `rows` with a query per model. Returns them by abbreviation
+        """
+        wanted = {}
+        for row in rows:
+            location = row.get("localizacao")
+            wanted.setdefault(
+                row["busca"].strip().title(),
+                None if pd.isnull(location) else location.strip().title(),
+            )
 
-                if USE_CSV_CODE:
-                    code = f"{book_code} Ex {i + 1}"
-                    if code:
-                        sp.code = code
-                sp.save()
+        classifications = Classification.objects.in_bulk(list(wanted))
+        missing = {
+            abbreviation: location
+            for abbreviation, location in wanted.items()
+            if abbreviation not in classifications and location
+        }
 
-        incomplete = pd.DataFrame(incomplete)
-        incomplete = incomplete[
+        locations = set(missing.values())
+        existing = set(
+            Location.objects.filter(name__in=locations).values_list(
+                "name", flat=True
+            )
+        )
+        Location.objects.bulk_create(
+            [Location(name=name) for name in locations - existing]
+        )
+        Classification.objects.bulk_create(
             [
-                "isbn",
-                "busca",
-                "titulo",
-                "editora",
-                "autor",
-                "exemplares",
-                "valid_isbn",
+                Classification(abbreviation=abbreviation, location_id=name)
+                for abbreviation, name in missing.items()
             ]
-        ]
+        )
+
+        return Classification.objects.in_bulk(list(wanted))
 
+    def build_book(self, row, classification):
+        author_names = get_author_names(row["autor"])
+        book = Book(
+            isbn=row["isbn"] if row["valid_isbn"] else None,
+            title=row["titulo"].strip("/ ").strip(),
+            author_first_names=" ".join(author_names[:-1]),
+            author_last_name=author_names[-1],
+            publisher=get_publisher(row["editora"]),
+            classification=classification,
+            collection_id=self.collection,
+        )
+        book.normalize_fields()
+        return book
+
+    def allocate_codes(self, books):
+        for book in books:
+            book.code = book.calc_code(taken=self.taken_codes)
+            book.search_document = search.get_document(book)
+            self.taken_codes.add(book.code)
+
+    def create_chunk(self, books, units):
+        """Insert a chunk of books with their specimens in a transaction,
+        allocating their cutter codes. If a concurrent save took one of
+        the codes, reload the codes in use and try again
+        """
+        for attempt in range(CODE_ALLOCATION_ATTEMPTS):
+            self.allocate_codes(books)
+            try:
+                with transaction.atomic():
+                    Book.objects.bulk_create(books)
+                    Specimen.objects.bulk_create(
+                        Specimen(book=book, number=number)
+                        for book, n in zip(books, units)
+                        for number in range(1, n + 1)
+                    )
+                    search.index_books(books)
+                    return
+            except IntegrityError:
+                if attempt + 1 == CODE_ALLOCATION_ATTEMPTS:
+                    raise
+                for book in books:
+                    book.pk = None
+                    book.code = None
+                self.taken_codes = set(
+                    Book.objects.values_list("code", flat=True)
+                )
+
+    def write_incomplete(self, path):
+        incomplete = pd.DataFrame(self.incomplete, columns=incomplete_fields)
         incomplete["exemplares"] = (
-            incomplete["exemplares"].fillna(0).astype(int)
+            pd.to_numeric(incomplete["exemplares"]).fillna(0).astype(int)
         )
         incomplete["busca"] = incomplete["busca"].apply(
             lambda b: str(b).title()
@@ -199,4 +270,67 @@ class Command(BaseCommand):
         incomplete = incomplete.sort_values(
             ["busca", "titulo", "autor", "editora"]
         )
-        incomplete.to_csv("incomplete.csv")
+        incomplete.to_csv(path)
+
+    def handle(self, *args, **options):
+        self.start = perf_counter()
+        self.incomplete = []
+        self.existing_isbns = set()
+        self.existing_titles = set()
+        self.taken_codes = set()
+        for canonical_isbn, title, code in Book.objects.values_list(
+            "canonical_isbn", "title", "code"
+        ):
+            self.existing_isbns.add(canonical_isbn)
+            self.existing_titles.add(title)
+            self.taken_codes.add(code)
+        self.collection = Collection.get_default_pk()
+
+        rows = pd.read_csv(options["path"], dtype=str).to_dict("records")
+        n = len(rows)
+        rows = self.filter_rows(rows)
+        self.fill_incomplete(rows, options["workers"])
+
+        complete = []
+        for row in rows:
+            if not self.is_complete(row):
+                self.stdout.write(f"    Insuficient data for {row['isbn']}!")
+                self.incomplete.append(row)
+            elif self.is_duplicate(row):
+                self.stdout.write(f"    {row['isbn']} already exists.")
+            else:
+                complete.append(row)
+                self.existing_titles.add(row["titulo"].strip("/ ").strip())
+                if row["valid_isbn"]:
+                    self.existing_isbns.add(ean13(canonical(row["isbn"])))
+
+        classifications = self.resolve_classifications(complete)
+        imported = 0
+        for chunk in chunks(complete, options["chunk_size"]):
+            books, units = [], []
+            for row in chunk:
+                classification = classifications.get(
+                    row["busca"].strip().title()
+                )
+                if classification is None:
+                    self.stdout.write(
+                        f"    No location for {row['busca']}, "
+                        f"skipping {row['titulo']}"
+                    )
+                    self.incomplete.append(row)
+                    continue
+                books.append(self.build_book(row, classification))
+                units.append(get_units(row["exemplares"]))
+
+            self.create_chunk(books, units)
+            imported += len(books)
+            self.progress("Imported", imported, len(complete))
+
+        self.write_incomplete(options["incomplete"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {imported} of {n} rows in "
+                f"{perf_counter() - self.start:.1f}s, "
+                f"{len(self.incomplete)} incomplete"
+            )
+        )
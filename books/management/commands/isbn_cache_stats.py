@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...models import ISBNMetadata
+
+
+class Command(BaseCommand):
+    help = "Report the hit ratio of the ISBN metadata cache"
+
+    def handle(self, *args, **options):
+        stats = ISBNMetadata.objects.stats()
+        if not stats:
+            self.stdout.write(_("Cache de ISBN vazio"))
+            return
+
+        for source, row in sorted(stats.items()):
+            lookups = row["hits"] + row["fetches"]
+            row["ratio"] = 100 * row["hits"] / lookups if lookups else 0
+            self.stdout.write(
+                _(
+                    "%(source)s: %(entries)d entradas (%(not_found)d não "
+                    "encontradas), %(hits)d acertos, %(fetches)d consultas, "
+                    "%(ratio).1f%% de acertos"
+                )
+                % {"source": source, **row}
+            )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...models import Specimen
+
+
+class Command(BaseCommand):
+    help = "Recompute the availability of every specimen from its loans"
+
+    def handle(self, *args, **options):
+        count = Specimen.objects.update_availability()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Disponibilidade de %(count)d exemplares recalculada")
+                % {"count": count}
+            )
+        )
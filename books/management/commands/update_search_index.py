@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ... import search
+from ...models import Book
+
+
+class Command(BaseCommand):
+    help = "Rebuild the catalogue search index"
+
+    def handle(self, *args, **options):
+        count = search.rebuild_index(Book.objects.all())
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Índice de busca refeito para %(count)d livros")
+                % {"count": count}
+            )
+        )
@@ -0,0 +1,59 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from isbnlib import ISBNLibException, get_isbnlike
+
+from ... import isbn
+from ...validators import validate_isbn
+
+
+class Command(BaseCommand):
+    help = "Fetch the metadata of the ISBNs found in a file into the cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Text or csv file with ISBNs")
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Fetch again ISBNs that are already cached",
+        )
+
+    def read_isbns(self, path):
+        keys = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                for value in get_isbnlike(line):
+                    try:
+                        validate_isbn(value)
+                    except ValidationError:
+                        continue
+                    keys.setdefault(isbn.cache_key(value), value)
+
+        return list(keys)
+
+    def handle(self, *args, **options):
+        isbns = self.read_isbns(options["path"])
+        counts = {"found": 0, "not_found": 0, "cached": 0}
+
+        n = len(isbns)
+        for i, value in enumerate(isbns, 1):
+            self.stdout.write(f"{i}/{n} {value}")
+            if not options["refresh"] and isbn.cached(value, isbn.MERGED):
+                counts["cached"] += 1
+                continue
+
+            try:
+                isbn.get_isbn_data(value, refresh=options["refresh"])
+                counts["found"] += 1
+            except ISBNLibException:
+                counts["not_found"] += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _(
+                    "%(found)d ISBNs encontrados, %(not_found)d não "
+                    "encontrados e %(cached)d já em cache"
+                )
+                % counts
+            )
+        )
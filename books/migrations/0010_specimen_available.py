@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-18 00:57
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+
+def compute_availability(apps, schema_editor):
+    Specimen = apps.get_model("books", "Specimen")
+    Loan = apps.get_model("loans", "Loan")
+
+    open_loans = Loan.objects.filter(
+        specimen=OuterRef("pk"), return_date__isnull=True
+    )
+    Specimen.objects.update(available=~Exists(open_loans))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0009_remove_book_unique_isbn_remove_book_unique_code_and_more"),
+        (
+            "loans",
+            "0002_period_is_default_renewal_is_default_and_more_squashed_0007_remove_period_renewals_renewal_period_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="specimen",
+            name="available",
+            field=models.BooleanField(
+                db_index=True,
+                default=True,
+                editable=False,
+                verbose_name="Disponível?",
+            ),
+        ),
+        migrations.RunPython(compute_availability, migrations.RunPython.noop),
+    ]
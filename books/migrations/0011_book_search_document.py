@@ -0,0 +1,93 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:03
+
+from django.db import DatabaseError, migrations, models, transaction
+from unidecode import unidecode
+
+# Frozen copies of books.search as of this migration
+FTS_TABLE = "books_book_search"
+TRIGRAM_INDEX = "books_book_search_document_trgm"
+
+DOCUMENT_FIELDS = [
+    "isbn",
+    "canonical_isbn",
+    "title",
+    "author_first_names",
+    "author_last_name",
+    "publisher",
+    "code",
+]
+
+
+def get_document(book):
+    return "\n".join(
+        unidecode(str(value)).lower()
+        for field in DOCUMENT_FIELDS
+        if (value := getattr(book, field))
+    )
+
+
+def fill_documents(apps, schema_editor):
+    Book = apps.get_model("books", "Book")
+
+    books = list(Book.objects.all())
+    for book in books:
+        book.search_document = get_document(book)
+    Book.objects.bulk_update(books, ["search_document"], batch_size=1000)
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "postgresql":
+        statements = [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            f"CREATE INDEX {TRIGRAM_INDEX} ON books_book "
+            "USING gin (search_document gin_trgm_ops)",
+        ]
+    elif vendor == "sqlite":
+        statements = [
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} "
+            "USING fts5(document, tokenize='trigram')",
+            f"INSERT INTO {FTS_TABLE}(rowid, document) "
+            "SELECT id, search_document FROM books_book",
+        ]
+    else:
+        return
+
+    # The index is only an optimization: without it (e.g. no permission to
+    # create the extension, or no FTS5 support) search falls back to plain
+    # substring lookups
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            for statement in statements:
+                schema_editor.execute(statement)
+    except DatabaseError:
+        pass
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {TRIGRAM_INDEX}")
+    elif vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0010_specimen_available"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="search_document",
+            field=models.TextField(
+                default="", editable=False, verbose_name="Documento de busca"
+            ),
+        ),
+        migrations.RunPython(fill_documents, migrations.RunPython.noop),
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0011_book_search_document"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ISBNMetadata",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "isbn",
+                    models.CharField(max_length=13, verbose_name="ISBN-13 canônico"),
+                ),
+                ("source", models.CharField(max_length=10, verbose_name="Fonte")),
+                ("data", models.JSONField(null=True, verbose_name="Dados")),
+                ("fetched", models.DateTimeField(verbose_name="Data da consulta")),
+                (
+                    "hits",
+                    models.PositiveIntegerField(default=0, verbose_name="Acertos"),
+                ),
+                (
+                    "fetches",
+                    models.PositiveIntegerField(default=0, verbose_name="Consultas"),
+                ),
+            ],
+            options={
+                "verbose_name": "Metadados de ISBN",
+                "verbose_name_plural": "Metadados de ISBN",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="isbnmetadata",
+            constraint=models.UniqueConstraint(
+                fields=("isbn", "source"), name="unique isbn metadata source"
+            ),
+        ),
+    ]
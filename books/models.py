@@ -1,9 +1,9 @@
 from colorfield.fields import ColorField
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Count, Q
-from django.db.models.lookups import Exact
-from django.utils import timezone
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 from isbnlib import canonical, ean13
@@ -11,7 +11,7 @@ from unidecode import unidecode
 
 from default_object.models import DefaultObjectMixin
 
-from . import cutter
+from . import cutter, search
 from .language import ARTICLES
 from .validators import validate_isbn
 
@@ -156,20 +156,32 @@ class Book(models.Model):
     last_modified = models.DateTimeField(
         auto_now=True, verbose_name=_("Última modificação")
     )
+    search_document = models.TextField(
+        verbose_name=_("Documento de busca"),
+        editable=False,
+        default="",
+    )
+
+    code_allocation_attempts = 5
 
     def units(self):
+        if hasattr(self, "specimens__count"):
+            return self.specimens__count
         return self.specimens.count()
 
     @property
     def pending_labeling(self):
         return self.specimens.filter(label_printed=False).exists()
 
-    def calc_title_first_letters(self, n=1):
+    def calc_title_letters(self):
         words = self.title.split()
         while words[0].lower() in ARTICLES:
             del words[0]
 
-        letters = "".join(words)
+        return "".join(words)
+
+    def calc_title_first_letters(self, n=1):
+        letters = self.calc_title_letters()
         m = n - len(letters)
         first_letters = unidecode(letters[:n].lower())
         if m > 0:
@@ -178,27 +190,47 @@ class Book(models.Model):
         return first_letters
 
 
-    def calc_code(self):
+    def calc_code_prefix(self):
         cutcode = cutter.get(self.author_last_name)
         author = self.author_last_name[0].upper()
 
-        n = 1
-        while self.__class__.objects.filter(
-            code=(
-                code := f"{author}{cutcode}{self.calc_title_first_letters(n)}"
+        return f"{author}{cutcode}"
+
+    def calc_code(self, taken=None):
+        """Find the first free cutter code for this book. `taken` is a
+        set of codes already in use (at least those sharing this book's
+        prefix); if not given, it is fetched with a single query
+        """
+        prefix = self.calc_code_prefix()
+        if taken is None:
+            # Every candidate code starts with the first title letter
+            lookup = f"{prefix}{self.calc_title_first_letters(1)}"
+            taken = set(
+                self.__class__.objects.filter(
+                    code__startswith=lookup
+                ).values_list("code", flat=True)
             )
-        ).exists():
-            n += 1
 
-        return code
+        size = len(self.calc_title_letters())
+        for n in range(1, size + 1):
+            code = f"{prefix}{self.calc_title_first_letters(n)}"
+            if code not in taken:
+                return code
+
+        # Past the title's length, codes only differ by a numeric suffix
+        code = f"{prefix}{self.calc_title_first_letters(size)}"
+        m = 1
+        while f"{code}{m}" in taken:
+            m += 1
+
+        return f"{code}{m}"
 
     @property
     def author(self):
         return f"{self.author_first_names} {self.author_last_name}"
 
-    def save(self, *args, **kwargs):
-        if not self.code:
-            self.code = self.calc_code()
+    def normalize_fields(self):
+        """Fill the canonical ISBN and the unaccented fields"""
         if self.isbn:
             self.isbn = canonical(self.isbn)
             self.canonical_isbn = ean13(self.isbn)
@@ -209,11 +241,39 @@ class Book(models.Model):
             f"{self.author_first_names} {self.author_last_name}"
         )
         self.unaccent_title = unidecode(self.title)
-        return super().save(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        self.normalize_fields()
+
+        if self.code:
+            self.search_document = search.get_document(self)
+            return super().save(*args, **kwargs)
+
+        # A concurrent save may take the code between calc_code and the
+        # insert, so rely on the unique constraint and try again
+        for attempt in range(self.code_allocation_attempts):
+            self.code = self.calc_code()
+            self.search_document = search.get_document(self)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if (
+                    attempt + 1 == self.code_allocation_attempts
+                    or not self.__class__.objects.filter(
+                        code=self.code
+                    ).exists()
+                ):
+                    self.code = None
+                    raise
+
+        return None
 
     @property
     def available(self):
-        return self.specimens.filter(_available=True).exists()
+        if hasattr(self, "_available"):
+            return self._available
+        return self.specimens.filter(available=True).exists()
 
 
     def __str__(self):
@@ -225,18 +285,62 @@ class Book(models.Model):
         ordering = ["author_last_name", "title"]
 
 
-# pylint: disable-next=too-few-public-methods
+@receiver(post_save, sender=Book)
+def index_book_hook(sender, instance, *args, **kwargs):
+    search.index_books([instance])
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book_hook(sender, instance, *args, **kwargs):
+    search.unindex_books([instance.pk])
+
+
 class SpecimenManager(models.Manager):
-    """Annotate if specimen is available (`_available`)"""
+    numbering_attempts = 5
+
+    def last_number(self, book):
+        return (
+            self.filter(book=book).aggregate(last=Max("number"))["last"] or 0
+        )
 
-    def get_queryset(self, *args, **kwargs):
-        qs = super().get_queryset(*args, **kwargs)
-        count_returned = Count(
-            "loans", filter=Q(loans__return_date__lt=timezone.now())
+    def number_taken(self, book, numbers):
+        return self.filter(book=book, number__in=numbers).exists()
+
+    def bulk_create_numbered(self, book, n, **kwargs):
+        """Create `n` specimens of `book` in one insert, numbered after
+        the existing ones
+        """
+        for attempt in range(self.numbering_attempts):
+            last = self.last_number(book)
+            specimens = [
+                self.model(book=book, number=last + i, **kwargs)
+                for i in range(1, n + 1)
+            ]
+            try:
+                with transaction.atomic():
+                    return self.bulk_create(specimens)
+            except IntegrityError:
+                if attempt + 1 == self.numbering_attempts or not (
+                    self.number_taken(book, [s.number for s in specimens])
+                ):
+                    raise
+
+        return []
+
+    def update_availability(self, specimens=None):
+        """Recompute the `available` column from the loans table, for
+        the given specimens (pks or queryset) or for all of them
+        """
+        loan_model = self.model._meta.get_field("loans").related_model
+        open_loans = loan_model._base_manager.filter(
+            specimen=OuterRef("pk"), return_date__isnull=True
         )
-        qs = qs.annotate(_available=Exact(count_returned, Count("loans")))
 
-        return qs
+        qs = self.all()
+        if specimens is not None:
+            qs = qs.filter(pk__in=specimens)
+
+        return qs.update(available=~Exists(open_loans))
 
 
 class Specimen(models.Model):
@@ -257,25 +361,36 @@ class Specimen(models.Model):
         default=False,
         verbose_name=_("Etiqueta impressa?"),
     )
-
-    @property
-    def available(self):
-        if hasattr(self, "_available"):
-            return self._available
-
-        returned_loans = self.loans.filter(return_date__lt=timezone.now())
-        all_loans = self.loans.all()
-        return all_loans.count() == returned_loans.count()
+    available = models.BooleanField(
+        default=True,
+        editable=False,
+        db_index=True,
+        verbose_name=_("Disponível?"),
+    )
 
     def __str__(self):
         return f"E{self.number} | {self.book}"
 
     def save(self, *args, **kwargs):
-        cls = self.__class__
-        qs = cls.objects.filter(book=self.book)
-        self.number = max(o.number for o in qs) + 1 if qs else 1
-
-        super().save(*args, **kwargs)
+        if not self._state.adding or self.number:
+            super().save(*args, **kwargs)
+            return
+
+        # Number on insert only, retrying if a concurrent insert took
+        # the same number
+        manager = self.__class__.objects
+        for attempt in range(manager.numbering_attempts):
+            self.number = manager.last_number(self.book_id) + 1
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                    return
+            except IntegrityError:
+                if attempt + 1 == manager.numbering_attempts or not (
+                    manager.number_taken(self.book_id, [self.number])
+                ):
+                    self.number = 0
+                    raise
 
     class Meta:
         verbose_name = _("Exemplar")
@@ -286,3 +401,47 @@ class Specimen(models.Model):
             ),
         ]
         ordering = ["book__author_last_name", "book__title", "number"]
+
+
+class ISBNMetadataManager(models.Manager):
+    def stats(self):
+        """Entries, hits and fetches of the cache, by source"""
+        rows = (
+            self.order_by()
+            .values("source")
+            .annotate(
+                entries=Count("pk"),
+                not_found=Count("pk", filter=Q(data__isnull=True)),
+                hits=Sum("hits"),
+                fetches=Sum("fetches"),
+            )
+        )
+        return {row.pop("source"): row for row in rows}
+
+
+class ISBNMetadata(models.Model):
+    """Cached response of an ISBN metadata source, or the merged result
+    of all of them. `data` is null if the ISBN wasn't found
+    """
+
+    objects = ISBNMetadataManager()
+    isbn = models.CharField(max_length=13, verbose_name=_("ISBN-13 canônico"))
+    source = models.CharField(max_length=10, verbose_name=_("Fonte"))
+    data = models.JSONField(null=True, verbose_name=_("Dados"))
+    fetched = models.DateTimeField(verbose_name=_("Data da consulta"))
+    hits = models.PositiveIntegerField(default=0, verbose_name=_("Acertos"))
+    fetches = models.PositiveIntegerField(
+        default=0, verbose_name=_("Consultas")
+    )
+
+    def __str__(self):
+        return f"{self.isbn} ({self.source})"
+
+    class Meta:
+        verbose_name = _("Metadados de ISBN")
+        verbose_name_plural = _("Metadados de ISBN")
+        constraints = [
+            models.UniqueConstraint(
+                fields=("isbn", "source"), name="unique isbn metadata source"
+            ),
+        ]
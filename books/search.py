@@ -0,0 +1,182 @@
+"""Catalogue search backed by a database index.
+
+Each book keeps a normalized `search_document` (unaccented, lowercase)
+with the text fields the admin searches on. On PostgreSQL the column
+has a trigram GIN index, so substring lookups on it are index scans; on
+SQLite the documents are mirrored into an FTS5 table with the trigram
+tokenizer. Other databases fall back to plain substring lookups on the
+column.
+"""
+
+from functools import cache
+
+from django.db import connection
+from django.db.models import Case, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils.text import smart_split, unescape_string_literal
+from isbnlib import canonical, clean, ean13, get_isbnlike
+from unidecode import unidecode
+
+FTS_TABLE = "books_book_search"
+FTS_MIN_LENGTH = 3  # The trigram tokenizer can't match shorter terms
+
+document_fields = [
+    "isbn",
+    "canonical_isbn",
+    "title",
+    "author_first_names",
+    "author_last_name",
+    "publisher",
+    "code",
+]
+
+
+def normalize(value):
+    return unidecode(str(value)).lower()
+
+
+def get_document(book):
+    # Fields are kept on separate lines so terms don't match across them
+    return "\n".join(
+        normalize(value)
+        for field in document_fields
+        if (value := getattr(book, field))
+    )
+
+
+def get_terms(search_term):
+    """Split the search term the same way the django admin does"""
+    terms = []
+    for bit in smart_split(search_term):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            bit = unescape_string_literal(bit)
+        if bit:
+            terms.append(bit)
+
+    return terms
+
+
+@cache
+def uses_fts():
+    if connection.vendor != "sqlite":
+        return False
+
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def index_books(books):
+    """Mirror the documents of `books` into the FTS table, if in use"""
+    if not uses_fts():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+            [(book.pk,) for book in books],
+        )
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE}(rowid, document) VALUES (%s, %s)",
+            [(book.pk, book.search_document) for book in books],
+        )
+
+
+def unindex_books(pks):
+    if not uses_fts():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+            [(pk,) for pk in pks],
+        )
+
+
+def rebuild_index(queryset):
+    """Recompute the documents of every book in `queryset` and rebuild
+    the FTS table from them
+    """
+    books = list(queryset.only("pk", *document_fields))
+    for book in books:
+        book.search_document = get_document(book)
+    queryset.model.objects.bulk_update(
+        books, ["search_document"], batch_size=1000
+    )
+
+    if uses_fts():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        index_books(books)
+
+    return len(books)
+
+
+def document_filter(term, prefix=""):
+    term = normalize(term)
+
+    if uses_fts() and len(term) >= FTS_MIN_LENGTH:
+        match = '"{}"'.format(term.replace('"', '""'))
+        return Q(
+            **{
+                f"{prefix}pk__in": RawSQL(
+                    f"SELECT rowid FROM {FTS_TABLE} "
+                    f"WHERE {FTS_TABLE} MATCH %s",
+                    [match],
+                )
+            }
+        )
+
+    return Q(**{f"{prefix}search_document__contains": term})
+
+
+def search_filter(search_term, prefix=""):
+    """Build the filter for `search_term` over books, or over specimens
+    if `prefix` is "book__". Every term must match the book's document,
+    its classification or, if numeric, a specimen id
+    """
+    # Imported here, since models use this module
+    from .models import Specimen  # pylint: disable=import-outside-toplevel
+
+    query = Q()
+    for term in get_terms(search_term):
+        term_query = document_filter(term, prefix)
+        for field in ("classification__name", "classification__abbreviation"):
+            term_query |= Q(**{f"{prefix}{field}__icontains": term})
+
+        if term.isdigit() and prefix:
+            term_query |= Q(pk=int(term))
+        elif term.isdigit():
+            specimens = Specimen.objects.filter(pk=int(term))
+            term_query |= Q(pk__in=specimens.values("book"))
+
+        query &= term_query
+
+    if get_isbnlike(search_term, level="strict"):
+        isbn = ean13(canonical(clean(search_term)))
+        query |= Q(**{f"{prefix}canonical_isbn": isbn})
+
+    return query
+
+
+def search_rank(search_term, prefix=""):
+    """Rank results by how many terms they match on the title (higher)
+    and on the author
+    """
+    rank = Value(0)
+    for term in get_terms(search_term):
+        term = unidecode(term)
+        for field, weight in (("unaccent_title", 2), ("unaccent_author", 1)):
+            rank += Case(
+                When(
+                    **{f"{prefix}{field}__icontains": term},
+                    then=Value(weight),
+                ),
+                default=Value(0),
+            )
+
+    return rank
+
+
+def search(queryset, search_term, prefix=""):
+    """Filter `queryset` by `search_term`, annotating `_search_rank`"""
+    qs = queryset.filter(search_filter(search_term, prefix))
+    return qs.annotate(_search_rank=search_rank(search_term, prefix))
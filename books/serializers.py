@@ -5,7 +5,13 @@ from rest_framework import serializers
 import csvio
 
 from .isbn import search
-from .models import Book, Classification, Collection, Location
+from .models import (
+    Book,
+    Classification,
+    Collection,
+    Location,
+    Specimen,
+)
 
 
 class CollectionSerializer(serializers.ModelSerializer):
@@ -71,8 +77,8 @@ class BookSerializer(serializers.ModelSerializer):
 
         book = super().create(validated_data)
 
-        for _ in range(units):
-            book.specimens.create()
+        if units:
+            Specimen.objects.bulk_create_numbered(book, units)
 
         return book
 
@@ -0,0 +1,153 @@
+from io import StringIO
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ..admin import BookAdmin, SpecimenAdmin
+from ..models import Book, Specimen
+from .test_catalog import create_test_catalog
+
+User = get_user_model()
+
+
+class BookChangelistTestCase(TestCase):
+    def setUp(self):
+        create_test_catalog()
+        self.admin_user = User.objects.create_superuser(
+            "admin",
+            "admin@example.com",
+            "admin",
+        )
+
+    def add_books(self, n):
+        template = Book.objects.exclude(classification=None).first()
+        for i in range(n):
+            book = Book.objects.create(
+                title=f"Livro {i}",
+                author_last_name="Silva",
+                classification=template.classification,
+                collection=template.collection,
+            )
+            book.specimens.create()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url):
+        self.count_queries(url)  # Create singletons on the first load
+        before = self.count_queries(url)
+        self.add_books(30)
+        self.assertEqual(self.count_queries(url), before)
+
+    def test_admin_changelist(self):
+        self.client.force_login(self.admin_user)
+        self.assertConstantQueries(reverse("admin:books_book_changelist"))
+
+    def test_search_changelist(self):
+        url = reverse("public_admin:books_book_changelist")
+        response = self.client.get(url, {"q": "camus"})
+        self.assertContains(response, "O estrangeiro")
+
+        response = self.client.get(url, {"q": "camus", "o": "1"})
+        self.assertContains(response, "O estrangeiro")
+
+    def test_public_changelist(self):
+        self.assertConstantQueries(
+            reverse("public_admin:books_book_changelist")
+        )
+
+
+class SearchTestCase(TestCase):
+    astecas = (
+        "A vida quotidiana dos Astecas na véspera da conquista espanhola"
+    )
+
+    def setUp(self):
+        create_test_catalog()
+        self.book_admin = BookAdmin(Book, admin.site)
+        self.specimen_admin = SpecimenAdmin(Specimen, admin.site)
+
+    def search(self, term, model_admin=None):
+        model_admin = model_admin or self.book_admin
+        qs, _ = model_admin.get_search_results(
+            None, model_admin.model.objects.all(), term
+        )
+        return qs
+
+    def titles(self, term):
+        return set(self.search(term).values_list("title", flat=True))
+
+    def test_fields(self):
+        self.assertEqual(self.titles("apócrifas"), {"Histórias apócrifas"})
+        self.assertEqual(self.titles("apocrifas"), {"Histórias apócrifas"})
+        self.assertEqual(self.titles("TCHAPEK"), {"Histórias apócrifas"})
+        self.assertEqual(self.titles("companhia"), {"Operação cetro dourado"})
+        self.assertEqual(self.titles("c4"), {"O estrangeiro"})
+        self.assertEqual(self.titles("ClasS3"), {self.astecas})
+
+    def test_short_terms(self):
+        self.assertEqual(
+            self.titles("ca"),
+            {
+                "Amor de perdicao",
+                "Operação cetro dourado",
+                self.astecas,
+                "O estrangeiro",
+            },
+        )
+
+    def test_terms(self):
+        self.assertEqual(self.titles("camus estrangeiro"), {"O estrangeiro"})
+        self.assertEqual(self.titles('"o estrangeiro"'), {"O estrangeiro"})
+        self.assertEqual(self.titles("camus perdicao"), set())
+
+    def test_isbn(self):
+        self.assertEqual(self.titles("85-00-91259-6"), {"Amor de perdicao"})
+        self.assertEqual(self.titles("9788500912597"), {"Amor de perdicao"})
+
+    def test_specimen_id(self):
+        specimen = Specimen.objects.get(book__title="O estrangeiro", number=2)
+
+        self.assertIn("O estrangeiro", self.titles(f"{specimen.pk:06d}"))
+        self.assertEqual(
+            list(self.search(str(specimen.pk), self.specimen_admin)),
+            [specimen],
+        )
+
+    def test_specimen_admin(self):
+        specimens = self.search("camus", self.specimen_admin)
+        self.assertEqual(
+            set(specimens),
+            set(Specimen.objects.filter(book__title="O estrangeiro")),
+        )
+
+    def test_rank(self):
+        Book.objects.create(title="Sobre Camus", author_last_name="Sartre")
+        self.assertEqual(
+            self.search("camus").order_by("-_search_rank").first().title,
+            "Sobre Camus",
+        )
+
+    def test_index_sync(self):
+        book = Book.objects.get(title="O estrangeiro")
+        book.title = "A peste"
+        book.save()
+        self.assertEqual(self.titles("estrangeiro"), set())
+        self.assertEqual(self.titles("peste"), {"A peste"})
+
+        book.delete()
+        self.assertEqual(self.titles("peste"), set())
+
+    def test_rebuild(self):
+        Book.objects.update(search_document="")
+        call_command("update_search_index", stdout=StringIO())
+        self.assertEqual(self.titles("estrangeiro"), {"O estrangeiro"})
@@ -0,0 +1,145 @@
+import csv
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from .. import isbn, search
+from ..models import Book, Classification, Location, Specimen
+
+fields = [
+    "isbn",
+    "busca",
+    "localizacao",
+    "titulo",
+    "editora",
+    "autor",
+    "exemplares",
+]
+
+
+class ImportBooksTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = Path(self.dir.name) / "books.csv"
+        self.incomplete = Path(self.dir.name) / "incomplete.csv"
+
+        Location.objects.create(name="Sala")
+        Classification.objects.create(abbreviation="Rom", location_id="Sala")
+        Book.objects.create(
+            title="Contos", author_last_name="Rosa", isbn="9780306406157"
+        )
+
+    def write(self, rows):
+        with open(self.path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def run_import(self, **kwargs):
+        out = StringIO()
+        call_command(
+            "import_books",
+            self.path,
+            incomplete=self.incomplete,
+            stdout=out,
+            **kwargs,
+        )
+        return out.getvalue()
+
+    def search(self, value, split_author=True):
+        data = {
+            "9788535914849": {
+                "title": "O cortiço",
+                "author": "Aluísio Azevedo",
+                "publisher": "Ática",
+            }
+        }.get(value)
+        return data, []
+
+    def test_import(self):
+        rows = [
+            {
+                "busca": "rom",
+                "titulo": f"Livro {i}",
+                "editora": "Editora",
+                "autor": "Silva, Maria",
+                "exemplares": "2",
+            }
+            for i in range(25)
+        ]
+        rows += [
+            # Filled from the ISBN data
+            {"isbn": "9788535914849", "busca": "Cla", "localizacao": "Sala"},
+            # Already in the catalogue
+            {"isbn": "0306406152", "busca": "Rom", "titulo": "Contos"},
+            # Invalid ISBN and incomplete rows
+            {"isbn": "123", "busca": "Rom", "titulo": "Nada"},
+            {"busca": "Rom", "titulo": "Sem autor", "editora": "Editora"},
+            # New classification without a location
+            {
+                "busca": "Poe",
+                "titulo": "Versos",
+                "editora": "Editora",
+                "autor": "Souza",
+            },
+        ]
+        self.write(rows)
+
+        with mock.patch.object(isbn, "search", self.search):
+            out = self.run_import(chunk_size=10)
+
+        self.assertIn("Imported 26 of 30 rows", out)
+        self.assertEqual(Book.objects.count(), 27)
+        self.assertEqual(Specimen.objects.count(), 51)
+
+        book = Book.objects.get(canonical_isbn="9788535914849")
+        self.assertEqual(book.author_last_name, "Azevedo")
+        self.assertEqual(book.classification.location.name, "Sala")
+        self.assertEqual(book.specimens.get().number, 1)
+        self.assertEqual(
+            search.search(Book.objects.all(), "cortico").get(), book
+        )
+
+        codes = list(Book.objects.values_list("code", flat=True))
+        self.assertEqual(len(codes), len(set(codes)))
+        self.assertEqual(
+            list(
+                Book.objects.get(title="Livro 3")
+                .specimens.order_by("number")
+                .values_list("number", flat=True)
+            ),
+            [1, 2],
+        )
+
+        with open(self.incomplete, encoding="utf-8") as f:
+            titles = {row["titulo"] for row in csv.DictReader(f)}
+        self.assertEqual(titles, {"Nada", "Sem autor", "Versos"})
+
+        # Running again imports nothing
+        self.assertIn("Imported 0 of 30 rows", self.run_import())
+        self.assertEqual(Book.objects.count(), 27)
+
+    def test_constant_queries(self):
+        def rows(n):
+            return [
+                {
+                    "busca": "Rom",
+                    "titulo": f"Livro {n} {i}",
+                    "editora": "Editora",
+                    "autor": "Maria Silva",
+                }
+                for i in range(n)
+            ]
+
+        self.write(rows(5))
+        with self.assertNumQueries(10) as ctx:
+            self.run_import()
+
+        self.write(rows(50))
+        with self.assertNumQueries(len(ctx.captured_queries)):
+            self.run_import()
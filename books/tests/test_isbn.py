@@ -0,0 +1,171 @@
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+from isbnlib import ISBNLibException
+from isbnlib.dev import ServiceIsDownError
+
+from .. import isbn
+from ..models import ISBNMetadata
+
+ISBN = "9788535914849"
+OTHER_ISBN = "9780306406157"
+
+responses = {
+    "wiki": {"Title": "O CORTIÇO", "Authors": ["Aluísio Azevedo"]},
+    "goob": {"Title": "O cortiço", "Publisher": "Ática"},
+    "openl": {},
+}
+
+
+class ISBNCacheTestCase(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.responses = {ISBN: responses}
+        self.delays = {}
+        for name, value in (
+            ("meta", self.meta),
+            ("cooldown", isbn.SourceCooldown(max_failures=2, cooldown=60)),
+            ("LOOKUP_TIMEOUT", 0.5),
+        ):
+            patcher = mock.patch.object(isbn, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def meta(self, value, source):
+        self.calls.append((value, source))
+        time.sleep(self.delays.get(source, 0))
+        response = self.responses.get(value, {}).get(source, {})
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def test_repeat_lookup_is_cached(self):
+        data = isbn.get_isbn_data(ISBN)
+        self.assertEqual(data["Title"], "O cortiço")
+        self.assertEqual(data["Publisher"], "Ática")
+        self.assertEqual(len(self.calls), 3)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(isbn.get_isbn_data(ISBN), data)
+        self.assertEqual(len(self.calls), 3)
+
+        merged = ISBNMetadata.objects.get(isbn=ISBN, source=isbn.MERGED)
+        self.assertEqual((merged.hits, merged.fetches), (1, 1))
+
+    def test_isbn10_shares_entries(self):
+        isbn.get_isbn_data(ISBN)
+        isbn.get_isbn_data("8535914846")
+        self.assertEqual(len(self.calls), 3)
+
+    def test_not_found_is_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ISBNLibException):
+                isbn.get_isbn_data(OTHER_ISBN)
+        self.assertEqual(len(self.calls), 3)
+
+        ISBNMetadata.objects.update(
+            fetched=ISBNMetadata.objects.get(source=isbn.MERGED).fetched
+            - isbn.NOT_FOUND_CACHE_TTL
+        )
+        with self.assertRaises(ISBNLibException):
+            isbn.get_isbn_data(OTHER_ISBN)
+        self.assertEqual(len(self.calls), 6)
+
+    def test_expired_entries_are_refetched(self):
+        isbn.get_isbn_data(ISBN)
+        ISBNMetadata.objects.update(
+            fetched=ISBNMetadata.objects.get(source=isbn.MERGED).fetched
+            - isbn.CACHE_TTL
+            + timedelta(minutes=1)
+        )
+        isbn.get_isbn_data(ISBN)
+        self.assertEqual(len(self.calls), 3)
+
+        ISBNMetadata.objects.update(
+            fetched=ISBNMetadata.objects.get(source=isbn.MERGED).fetched
+            - timedelta(minutes=2)
+        )
+        isbn.get_isbn_data(ISBN)
+        self.assertEqual(len(self.calls), 6)
+
+    def test_unreachable_source_is_retried(self):
+        self.responses[ISBN] = {**responses, "goob": ServiceIsDownError()}
+        data = isbn.get_isbn_data(ISBN)
+        self.assertNotIn("Publisher", data)
+        self.assertFalse(
+            ISBNMetadata.objects.filter(
+                source__in=["goob", isbn.MERGED]
+            ).exists()
+        )
+
+        self.responses[ISBN] = responses
+        data = isbn.get_isbn_data(ISBN)
+        self.assertEqual(data["Publisher"], "Ática")
+        self.assertEqual(
+            self.calls[3:], [(ISBN, "goob")], "Only goob is queried again"
+        )
+
+    def test_sources_are_queried_concurrently(self):
+        self.delays = {source: 0.2 for source in isbn.SOURCES}
+        start = time.monotonic()
+        isbn.get_isbn_data(ISBN)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_slow_source_misses_deadline(self):
+        self.delays = {"goob": 2}
+        start = time.monotonic()
+        data = isbn.get_isbn_data(ISBN)
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.assertEqual(data["Title"], "O CORTIÇO")
+        self.assertNotIn("Publisher", data)
+        self.assertFalse(
+            ISBNMetadata.objects.filter(
+                source__in=["goob", isbn.MERGED]
+            ).exists()
+        )
+
+    def test_failing_source_cools_down(self):
+        self.responses[ISBN] = {**responses, "goob": ServiceIsDownError()}
+        for _ in range(2):
+            isbn.get_isbn_data(ISBN)
+        self.assertEqual(self.calls.count((ISBN, "goob")), 2)
+
+        isbn.get_isbn_data(ISBN)
+        self.assertEqual(self.calls.count((ISBN, "goob")), 2)
+
+        isbn.cooldown.skip_until.clear()
+        self.responses[ISBN] = responses
+        self.assertEqual(isbn.get_isbn_data(ISBN)["Publisher"], "Ática")
+        self.assertEqual(self.calls.count((ISBN, "goob")), 3)
+
+    def test_warm_and_stats(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(f"isbn,titulo\n{ISBN},O cortiço\n{OTHER_ISBN},\n")
+            f.write("123,invalid\n")
+            f.flush()
+
+            out = StringIO()
+            call_command("warm_isbn_cache", f.name, stdout=out)
+            self.assertIn("1 ISBNs encontrados, 1 não", out.getvalue())
+
+            out = StringIO()
+            call_command("warm_isbn_cache", f.name, stdout=out)
+            self.assertIn("2 já em cache", out.getvalue())
+
+        self.assertEqual(len(self.calls), 6)
+        isbn.search(ISBN)
+
+        out = StringIO()
+        call_command("isbn_cache_stats", stdout=out)
+        self.assertIn(
+            "merged: 2 entradas (1 não encontradas), 1 acertos, "
+            "2 consultas, 33.3% de acertos",
+            out.getvalue(),
+        )
@@ -0,0 +1,115 @@
+from django.test import TestCase
+
+from ..models import Book, Specimen
+
+
+class CutterCodeTestCase(TestCase):
+    def mk_book(self, title, last_name="Silva"):
+        return Book.objects.create(
+            title=title,
+            author_first_names="Maria",
+            author_last_name=last_name,
+        )
+
+    def test_codes_are_unique(self):
+        books = [self.mk_book("O livro") for _ in range(20)]
+        books += [self.mk_book("Livro azul") for _ in range(5)]
+        books += [self.mk_book("Livro", "Souza") for _ in range(5)]
+
+        codes = [b.code for b in books]
+        self.assertEqual(len(codes), len(set(codes)))
+        self.assertTrue(all(codes))
+
+    def test_calc_code_constant_queries(self):
+        for _ in range(15):
+            self.mk_book("Lendas do sul")
+
+        book = Book(
+            title="Lendas do sul",
+            author_first_names="Maria",
+            author_last_name="Silva",
+        )
+        with self.assertNumQueries(1):
+            code = book.calc_code()
+
+        self.assertFalse(Book.objects.filter(code=code).exists())
+
+    def test_calc_code_taken(self):
+        book = Book(title="Amor", author_last_name="Branco")
+        first = book.calc_code(taken=set())
+        self.assertNotEqual(book.calc_code(taken={first}), first)
+
+    def test_retry_on_conflict(self):
+        book = self.mk_book("Contos")
+        other = Book(title="Contos", author_last_name="Silva")
+
+        # Simulate a concurrent save taking the code first
+        calls = []
+
+        def calc_code(taken=None):
+            calls.append(taken)
+            if len(calls) == 1:
+                return book.code
+            return Book.calc_code(other)
+
+        other.calc_code = calc_code
+        other.save()
+
+        self.assertEqual(len(calls), 2)
+        self.assertNotEqual(other.code, book.code)
+
+
+class SpecimenNumberingTestCase(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(
+            title="Contos", author_last_name="Rosa"
+        )
+
+    def test_numbers_on_insert(self):
+        for _ in range(3):
+            self.book.specimens.create()
+
+        self.assertEqual(
+            list(self.book.specimens.values_list("number", flat=True)),
+            [1, 2, 3],
+        )
+
+    def test_update_keeps_number(self):
+        first = self.book.specimens.create()
+        self.book.specimens.create()
+
+        first.label_printed = True
+        with self.assertNumQueries(1):
+            first.save()
+
+        first.refresh_from_db()
+        self.assertEqual(first.number, 1)
+
+    def test_bulk_create_numbered(self):
+        self.book.specimens.create()
+        with self.assertNumQueries(4):
+            Specimen.objects.bulk_create_numbered(self.book, 5)
+
+        self.assertEqual(
+            list(self.book.specimens.values_list("number", flat=True)),
+            list(range(1, 7)),
+        )
+
+    def test_retry_on_conflict(self):
+        self.book.specimens.create()
+        last_number = Specimen.objects.last_number
+        calls = []
+
+        def stale_last_number(book):
+            calls.append(book)
+            # Simulate a concurrent insert not yet seen on the first try
+            return 0 if len(calls) == 1 else last_number(book)
+
+        Specimen.objects.last_number = stale_last_number
+        try:
+            specimen = self.book.specimens.create()
+        finally:
+            del Specimen.objects.last_number
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(specimen.number, 2)
@@ -1,18 +1,139 @@
 from django.contrib import admin, messages
-from django.core.exceptions import ValidationError
+from django.contrib.admin.utils import unquote
+from django.db import transaction
 from django.utils.html import format_html
+from django.utils.translation import gettext
 from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
+from django_object_actions import DjangoObjectActions, action
+from huey.contrib.djhuey import db_task
 
-from .io import csv_import
+from .io import csv_export, csv_import
 from .models import CSVExport, CSVImport
 from .registry import CSVIORegistry
 
 
+def run_in_background(obj, function):
+    try:
+        function(obj)
+    except Exception as e:
+        obj.finish(obj.Status.FAILED, str(e))
+        raise
+
+
+@db_task()
+def background_import(pk):
+    run_in_background(CSVImport.objects.get(pk=pk), csv_import)
+
+
+@db_task()
+def background_export(pk):
+    run_in_background(CSVExport.objects.get(pk=pk), csv_export)
+
+
+class ProgressAdminMixin(DjangoObjectActions):
+    progress_fields = ["status", "admin_progress", "message"]
+    # Fields that restart the processing, which can't change while it runs
+    restart_fields = ["key"]
+    change_actions = ["cancel_action"]
+    actions = ["cancel_selected"]
+
+    def get_readonly_fields(self, request, obj=None):
+        fields = super().get_readonly_fields(request, obj)
+        if obj is not None and obj.is_active():
+            return [*fields, *self.restart_fields]
+        return fields
+
+    def save_progress_model(self, request, obj, form, change, task):
+        """Save `obj`, queueing `task` once it's committed if the
+        processing restarts. Otherwise, only the fields changed in the
+        form are saved, so the progress written by the worker is kept
+        """
+        if change and (obj.is_active() or not self.restarts(form)):
+            if form.changed_data:
+                obj.save(update_fields=form.changed_data)
+            return
+
+        obj.reset_progress()
+        obj.save()
+        self.queued(request)
+        transaction.on_commit(lambda: task(obj.pk))
+
+    def restarts(self, form):
+        return bool(set(self.restart_fields) & set(form.changed_data))
+
+    @admin.display(description=_("Progresso"))
+    def admin_progress(self, obj):
+        percent = obj.percent_done()
+        if percent is None:
+            return "-"
+
+        rate = obj.rows_per_second()
+        return format_html(
+            "{}% ({}/{}){}",
+            percent,
+            obj.processed_rows,
+            obj.total_rows,
+            (
+                gettext(", %(rate)s linhas/s") % {"rate": rate}
+                if rate is not None
+                else ""
+            ),
+        )
+
+    def get_change_actions(self, request, object_id, form_url):
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None or not obj.is_active():
+            return []
+        return super().get_change_actions(request, object_id, form_url)
+
+    @action(label=_("Cancelar"), description=_("Cancelar o processamento"))
+    def cancel_action(self, request, obj):
+        if obj.cancel():
+            messages.success(request, gettext("Processamento cancelado"))
+
+    @admin.action(description=_("Cancelar processamentos selecionados"))
+    def cancel_selected(self, request, queryset):
+        count = sum(obj.cancel() for obj in queryset)
+        messages.success(
+            request,
+            ngettext(
+                "%(count)d processamento cancelado",
+                "%(count)d processamentos cancelados",
+                count,
+            )
+            % {"count": count},
+        )
+
+    def queued(self, request):
+        messages.info(
+            request,
+            gettext(
+                "Processamento agendado. Recarregue a página para "
+                "acompanhar o progresso."
+            ),
+        )
+
+
 @admin.register(CSVImport)
-class CSVImportAdmin(admin.ModelAdmin):
+class CSVImportAdmin(ProgressAdminMixin, admin.ModelAdmin):
     change_form_template = "csvio/change_form.html"
     add_form_template = "csvio/change_form.html"
-    readonly_fields = ["error_file"]
+    list_display = [
+        "name",
+        "created",
+        "status",
+        "admin_progress",
+        "imported_rows",
+        "failed_rows",
+    ]
+    progress_fields = ProgressAdminMixin.progress_fields + [
+        "imported_rows",
+        "failed_rows",
+        "error_file",
+    ]
+    readonly_fields = progress_fields
+    restart_fields = ["file", "key"]
 
     @property
     def model_fields_data(self):
@@ -20,6 +141,10 @@ class CSVImportAdmin(admin.ModelAdmin):
 
     def get_form(self, request, obj=None, change=False, **kwargs):
         form = super().get_form(request, obj=obj, change=change, **kwargs)
+        # Read only while the import runs
+        if "key" not in form.base_fields:
+            return form
+
         form.base_fields["key"].help_text = format_html(
             '{}: <span id="mandatory-fields"></span><br>'
             '{}: <span id="optional-fields"></span>',
@@ -29,24 +154,16 @@ class CSVImportAdmin(admin.ModelAdmin):
 
         return form
 
-    def save_model(self, request, obj, *args, **kwargs):
-        super().save_model(request, obj, *args, **kwargs)
-        try:
-            csv_import(request, obj)
-            model = obj.get_model()
-            messages.success(
-                request,
-                _("%(objects)s importados com sucesso")
-                % {"objects": model._meta.verbose_name_plural},
-            )
-        except ValidationError as e:
-            for msg in e:
-                messages.error(request, msg)
+    def save_model(self, request, obj, form, change):
+        # A new file or data type starts the import over
+        self.save_progress_model(
+            request, obj, form, change, background_import
+        )
 
     def get_fields(self, request, obj=None):
         fields = super().get_fields(request, obj)
         if obj is None:
-            return [f for f in fields if f != "error_file"]
+            return [f for f in fields if f not in self.progress_fields]
         return fields
 
     def change_view(
@@ -70,6 +187,20 @@ class CSVImportAdmin(admin.ModelAdmin):
 
 
 @admin.register(CSVExport)
-class CSVExportAdmin(admin.ModelAdmin):
-    fields = ["name", "key", "file"]
-    readonly_fields = ["file"]
+class CSVExportAdmin(ProgressAdminMixin, admin.ModelAdmin):
+    list_display = ["name", "created", "status", "admin_progress"]
+    readonly_fields = ["file", *ProgressAdminMixin.progress_fields]
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ["name", "key"]
+        return ["name", "key", "file", *self.progress_fields]
+
+    def restarts(self, form):
+        # Saving a finished export exports again, with the current data
+        return True
+
+    def save_model(self, request, obj, form, change):
+        self.save_progress_model(
+            request, obj, form, change, background_export
+        )
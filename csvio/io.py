@@ -1,118 +1,244 @@
 import csv
 from io import StringIO, TextIOWrapper
+from itertools import islice
 from pathlib import Path
 
-from django.core.exceptions import ValidationError
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from rest_framework_csv.parsers import CSVParser
 from rest_framework_csv.renderers import CSVRenderer
 
 from .registry import CSVIORegistry
 
 
-def csv_export(key):
-    reg = CSVIORegistry.get(key)
+def csv_export(obj):
+    """Write all objects of `obj.key` to `obj.file` in chunks of
+    CSVIO_CHUNK_SIZE, recording the progress on `obj`
+    """
+    if not obj.is_active():
+        return
 
-    serializer = reg.serializer(reg.model.objects.all(), many=True)
-    try:
-        context = {"header": serializer.data.keys()}
-    except AttributeError:
-        try:
-            context = {"header": serializer.data[0].keys()}
-        except AttributeError:
-            context = {}
+    reg = CSVIORegistry.get(obj.key)
+    chunk_size = getattr(settings, "CSVIO_CHUNK_SIZE", 500)
+    queryset = reg.model.objects.all()
+
+    obj.file.delete(save=False)
+    obj.file.save(
+        name=obj.get_file_name(), content=ContentFile(b""), save=False
+    )
+    obj.start(queryset.count())
+
+    renderer = CSVRenderer()
+    header = None
+    with open(obj.file.path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        rows = queryset.iterator(chunk_size=chunk_size)
+        while chunk := list(islice(rows, chunk_size)):
+            if obj.is_canceled():
+                break
+
+            data = reg.serializer(chunk, many=True).data
+            if header is None:
+                header = list(data[0].keys())
+                writer.writerow(header)
+            table = renderer.tablize(data, header=header)
+            next(table)  # The header row
+            writer.writerows(table)
+
+            obj.processed_rows += len(chunk)
+            obj.save(update_fields=["processed_rows"])
+
+    if obj.is_canceled():
+        obj.file.delete(save=False)
+        obj.save(update_fields=["file"])
+        return
 
-    return CSVRenderer().render(
-        serializer.data,
-        renderer_context=context,
+    obj.finish(
+        obj.Status.DONE,
+        _("%(count)d %(objects)s exportados")
+        % {
+            "count": obj.processed_rows,
+            "objects": reg.model._meta.verbose_name_plural,
+        },
     )
 
 
+class ImportClaimed(Exception):
+    """The import was resumed by another worker"""
+
+
 def unique(*args):
     seen = set()
     seen_add = seen.add
     return [x for x in args if not (x in seen or seen_add(x))]
 
 
-def get_errors(request, obj, errors):
+def format_errors(errors):
+    return {
+        f"{f}_error": " - ".join(str(e).title() for e in err)
+        for f, err in errors.items()
+    }
 
-    error_stream = StringIO()
-    errors = [
-        {
-            f"{f}_error": " - ".join(e.title() for e in err)
-            for f, err in error.items()
-        }
-        for error in errors
-    ]
 
-    obj.file.open("r")
-    encoding = request.encoding or "utf-8"
-    dialect = csv.Sniffer().sniff(
-        TextIOWrapper(obj.file, encoding=encoding).read(1024)
-    )
+def count_rows(file, encoding):
+    reader = csv.reader(TextIOWrapper(file, encoding=encoding, newline=""))
+    return max(sum(1 for _row in reader) - 1, 0)
 
-    obj.file.open("r")
-    reader = csv.DictReader(obj.file, dialect=dialect)
 
-    error_fieldnames = unique(
-        *reader.fieldnames,
-        *(f"{f}_error" for f in reader.fieldnames),
-        *{f for error in errors for f, _ in error.items()},
-    )
-    writer = csv.DictWriter(error_stream, fieldnames=error_fieldnames)
-    writer.writeheader()
+def read_rows(file, encoding):
+    """Stream the rows of a csv file as dicts, like CSVParser does"""
+    reader = csv.reader(TextIOWrapper(file, encoding=encoding, newline=""))
+    header = next(reader, [])
+    return header, (dict(zip(header, row)) for row in reader)
 
-    for line, errs in zip(reader, errors):
-        writer.writerow({**line, **errs})
-
-    return error_stream
 
+def open_error_file(obj, header, serializer):
+    """Open the error file for appending. A new one gets a header with
+    a column for each column's errors; an existing one is truncated to
+    the size recorded with the last committed chunk
+    """
+    if not obj.error_file.name:
+        fields = unique(*header, *serializer().fields, "non_field_errors")
+        stream = StringIO()
+        csv.writer(stream).writerow(
+            unique(*header, *(f"{f}_error" for f in fields))
+        )
+        obj.error_file.save(
+            name=_("erros_%(name)s") % {"name": Path(obj.file.name).name},
+            content=ContentFile(stream.getvalue().encode()),
+            save=False,
+        )
+        obj.error_file_size = obj.error_file.size
+        obj.save(update_fields=["error_file", "error_file_size"])
 
-def csv_import(request, obj):
-    if not obj.file:
-        return
+    # pylint: disable-next=consider-using-with
+    f = open(obj.error_file.path, "r+", newline="", encoding="utf-8")
+    fieldnames = next(csv.reader(f))
+    f.truncate(obj.error_file_size)
+    f.seek(obj.error_file_size)
 
-    stream = obj.file.open()
-    reg = CSVIORegistry.get(obj.key)
+    return f, csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
 
-    data = CSVParser().parse(stream)
-    serializer = reg.serializer(data=data, many=True)
 
-    if serializer.is_valid():
+def save_rows(serializers):
+    """Save the validated rows in one go, falling back to one at a time
+    if that fails. Returns the errors of the rows that failed
+    """
+    try:
+        with transaction.atomic():
+            for _row, serializer in serializers:
+                serializer.save()
+        return []
+    except Exception:  # pylint: disable=broad-exception-caught
+        pass
+
+    failed = []
+    for row, serializer in serializers:
+        # A fresh serializer, since the first may hold a rolled back
+        # instance
+        serializer = serializer.__class__(data=row)
         try:
             with transaction.atomic():
+                serializer.is_valid(raise_exception=True)
                 serializer.save()
-        except Exception as e:
-            raise ValidationError(
-                _(
-                    "Não foi possível realizar a importação dos "
-                    "%(objects)s : %(error)s"
-                )
-                % {
-                    "objects": reg.model._meta.verbose_name_plural,
-                    "error": str(e),
-                }
-            ) from e
-        obj.error_file.delete()
-    else:
-        error_file = get_errors(request, obj, serializer.errors)
-
-        if not obj.error_file.name:
-            obj.error_file.save(
-                name=_("erros_%(name)s") % {"name": Path(obj.file.name).name},
-                content=ContentFile(error_file.getvalue()),
-            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            failed.append((row, {"non_field_errors": [str(e)]}))
+
+    return failed
+
+
+def import_chunk(obj, reg, rows, error_writer, error_stream):
+    """Validate and save a chunk of rows, writing the failed ones to the
+    error file. The progress is committed along with the rows. Raises
+    ImportClaimed, committing nothing, if another worker took the import
+    over since this one's last chunk
+    """
+    valid = []
+    failed = []
+    for row in rows:
+        serializer = reg.serializer(data=row)
+        if serializer.is_valid():
+            valid.append((row, serializer))
         else:
-            obj.error_file.open("w")
-            obj.error_file.write(error_file.getvalue())
-            obj.error_file.flush()
-
-        raise ValidationError(
-            _(
-                "Não foi possível realizar a importação dos %(objects)s. "
-                "Confira o arquivo de erros para maiores detalhes."
-            )
-            % {"objects": reg.model._meta.verbose_name_plural}
+            failed.append((row, serializer.errors))
+
+    with transaction.atomic():
+        heartbeat = (
+            type(obj)
+            .objects.select_for_update()
+            .values_list("heartbeat", flat=True)
+            .get(pk=obj.pk)
         )
+        if heartbeat != obj.heartbeat:
+            raise ImportClaimed
+
+        save_failed = save_rows(valid)
+        for row, errors in failed + save_failed:
+            error_writer.writerow({**row, **format_errors(errors)})
+        error_stream.flush()
+
+        obj.processed_rows += len(rows)
+        obj.imported_rows += len(valid) - len(save_failed)
+        obj.failed_rows += len(failed) + len(save_failed)
+        obj.error_file_size = error_stream.tell()
+        obj.heartbeat = timezone.now()
+        obj.save(
+            update_fields=[
+                "processed_rows",
+                "imported_rows",
+                "failed_rows",
+                "error_file_size",
+                "heartbeat",
+            ]
+        )
+
+
+def csv_import(obj, encoding=None):
+    """Import the rows of `obj.file` in chunks of CSVIO_CHUNK_SIZE, each
+    committed with the progress on `obj`. An interrupted import, queued
+    again by the resume_csv_imports command, resumes after the last
+    committed chunk
+    """
+    if not obj.file or not obj.is_active():
+        return
+
+    reg = CSVIORegistry.get(obj.key)
+    chunk_size = getattr(settings, "CSVIO_CHUNK_SIZE", 500)
+    encoding = encoding or "utf-8"
+
+    if obj.status == obj.Status.PENDING:
+        obj.reset_progress()
+        obj.heartbeat = timezone.now()
+        obj.start(count_rows(obj.file.open("rb"), encoding))
+
+    header, rows = read_rows(obj.file.open("rb"), encoding)
+    error_stream, error_writer = open_error_file(obj, header, reg.serializer)
+    try:
+        rows = islice(rows, obj.processed_rows, None)
+        while chunk := list(islice(rows, chunk_size)):
+            if obj.is_canceled():
+                return
+            import_chunk(obj, reg, chunk, error_writer, error_stream)
+    except ImportClaimed:
+        # The worker resuming it goes on from the last committed chunk
+        return
+    finally:
+        error_stream.close()
+        obj.file.close()
+
+    if not obj.failed_rows:
+        obj.error_file.delete(save=False)
+        obj.error_file_size = 0
+
+    message = _("%(imported)d %(objects)s importados") % {
+        "imported": obj.imported_rows,
+        "objects": reg.model._meta.verbose_name_plural,
+    }
+    if obj.failed_rows:
+        message += _(
+            ", mas %(failed)d linhas não puderam ser importadas. Confira o "
+            "arquivo de erros para maiores detalhes."
+        ) % {"failed": obj.failed_rows}
+    obj.finish(obj.Status.DONE, message)
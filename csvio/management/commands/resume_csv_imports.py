@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ...admin import background_import
+from ...models import CSVImport
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue the csv imports interrupted by a crash or an error. Running "
+        "imports are only resumed once their worker hasn't committed for "
+        "CSVIO_STALE_AFTER seconds"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=getattr(settings, "CSVIO_STALE_AFTER", 15 * 60),
+            help="Seconds without progress before a running import is "
+            "taken for dead",
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        stale = now - timedelta(seconds=options["stale_after"])
+        with transaction.atomic():
+            # Claimed by moving the heartbeat forward, which stops the old
+            # worker, if alive, at its next chunk
+            claimed = list(
+                CSVImport.objects.select_for_update(skip_locked=True).filter(
+                    Q(status=CSVImport.Status.FAILED)
+                    | Q(status=CSVImport.Status.RUNNING, heartbeat=None)
+                    | Q(status=CSVImport.Status.RUNNING, heartbeat__lt=stale)
+                )
+            )
+            CSVImport.objects.filter(
+                pk__in=[obj.pk for obj in claimed]
+            ).update(status=CSVImport.Status.RUNNING, heartbeat=now)
+
+            for obj in claimed:
+                self.stdout.write(
+                    f"{obj}: resuming after {obj.processed_rows} rows"
+                )
+                # Resume instead of starting over
+                transaction.on_commit(lambda pk=obj.pk: background_import(pk))
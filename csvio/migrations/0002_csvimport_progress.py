@@ -0,0 +1,54 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("csvio", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="csvimport",
+            name="error_file_size",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="failed_rows",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Linhas com erros"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="imported_rows",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Linhas importadas"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="processed_rows",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Linhas processadas"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pendente"),
+                    ("running", "Em andamento"),
+                    ("done", "Concluída"),
+                ],
+                default="pending",
+                editable=False,
+                max_length=16,
+                verbose_name="Situação",
+            ),
+        ),
+    ]
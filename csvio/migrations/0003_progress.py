@@ -0,0 +1,110 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("csvio", "0002_csvimport_progress"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="csvexport",
+            name="finished",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Fim"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvexport",
+            name="message",
+            field=models.TextField(
+                blank=True, editable=False, verbose_name="Mensagem"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvexport",
+            name="processed_rows",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Linhas processadas"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvexport",
+            name="started",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Início"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvexport",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pendente"),
+                    ("running", "Em andamento"),
+                    ("done", "Concluída"),
+                    ("failed", "Falhou"),
+                    ("canceled", "Cancelada"),
+                ],
+                default="pending",
+                editable=False,
+                max_length=16,
+                verbose_name="Situação",
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvexport",
+            name="total_rows",
+            field=models.PositiveIntegerField(
+                editable=False, null=True, verbose_name="Total de linhas"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="finished",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Fim"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="message",
+            field=models.TextField(
+                blank=True, editable=False, verbose_name="Mensagem"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="started",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Início"
+            ),
+        ),
+        migrations.AddField(
+            model_name="csvimport",
+            name="total_rows",
+            field=models.PositiveIntegerField(
+                editable=False, null=True, verbose_name="Total de linhas"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="csvimport",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pendente"),
+                    ("running", "Em andamento"),
+                    ("done", "Concluída"),
+                    ("failed", "Falhou"),
+                    ("canceled", "Cancelada"),
+                ],
+                default="pending",
+                editable=False,
+                max_length=16,
+                verbose_name="Situação",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.4 on 2026-10-18 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("csvio", "0003_progress"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="csvimport",
+            name="heartbeat",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Último sinal"
+            ),
+        ),
+    ]
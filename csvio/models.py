@@ -1,9 +1,5 @@
-import re
-from pathlib import Path
-
 from django.apps import apps
 from django.conf import settings
-from django.core.files.base import ContentFile
 from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
@@ -12,7 +8,6 @@ from django.utils.translation import gettext
 from django.utils.translation import gettext_lazy as _
 from unidecode import unidecode
 
-from .io import csv_export
 from .registry import CSVIORegistry
 
 
@@ -27,7 +22,95 @@ def export_name():
         "date": timezone.now().strftime("%y.%m.%d")
     }
 
-class CSVImport(models.Model):
+
+class ProgressMixin(models.Model):
+    """Status and progress of an import or export run in the background"""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pendente")
+        RUNNING = "running", _("Em andamento")
+        DONE = "done", _("Concluída")
+        FAILED = "failed", _("Falhou")
+        CANCELED = "canceled", _("Cancelada")
+
+    status = models.CharField(
+        max_length=16,
+        verbose_name=_("Situação"),
+        choices=Status.choices,
+        default=Status.PENDING,
+        editable=False,
+    )
+    message = models.TextField(
+        verbose_name=_("Mensagem"), blank=True, editable=False
+    )
+    total_rows = models.PositiveIntegerField(
+        verbose_name=_("Total de linhas"), null=True, editable=False
+    )
+    processed_rows = models.PositiveIntegerField(
+        verbose_name=_("Linhas processadas"), default=0, editable=False
+    )
+    started = models.DateTimeField(
+        verbose_name=_("Início"), null=True, editable=False
+    )
+    finished = models.DateTimeField(
+        verbose_name=_("Fim"), null=True, editable=False
+    )
+
+    def reset_progress(self):
+        self.status = self.Status.PENDING
+        self.message = ""
+        self.total_rows = None
+        self.processed_rows = 0
+        self.started = None
+        self.finished = None
+
+    def start(self, total_rows):
+        self.status = self.Status.RUNNING
+        self.total_rows = total_rows
+        self.started = timezone.now()
+        self.save()
+
+    def finish(self, status, message=""):
+        self.status = status
+        self.message = message
+        self.finished = timezone.now()
+        self.save()
+
+    def is_active(self):
+        return self.status in (self.Status.PENDING, self.Status.RUNNING)
+
+    def is_canceled(self):
+        """Check the database, since it's canceled from another process"""
+        return self.__class__.objects.filter(
+            pk=self.pk, status=self.Status.CANCELED
+        ).exists()
+
+    def cancel(self):
+        return self.__class__.objects.filter(
+            pk=self.pk,
+            status__in=[self.Status.PENDING, self.Status.RUNNING],
+        ).update(status=self.Status.CANCELED, finished=timezone.now())
+
+    def percent_done(self):
+        if self.status == self.Status.DONE:
+            return 100
+        if not self.total_rows:
+            return None
+        return round(100 * self.processed_rows / self.total_rows, 1)
+
+    def rows_per_second(self):
+        if not self.started:
+            return None
+        elapsed = (self.finished or timezone.now()) - self.started
+        if not elapsed.total_seconds():
+            return None
+        return round(self.processed_rows / elapsed.total_seconds(), 1)
+
+    class Meta:
+        abstract = True
+
+
+class CSVImport(ProgressMixin, models.Model):
     name = models.CharField(
         max_length=127,
         verbose_name=_("Nome"),
@@ -52,10 +135,33 @@ class CSVImport(models.Model):
         choices=CSVIORegistry.get_model_import_choices,
         default=getattr(settings, "CSVIO_DEFAULT_MODEL", None),
     )
+    imported_rows = models.PositiveIntegerField(
+        verbose_name=_("Linhas importadas"), default=0, editable=False
+    )
+    failed_rows = models.PositiveIntegerField(
+        verbose_name=_("Linhas com erros"), default=0, editable=False
+    )
+    # Size of the error file when the progress was last committed, so a
+    # resumed import drops the errors of the chunk it redoes
+    error_file_size = models.PositiveIntegerField(default=0, editable=False)
+    # When the worker last committed a chunk. Stale, the worker is taken
+    # for dead and the import may be resumed, which moves it forward so
+    # the old worker stops if it wasn't
+    heartbeat = models.DateTimeField(
+        verbose_name=_("Último sinal"), null=True, editable=False
+    )
 
     def get_model(self):
         return apps.get_model(".".join(self.key.split(".")[:2]))
 
+    def reset_progress(self):
+        super().reset_progress()
+        self.imported_rows = 0
+        self.failed_rows = 0
+        self.error_file_size = 0
+        self.heartbeat = None
+        self.error_file.delete(save=False)
+
     def __str__(self):
         return self.name
 
@@ -64,7 +170,7 @@ class CSVImport(models.Model):
         verbose_name_plural = _("Importações CSV")
 
 
-class CSVExport(models.Model):
+class CSVExport(ProgressMixin, models.Model):
     name = models.CharField(
         max_length=127,
         verbose_name=_("Nome"),
@@ -86,33 +192,10 @@ class CSVExport(models.Model):
         default=getattr(settings, "CSVIO_DEFAULT_MODEL", None),
     )
 
-    def rename_file(self):
-        mo = re.search(r"_(\w+\.\w+.\w+).csv$", self.file.path)
-        model_part = mo.group(1)
-        if model_part != self.key:
-            path = Path(self.file.path)
-            path.rename(path.parent / path.name.replace(model_part, self.key))
-            self.file.name = self.file.name.replace(model_part, self.key)
-
-    def save(self, *args, **kwargs):
-        if self.key:
-            content = csv_export(self.key)
-            if self.file and self.file.path:
-                with open(self.file.path, "wb") as f:
-                    f.write(content)
-                self.rename_file()
-            else:
-                self.file.save(
-                    name=(
-                        unidecode(self.name.replace(" - ", "_"))
-                        or gettext("exportacao")
-                    )
-                    + f"_{self.key}.csv",
-                    content=ContentFile(content),
-                    save=False,
-                )
-
-        super().save(*args, **kwargs)
+    def get_file_name(self):
+        return (
+            unidecode(self.name.replace(" - ", "_")) or gettext("exportacao")
+        ) + f"_{self.key}.csv"
 
     def __str__(self):
         return self.name
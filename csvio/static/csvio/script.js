@@ -13,6 +13,9 @@ function populateFields() {
 
 document.addEventListener("DOMContentLoaded", () => {
   select = document.getElementById("id_key");
+  if (!select) {
+    return;
+  }
 
   populateFields()
   select.addEventListener("change", populateFields);
@@ -0,0 +1,229 @@
+import csv
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from books.models import Location
+
+from . import io
+from .admin import background_export, background_import
+from .io import csv_import
+from .models import CSVExport, CSVImport
+
+
+class Crash(Exception):
+    pass
+
+
+@override_settings(CSVIO_CHUNK_SIZE=3)
+class CSVImportTestCase(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def mk_import(self, names):
+        obj = CSVImport(key="books.location.default")
+        content = "name,color\n" + "".join(f"{n},\n" for n in names)
+        obj.file.save("locations.csv", ContentFile(content.encode()))
+        return obj
+
+    def error_rows(self, obj):
+        with open(obj.error_file.path, newline="", encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+    def test_import(self):
+        obj = self.mk_import([f"Sala {i}" for i in range(7)])
+        csv_import(obj)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVImport.Status.DONE)
+        self.assertEqual((obj.processed_rows, obj.imported_rows), (7, 7))
+        self.assertEqual((obj.total_rows, obj.percent_done()), (7, 100))
+        self.assertIsNotNone(obj.rows_per_second())
+        self.assertFalse(obj.error_file)
+        self.assertEqual(Location.objects.count(), 7)
+
+    def test_bad_rows_dont_abort_import(self):
+        names = ["Sala 1", "", "Sala 2", "x" * 30, "Sala 1", "Sala 3"]
+        obj = self.mk_import(names)
+        csv_import(obj)
+
+        obj.refresh_from_db()
+        self.assertEqual((obj.imported_rows, obj.failed_rows), (3, 3))
+        self.assertIn("3 linhas não puderam", obj.message)
+        self.assertEqual(
+            set(Location.objects.values_list("name", flat=True)),
+            {"Sala 1", "Sala 2", "Sala 3"},
+        )
+        errors = self.error_rows(obj)
+        self.assertEqual(
+            [row["name"] for row in errors], ["", "x" * 30, "Sala 1"]
+        )
+        self.assertTrue(all(row["name_error"] for row in errors))
+
+    def test_resume(self):
+        obj = self.mk_import(["", "Sala 1", "Sala 2", "Sala 3", "", "Sala 4"])
+        import_chunk = io.import_chunk
+        calls = []
+
+        def crashing_import_chunk(obj, reg, rows, writer, stream):
+            calls.append(rows)
+            if len(calls) == 2:
+                # Write the chunk's errors, but crash before committing
+                writer.writerow({"name": "", "name_error": "Error"})
+                raise Crash
+            import_chunk(obj, reg, rows, writer, stream)
+
+        with mock.patch.object(io, "import_chunk", crashing_import_chunk):
+            with self.assertRaises(Crash):
+                csv_import(obj)
+
+        obj = CSVImport.objects.get(pk=obj.pk)
+        self.assertEqual(obj.status, CSVImport.Status.RUNNING)
+        self.assertEqual((obj.processed_rows, obj.imported_rows), (3, 2))
+
+        csv_import(obj)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVImport.Status.DONE)
+        self.assertEqual((obj.imported_rows, obj.failed_rows), (4, 2))
+        self.assertEqual(Location.objects.count(), 4)
+        self.assertEqual(len(self.error_rows(obj)), 2)
+
+    def test_resume_command(self):
+        obj = self.mk_import([f"Sala {i}" for i in range(7)])
+        obj.status = CSVImport.Status.RUNNING
+        obj.heartbeat = timezone.now()
+        obj.save()
+        command = "csvio.management.commands.resume_csv_imports"
+
+        # Its worker is still alive
+        with mock.patch(f"{command}.background_import") as task:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("resume_csv_imports", stdout=StringIO())
+        task.assert_not_called()
+
+        with mock.patch(f"{command}.background_import") as task:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command(
+                    "resume_csv_imports", stale_after=0, stdout=StringIO()
+                )
+        task.assert_called_once_with(obj.pk)
+
+        # The old worker, if it wasn't dead, stops at its next chunk
+        csv_import(obj)
+        self.assertEqual(Location.objects.count(), 0)
+        csv_import(CSVImport.objects.get(pk=obj.pk))
+        self.assertEqual(Location.objects.count(), 7)
+
+    def test_cancel(self):
+        obj = self.mk_import([f"Sala {i}" for i in range(7)])
+        import_chunk = io.import_chunk
+
+        def canceling_import_chunk(obj, *args):
+            import_chunk(obj, *args)
+            obj.cancel()
+
+        with mock.patch.object(io, "import_chunk", canceling_import_chunk):
+            background_import.call_local(obj.pk)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVImport.Status.CANCELED)
+        self.assertEqual(obj.percent_done(), 42.9)
+        self.assertEqual(Location.objects.count(), 3)
+
+    def test_admin_save_running(self):
+        obj = self.mk_import(["Sala 1"])
+        obj.start(1)
+        self.client.force_login(
+            get_user_model().objects.create_superuser("csv", "", "csv")
+        )
+        url = reverse("admin:csvio_csvimport_change", args=[obj.pk])
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        with mock.patch("csvio.admin.background_import") as task:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, {"name": "Salas"})
+        task.assert_not_called()
+        obj.refresh_from_db()
+        self.assertEqual(obj.name, "Salas")
+        self.assertEqual(obj.status, CSVImport.Status.RUNNING)
+
+    def test_failure(self):
+        obj = self.mk_import(["Sala 1"])
+        with mock.patch.object(io, "import_chunk", side_effect=Crash("!")):
+            with self.assertRaises(Crash):
+                background_import.call_local(obj.pk)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVImport.Status.FAILED)
+        self.assertEqual(obj.message, "!")
+
+
+@override_settings(CSVIO_CHUNK_SIZE=3)
+class CSVExportTestCase(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        for i in range(7):
+            Location.objects.create(name=f"Sala {i}", color="#ff0000")
+
+    def test_export(self):
+        obj = CSVExport.objects.create(key="books.location.default")
+        background_export.call_local(obj.pk)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVExport.Status.DONE)
+        self.assertEqual((obj.total_rows, obj.processed_rows), (7, 7))
+        with open(obj.file.path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            rows,
+            [{"name": f"Sala {i}", "color": "#ff0000"} for i in range(7)],
+        )
+
+    def test_admin_save(self):
+        obj = CSVExport.objects.create(key="books.location.default")
+        obj.start(7)
+        CSVExport.objects.filter(pk=obj.pk).update(processed_rows=3)
+        self.client.force_login(
+            get_user_model().objects.create_superuser("csv", "", "csv")
+        )
+        url = reverse("admin:csvio_csvexport_change", args=[obj.pk])
+        data = {"name": "Locais", "key": "books.location.default"}
+
+        # Running, only the name is saved and nothing is queued
+        with mock.patch("csvio.admin.background_export") as task:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, data)
+        task.assert_not_called()
+        obj.refresh_from_db()
+        self.assertEqual(obj.name, "Locais")
+        self.assertEqual(obj.status, CSVExport.Status.RUNNING)
+        self.assertEqual(obj.processed_rows, 3)
+
+        # Finished, it's exported again once committed
+        obj.finish(CSVExport.Status.DONE)
+        with mock.patch("csvio.admin.background_export") as task:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.client.post(url, data)
+            task.assert_not_called()
+            for callback in callbacks:
+                callback()
+        task.assert_called_once_with(obj.pk)
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, CSVExport.Status.PENDING)
@@ -0,0 +1,45 @@
+# Run with: ./manage.py shell < dev/benchmarks/cutter_codes.py
+#
+# Saves 10k books sharing a few surnames and title words, then rolls
+# everything back.
+
+from time import perf_counter
+
+from django.db import connection, transaction
+
+from books.models import Book
+
+N = 10_000
+SURNAMES = ["Silva", "Santos", "Souza", "Oliveira", "Pereira"]
+TITLES = ["O livro", "Livro de contos", "Contos", "A casa", "Casa azul"]
+
+
+class Rollback(Exception):
+    pass
+
+
+queries = 0
+
+
+def count_queries(execute, *args):
+    global queries  # pylint: disable=global-statement
+    queries += 1
+    return execute(*args)
+
+
+try:
+    with transaction.atomic(), connection.execute_wrapper(count_queries):
+        start = perf_counter()
+        for i in range(N):
+            Book(
+                title=TITLES[i % len(TITLES)],
+                author_first_names="Maria",
+                author_last_name=SURNAMES[i % len(SURNAMES)],
+            ).save()
+        elapsed = perf_counter() - start
+
+        print(f"{N} books saved in {elapsed:.2f}s ({N / elapsed:.0f}/s)")
+        print(f"{queries / N:.2f} queries per save")
+        raise Rollback
+except Rollback:
+    pass
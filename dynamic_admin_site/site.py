@@ -21,7 +21,12 @@ class DynamicAdminMixin:
             ) from e
 
         try:
-            conf = cls.objects.get()
+            # Singletons may cache the instance
+            conf = (
+                cls.get_solo()
+                if hasattr(cls, "get_solo")
+                else cls.objects.get()
+            )
         except cls.DoesNotExist:
             return context
 
@@ -1,24 +1,38 @@
 import re
 
 from adminsortable2.admin import SortableAdminMixin, SortableStackedInline
+from django import forms
 from django.contrib import admin, messages
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import models
 from django.forms import CheckboxSelectMultiple
 from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
 from django.templatetags.static import static
 from django.urls import path, reverse
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.timezone import localtime
 from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
 
 from admin_buttons.admin import AdminButtonsMixin
 from barcodes.admin import BarcodeSearchBoxMixin
 from default_object.admin import DefaultObjectAdminMixin
-from notifications.mail import loan_receipt, renewal_receipt, return_receipt
+from notifications.mail import (
+    checkin_receipt,
+    checkout_receipt,
+    loan_receipt,
+    renewal_receipt,
+    return_receipt,
+)
 
-from .filters import LoanStatusFilter
-from .models import Loan, Period, Renewal
+from .filters import LoanStatusFilter, UserFilter
+from .models import Loan, LoanHistory, LoanRenewal, Period, Renewal
+
+User = get_user_model()
 
 
 class RenewalInline(SortableStackedInline):
@@ -26,6 +40,24 @@ class RenewalInline(SortableStackedInline):
     extra = 0
 
 
+class LoanRenewalInline(admin.TabularInline):
+    """Read only renewal history of a loan"""
+
+    model = LoanRenewal
+    extra = 0
+    fields = ["renewal", "days", "removed", "date"]
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Period)
 class PeriodAdmin(
     SortableAdminMixin, DefaultObjectAdminMixin, admin.ModelAdmin
@@ -70,16 +102,58 @@ class PeriodAdmin(
 
 @admin.action(description=_("Marcar devolução"))
 def make_returned(_modeladmin, _request, queryset):
-    queryset.filter(return_date__isnull=True).update(
-        return_date=timezone.now()
+    checkin_receipt(Loan.objects.checkin(queryset))
+
+
+class BulkLoanForm(forms.Form):
+    user = forms.ModelChoiceField(
+        User.objects.all(), required=False, label=_("Usuário")
+    )
+    specimens = forms.CharField(
+        widget=forms.Textarea(attrs={"autofocus": True}),
+        label=_("Exemplares"),
+        help_text=_("Códigos dos exemplares lidos, um por linha"),
     )
 
+    def clean_specimens(self):
+        try:
+            return [int(v) for v in self.cleaned_data["specimens"].split()]
+        except ValueError as e:
+            raise ValidationError(_("Códigos de exemplar inválidos")) from e
+
+
+class LoanOwnerMixin:
+    """Show the loans of everyone to those who manage them, and their own
+    to other users. Shared by the live and the archived loans
+    """
+
+    def get_owner(self, request):
+        """User whose loans are shown, or None for everyone's"""
+        if request.user.is_superuser or (
+            request.user.has_perm("loans.change_loan")
+            and request.user.has_perm("loans.add_loan")
+        ):
+            return None
+        return request.user
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        owner = self.get_owner(request)
+        if owner is None:
+            return qs
+        return qs.filter(user=owner)
+
 
 @admin.register(Loan)
-class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
+class LoanAdmin(
+    LoanOwnerMixin,
+    AdminButtonsMixin,
+    BarcodeSearchBoxMixin,
+    admin.ModelAdmin,
+):
     autocomplete_fields = ["specimen", "user"]
     ordering = ["-date"]
-    readonly_fields = ["renewals", "due", "period"]
+    readonly_fields = ["renewals_count", "full_due", "period"]
     list_display = [
         "user",
         "title",
@@ -91,11 +165,10 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
         "n_renovations",
         "late",
     ]
-    list_filter = [
-        LoanStatusFilter,
-        "date",
-        ("user", admin.RelatedOnlyFieldListFilter),
-    ]
+    list_filter = [LoanStatusFilter, "date", UserFilter]
+    list_select_related = ["specimen__book", "user"]
+    # Counting every loan on each load isn't worth it
+    show_full_result_count = False
     search_fields = [
         "user__username",
         "user__first_name",
@@ -110,9 +183,10 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
     }
 
     actions = [make_returned]
+    inlines = [LoanRenewalInline]
 
     @admin.display(description=_("Vencimento"))
-    def due(self, obj):
+    def full_due(self, obj):
         return localtime(obj.due).strftime("%d/%m/%Y, %H:%M")
 
     @admin.display(description=_("Título"), ordering="specimen__book__title")
@@ -144,10 +218,10 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
         return obj.return_date
 
     @admin.display(
-        description=_("Nº de renovações"), ordering="renewals__count"
+        description=_("Nº de renovações"), ordering="renewals_count"
     )
     def n_renovations(self, obj):
-        return obj.renewals__count
+        return obj.renewals_count
 
     @admin.display(description=_("atrasado"))
     def late(self, obj):
@@ -163,15 +237,6 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
             return [f for f in fields if f not in self.readonly_fields]
         return fields
 
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        if request.user.is_superuser or (
-            request.user.has_perm("loans.change_loan")
-            and request.user.has_perm("loans.add_loan")
-        ):
-            return qs
-        return qs.filter(user=request.user)
-
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
@@ -179,10 +244,83 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
                 "renew/<int:obj_or_id>",
                 self.admin_site.admin_view(self.renew_view),
                 name="loans_loan_renew",
-            )
+            ),
+            path(
+                "bulk/",
+                self.admin_site.admin_view(self.bulk_view),
+                name="loans_loan_bulk",
+            ),
         ]
         return my_urls + urls
 
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context["original_template"] = "loans/change_list.html"
+        return super().changelist_view(request, extra_context)
+
+    def bulk_view(self, request):
+        """Lend or return many scanned specimens at once"""
+        if not (
+            self.has_add_permission(request)
+            and self.has_change_permission(request)
+        ):
+            raise PermissionDenied
+
+        form = BulkLoanForm(request.POST or None)
+        field = form.fields["user"]
+        field.widget = AutocompleteSelect(
+            Loan._meta.get_field("user"), self.admin_site
+        )
+        field.widget.choices = field.choices
+
+        if request.method == "POST" and form.is_valid():
+            specimens = form.cleaned_data["specimens"]
+            user = form.cleaned_data["user"]
+            if "_checkin" in request.POST:
+                loans = Loan.objects.checkin(
+                    Loan.objects.filter(specimen__in=specimens)
+                )
+                checkin_receipt(loans)
+                messages.success(
+                    request,
+                    ngettext(
+                        "%(count)d devolução registrada",
+                        "%(count)d devoluções registradas",
+                        len(loans),
+                    )
+                    % {"count": len(loans)},
+                )
+                return redirect(request.path)
+
+            if user is None:
+                form.add_error("user", _("Escolha o usuário do empréstimo"))
+            else:
+                try:
+                    loans = Loan.objects.checkout(user, specimens)
+                except ValidationError as e:
+                    form.add_error("specimens", e)
+                else:
+                    checkout_receipt(loans)
+                    messages.success(
+                        request,
+                        ngettext(
+                            "%(count)d empréstimo registrado",
+                            "%(count)d empréstimos registrados",
+                            len(loans),
+                        )
+                        % {"count": len(loans)},
+                    )
+                    return redirect(request.path)
+
+        context = {
+            **self.admin_site.each_context(request),
+            "title": _("Empréstimos em lote"),
+            "form": form,
+            "opts": self.model._meta,
+            "media": self.media + form.media,
+        }
+        return TemplateResponse(request, "loans/bulk.html", context)
+
     def change_view(
         self, request, object_id, form_url="", extra_context=None
     ):
@@ -272,5 +410,63 @@ class LoanAdmin(AdminButtonsMixin, BarcodeSearchBoxMixin, admin.ModelAdmin):
         },
     ]
 
-    class Media:
-        js = ["loans/barcode_helper.js"]
+    @property
+    def media(self):
+        # The user filter's autocomplete
+        autocomplete = AutocompleteSelect(
+            Loan._meta.get_field("user"), self.admin_site
+        )
+        return (
+            super().media
+            + autocomplete.media
+            + forms.Media(
+                js=["loans/barcode_helper.js", "loans/user_filter.js"]
+            )
+        )
+
+
+@admin.register(LoanHistory)
+class LoanHistoryAdmin(LoanOwnerMixin, admin.ModelAdmin):
+    """Read only list of every loan, including the archived ones"""
+
+    ordering = ["-date"]
+    list_display = [
+        "user",
+        "title",
+        "short_date",
+        "short_return_date",
+        "renewals",
+        "archived",
+    ]
+    list_filter = ["archived", "date"]
+    search_fields = [
+        "user__username",
+        "user__first_name",
+        "user__last_name",
+        "specimen__book__title",
+        "specimen__book__isbn",
+    ]
+    show_full_result_count = False
+
+    @admin.display(description=_("Título"), ordering="specimen__book__title")
+    def title(self, obj):
+        return obj.specimen.book.title if obj.specimen else None
+
+    @admin.display(description=_("Empréstimo"), ordering="date")
+    def short_date(self, obj):
+        return localtime(obj.date).strftime("%d/%m/%y")
+
+    @admin.display(description=_("Devolução"), ordering="return_date")
+    def short_return_date(self, obj):
+        if obj.return_date:
+            return localtime(obj.return_date).strftime("%d/%m/%y")
+        return obj.return_date
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -1,14 +1,77 @@
-from datetime import datetime
-
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from site_configuration.cache import VersionedCache
+
+User = get_user_model()
+counts_cache = VersionedCache("loan-status-counts")
+
+
+def get_status_filters(now):
+    """Filter of each loan status. They're on the columns rather than on
+    the manager's annotations, so the index of open loans is used
+    """
+    return {
+        "not_returned": Q(return_date__isnull=True),
+        "late": Q(return_date__isnull=True, due__lt=now),
+        "running": Q(return_date__isnull=True, due__gte=now),
+        "all": Q(),
+        "returned": Q(return_date__isnull=False),
+    }
+
+
+def get_status_counts(user=None):
+    """Number of loans of `user`, or of everyone, of each status, counted
+    in a single query. Cached for LOAN_STATUS_COUNTS_TIMEOUT seconds or
+    until loans change
+    """
+    # Imported here, since models use this module
+    from .models import Loan  # pylint: disable=import-outside-toplevel
+
+    scope = user.pk if user is not None else "all"
+    key = f"loan-status-counts:{counts_cache.version()}:{scope}"
+    counts = cache.get(key)
+    if counts is None:
+        qs = Loan._base_manager.order_by()
+        if user is not None:
+            qs = qs.filter(user=user)
+        counts = qs.aggregate(
+            **{
+                status: Count("pk", filter=q or None)
+                for status, q in get_status_filters(timezone.now()).items()
+            }
+        )
+        # Counts of a transaction that changed loans aren't shared until
+        # it commits
+        if not counts_cache.pending():
+            cache.set(
+                key,
+                counts,
+                getattr(settings, "LOAN_STATUS_COUNTS_TIMEOUT", 60),
+            )
+    return counts
+
+
+def invalidate_status_counts():
+    counts_cache.invalidate()
+
 
 class LoanStatusFilter(admin.SimpleListFilter):
     title = _("status do empréstimo")
     parameter_name = "loan_status"
     default_lookup = "not_returned"
 
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.owner = model_admin.get_owner(request)
+
     def lookups(self, *args):
         return [
             ("not_returned", _("Não devolvidos")),
@@ -19,21 +82,12 @@ class LoanStatusFilter(admin.SimpleListFilter):
         ]
 
     def queryset(self, request, queryset):
-        match self.value():
-            case "returned":
-                return queryset.filter(returned=True)
-            case "late":
-                return queryset.filter(returned=False, due__lt=datetime.now())
-            case "running":
-                return queryset.filter(
-                    returned=False, due__gte=datetime.now()
-                )
-            case "all":
-                return queryset
-            case "not_returned" | _:
-                return queryset.filter(returned=False)
+        filters = get_status_filters(timezone.now())
+        value = self.value()
+        return queryset.filter(filters.get(value, filters["not_returned"]))
 
     def choices(self, changelist):
+        counts = get_status_counts(self.owner)
         for lookup, title in self.lookup_choices:
             yield {
                 "selected": (
@@ -46,5 +100,55 @@ class LoanStatusFilter(admin.SimpleListFilter):
                 "query_string": changelist.get_query_string(
                     {self.parameter_name: lookup}
                 ),
-                "display": title,
+                "display": f"{title} ({counts[lookup]})",
             }
+
+
+class UserFilter(admin.SimpleListFilter):
+    """Filter by a user chosen with an autocomplete, instead of listing
+    every user with loans
+    """
+
+    title = _("usuário")
+    parameter_name = "user"
+    template = "loans/user_filter.html"
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.field = forms.ModelChoiceField(
+            User.objects.all(),
+            required=False,
+            widget=AutocompleteSelect(
+                model._meta.get_field("user"), model_admin.admin_site
+            ),
+        )
+
+    def lookups(self, request, model_admin):
+        return []
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(user=self.value())
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.value() is None,
+            "query_string": changelist.get_query_string(
+                remove=[self.parameter_name]
+            ),
+            "display": _("Todos"),
+        }
+
+    def widget(self):
+        return self.field.widget.render(
+            self.parameter_name,
+            self.value(),
+            attrs={
+                "id": "user-filter",
+                "data-parameter": self.parameter_name,
+            },
+        )
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from ...models import Loan
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the loans returned more than LOAN_ARCHIVE_AFTER_DAYS ago to "
+        "the archive"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Archive loans returned more than this many days ago",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        before = None
+        if options["days"] is not None:
+            before = timezone.now() - timedelta(days=options["days"])
+        count = Loan.objects.archive(before, options["batch_size"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("%(count)d empréstimos arquivados") % {"count": count}
+            )
+        )
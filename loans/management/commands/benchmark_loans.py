@@ -0,0 +1,183 @@
+import random
+from datetime import timedelta
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from books.models import Book, Specimen
+from loans.models import Loan, Period
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the loan status queries, and show their plans, on synthetic "
+        "loans, with and without the loan indexes. Everything is rolled "
+        "back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loans", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=5000)
+        parser.add_argument("--specimens", type=int, default=50_000)
+        parser.add_argument("--years", type=int, default=10)
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument(
+            "--plans", action="store_true", help="Show the query plans"
+        )
+
+    def populate(self, options):
+        start = perf_counter()
+        users = User.objects.bulk_create(
+            User(username=f"benchmark-{i}") for i in range(options["users"])
+        )
+        books = Book.objects.bulk_create(
+            Book(
+                title=f"Livro {i}",
+                unaccent_title=f"Livro {i}",
+                author_last_name="Silva",
+                unaccent_author="Silva",
+                collection=None,
+            )
+            for i in range(max(options["specimens"] // 2, 1))
+        )
+        specimens = Specimen.objects.bulk_create(
+            Specimen(book=books[i % len(books)], number=i // len(books) + 1)
+            for i in range(options["specimens"])
+        )
+        period = Period.get_default()
+
+        now = timezone.now()
+        span = options["years"] * 365 * 24 * 60 * 60
+        batch = []
+        for i in range(options["loans"]):
+            date = now - timedelta(seconds=random.randrange(span))
+            due = date + timedelta(days=period.days)
+            # Nearly every old loan is returned, the recent ones aren't
+            returned = due < now - timedelta(days=60) or random.random() < 0.5
+            batch.append(
+                Loan(
+                    specimen=random.choice(specimens),
+                    user=random.choice(users),
+                    period=period,
+                    date=date,
+                    due=due,
+                    return_date=(
+                        date + timedelta(days=random.randrange(1, 30))
+                        if returned
+                        else None
+                    ),
+                )
+            )
+            if len(batch) == options["batch_size"]:
+                Loan.objects.bulk_create(batch)
+                batch = []
+        Loan.objects.bulk_create(batch)
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(
+            f"Created {options['loans']} loans in "
+            f"{perf_counter() - start:.1f}s"
+        )
+        return users, specimens
+
+    def get_queries(self, users, specimens):
+        """Name, queryset and how it's evaluated, of each query"""
+        now = timezone.now()
+        open_loans = Loan.objects.filter(return_date__isnull=True)
+        sample = [s.pk for s in random.sample(specimens, 1000)]
+        return [
+            (
+                "late loans",
+                open_loans.filter(due__lt=now).order_by("due"),
+                lambda qs: list(qs[:100]),
+            ),
+            (
+                "running loans count",
+                open_loans.filter(due__gte=now),
+                lambda qs: qs.count(),
+            ),
+            (
+                "not returned, latest first",
+                open_loans.order_by("-date"),
+                lambda qs: list(qs[:100]),
+            ),
+            (
+                "user's loans",
+                Loan.objects.filter(user=random.choice(users)).order_by(
+                    "-date"
+                ),
+                lambda qs: list(qs[:100]),
+            ),
+            (
+                "specimen's open loan",
+                open_loans.filter(specimen=random.choice(specimens)),
+                lambda qs: qs.exists(),
+            ),
+            (
+                "specimens' availability",
+                Specimen.objects.filter(pk__in=sample),
+                lambda qs: Specimen.objects.update_availability(sample),
+            ),
+        ]
+
+    def explain(self, queryset, label):
+        # The label keeps sqlite from reusing a cached statement, and so
+        # a plan from before dropping the indexes
+        sql, params = queryset.query.sql_with_params()
+        prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            cursor.execute(f"{prefix} /* {label} */ {sql}", params)
+            for row in cursor.fetchall():
+                self.stdout.write(" ".join(str(column) for column in row))
+
+    def run(self, users, specimens, options, label):
+        timings = {}
+        for name, queryset, evaluate in self.get_queries(users, specimens):
+            times = []
+            for _ in range(options["runs"]):
+                start = perf_counter()
+                evaluate(queryset)
+                times.append(perf_counter() - start)
+            timings[name] = median(times)
+
+            if options["plans"]:
+                self.stdout.write(self.style.MIGRATE_LABEL(name))
+                self.explain(queryset, label)
+        return timings
+
+    def drop_indexes(self):
+        with connection.cursor() as cursor:
+            for index in Loan._meta.indexes:
+                cursor.execute(
+                    f"DROP INDEX {connection.ops.quote_name(index.name)}"
+                )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Database: {connection.vendor}")
+        with transaction.atomic():
+            users, specimens = self.populate(options)
+
+            self.stdout.write("With indexes")
+            indexed = self.run(users, specimens, options, "indexed")
+            self.drop_indexes()
+            self.stdout.write("Without indexes")
+            plain = self.run(users, specimens, options, "plain")
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{'query':<30}{'indexed (ms)':>15}{'plain (ms)':>15}"
+        )
+        for name, seconds in indexed.items():
+            self.stdout.write(
+                f"{name:<30}{seconds * 1000:>15.1f}"
+                f"{plain[name] * 1000:>15.1f}"
+            )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...models import Loan
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored due date of every loan"
+
+    def handle(self, *args, **options):
+        count = Loan.objects.update_due()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Vencimento atualizado em %(count)d empréstimos")
+                % {"count": count}
+            )
+        )
@@ -0,0 +1,58 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:23
+
+from datetime import time, timedelta
+
+from django.db import migrations, models
+
+from loans.models import calc_due
+
+
+def compute_due(apps, schema_editor):
+    Loan = apps.get_model("loans", "Loan")
+    SiteConfiguration = apps.get_model(
+        "site_configuration", "SiteConfiguration"
+    )
+
+    working_days, ending_hour = [2, 3, 4, 5, 6], time(18, 0)
+    if conf := SiteConfiguration.objects.first():
+        working_days = conf.working_days
+        if isinstance(working_days, str):
+            working_days = working_days.split(",")
+        working_days = list(map(int, working_days))
+        ending_hour = conf.ending_hour
+
+    loans = Loan.objects.select_related("period").prefetch_related("renewals")
+    for loan in loans:
+        days = loan.period.days + sum(r.days for r in loan.renewals.all())
+        loan.due = calc_due(
+            loan.date + timedelta(days=days), working_days, ending_hour
+        )
+    Loan.objects.bulk_update(loans, ["due"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "site_configuration",
+            "0006_remove_backup_db_or_media_remove_backup_db_dump_and_more",
+        ),
+        (
+            "loans",
+            "0002_period_is_default_renewal_is_default_and_more_squashed_0007_remove_period_renewals_renewal_period_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="loan",
+            name="due",
+            field=models.DateTimeField(
+                db_index=True,
+                editable=False,
+                null=True,
+                verbose_name="Vencimento",
+            ),
+        ),
+        migrations.RunPython(compute_due, migrations.RunPython.noop),
+    ]
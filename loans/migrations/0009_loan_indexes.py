@@ -0,0 +1,40 @@
+# Generated by Django 5.0.4 on 2026-10-18 01:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0012_isbnmetadata"),
+        ("loans", "0008_loan_due"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="loan",
+            index=models.Index(
+                condition=models.Q(("return_date__isnull", True)),
+                fields=["due"],
+                name="loan_open_due_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="loan",
+            index=models.Index(
+                condition=models.Q(("return_date__isnull", True)),
+                fields=["specimen"],
+                name="loan_open_specimen_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="loan",
+            index=models.Index(fields=["user", "-date"], name="loan_user_date_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="loan",
+            index=models.Index(fields=["-date"], name="loan_date_idx"),
+        ),
+    ]
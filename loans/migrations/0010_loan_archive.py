@@ -0,0 +1,114 @@
+# Generated by Django 5.0.4 on 2026-10-18 02:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Every loan, live or archived. Live loans count their renewals
+LOAN_HISTORY_VIEW = """
+CREATE VIEW loans_loanhistory AS
+SELECT
+    l.id, l.specimen_id, l.period_id, l.user_id, l.date, l.due,
+    l.return_date,
+    (SELECT COUNT(*) FROM loans_loan_renewals r WHERE r.loan_id = l.id)
+        AS renewals,
+    FALSE AS archived
+FROM loans_loan l
+UNION ALL
+SELECT
+    a.id, a.specimen_id, a.period_id, a.user_id, a.date, a.due,
+    a.return_date, a.renewals, TRUE AS archived
+FROM loans_archivedloan a
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0012_isbnmetadata"),
+        ("loans", "0009_loan_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoanHistory",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("date", models.DateTimeField(verbose_name="Data do empréstimo")),
+                ("due", models.DateTimeField(null=True, verbose_name="Vencimento")),
+                (
+                    "return_date",
+                    models.DateTimeField(null=True, verbose_name="Data de devolução"),
+                ),
+                (
+                    "renewals",
+                    models.PositiveIntegerField(verbose_name="Nº de renovações"),
+                ),
+                ("archived", models.BooleanField(verbose_name="Arquivado")),
+            ],
+            options={
+                "verbose_name": "Histórico de empréstimos",
+                "verbose_name_plural": "Histórico de empréstimos",
+                "db_table": "loans_loanhistory",
+                "managed": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedLoan",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("date", models.DateTimeField(verbose_name="Data do empréstimo")),
+                ("due", models.DateTimeField(null=True, verbose_name="Vencimento")),
+                ("return_date", models.DateTimeField(verbose_name="Data de devolução")),
+                (
+                    "renewals",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Nº de renovações"
+                    ),
+                ),
+                (
+                    "period",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="archived_loans",
+                        to="loans.period",
+                        verbose_name="Duração",
+                    ),
+                ),
+                (
+                    "specimen",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="archived_loans",
+                        to="books.specimen",
+                        verbose_name="Exemplar",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archived_loans",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Usuário",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Empréstimo arquivado",
+                "verbose_name_plural": "Empréstimos arquivados",
+                "indexes": [
+                    models.Index(
+                        fields=["user", "-date"], name="archivedloan_user_date_idx"
+                    ),
+                    models.Index(fields=["-date"], name="archivedloan_date_idx"),
+                ],
+            },
+        ),
+        migrations.RunSQL(
+            LOAN_HISTORY_VIEW, "DROP VIEW loans_loanhistory"
+        ),
+    ]
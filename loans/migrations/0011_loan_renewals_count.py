@@ -0,0 +1,134 @@
+# Generated by Django 5.0.4 on 2026-10-18 02:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+# The loan history view, with the renewals counted from the loans'
+# renewals before, and read from the loans after
+LOAN_HISTORY_VIEW = """
+CREATE VIEW loans_loanhistory AS
+SELECT
+    l.id, l.specimen_id, l.period_id, l.user_id, l.date, l.due,
+    l.return_date, {renewals} AS renewals, FALSE AS archived
+FROM loans_loan l
+UNION ALL
+SELECT
+    a.id, a.specimen_id, a.period_id, a.user_id, a.date, a.due,
+    a.return_date, a.renewals, TRUE AS archived
+FROM loans_archivedloan a
+"""
+OLD_RENEWALS = (
+    "(SELECT COUNT(*) FROM loans_loan_renewals r WHERE r.loan_id = l.id)"
+)
+DROP_LOAN_HISTORY_VIEW = "DROP VIEW loans_loanhistory"
+
+
+def copy_renewals(apps, schema_editor):
+    Loan = apps.get_model("loans", "Loan")
+    LoanRenewal = apps.get_model("loans", "LoanRenewal")
+
+    loans = Loan.objects.filter(renewals__isnull=False).distinct()
+    loans = loans.prefetch_related("renewals")
+    history = []
+    for loan in loans:
+        renewals = sorted(loan.renewals.all(), key=lambda r: r.order)
+        loan.renewals_count = len(renewals)
+        loan.renewal_days = sum(r.days for r in renewals)
+        history += [
+            LoanRenewal(loan=loan, renewal=r, days=r.days, date=loan.date)
+            for r in renewals
+        ]
+    Loan.objects.bulk_update(
+        loans, ["renewals_count", "renewal_days"], batch_size=1000
+    )
+    LoanRenewal.objects.bulk_create(history, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0010_loan_archive"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            DROP_LOAN_HISTORY_VIEW,
+            LOAN_HISTORY_VIEW.format(renewals=OLD_RENEWALS),
+        ),
+        migrations.AddField(
+            model_name="loan",
+            name="renewal_days",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Dias de renovação"
+            ),
+        ),
+        migrations.AddField(
+            model_name="loan",
+            name="renewals_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Nº de renovações"
+            ),
+        ),
+        migrations.CreateModel(
+            name="LoanRenewal",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("days", models.IntegerField(verbose_name="Número de dias")),
+                (
+                    "removed",
+                    models.BooleanField(
+                        default=False, verbose_name="Removida"
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now,
+                        editable=False,
+                        verbose_name="Data",
+                    ),
+                ),
+                (
+                    "loan",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="renewal_history",
+                        to="loans.loan",
+                        verbose_name="Empréstimo",
+                    ),
+                ),
+                (
+                    "renewal",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="loans.renewal",
+                        verbose_name="Renovação",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Histórico de renovação",
+                "verbose_name_plural": "Histórico de renovações",
+                "ordering": ["date", "pk"],
+            },
+        ),
+        migrations.RunPython(copy_renewals, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="loan",
+            name="renewals",
+        ),
+        migrations.RunSQL(
+            LOAN_HISTORY_VIEW.format(renewals="l.renewals_count"),
+            DROP_LOAN_HISTORY_VIEW,
+        ),
+    ]
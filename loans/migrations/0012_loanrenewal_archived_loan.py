@@ -0,0 +1,37 @@
+# Generated by Django 5.0.4 on 2026-10-18 03:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0011_loan_renewals_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="loanrenewal",
+            name="archived_loan",
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="renewal_history",
+                to="loans.archivedloan",
+                verbose_name="Empréstimo arquivado",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="loanrenewal",
+            name="loan",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="renewal_history",
+                to="loans.loan",
+                verbose_name="Empréstimo",
+            ),
+        ),
+    ]
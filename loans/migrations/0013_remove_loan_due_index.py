@@ -0,0 +1,38 @@
+# Generated by Django 5.0.4 on 2026-10-18 03:49
+
+from django.db import migrations, models
+
+# SQLite rebuilds the loans table to alter the field, which the loan
+# history view can't outlive
+LOAN_HISTORY_VIEW = """
+CREATE VIEW loans_loanhistory AS
+SELECT
+    l.id, l.specimen_id, l.period_id, l.user_id, l.date, l.due,
+    l.return_date, l.renewals_count AS renewals, FALSE AS archived
+FROM loans_loan l
+UNION ALL
+SELECT
+    a.id, a.specimen_id, a.period_id, a.user_id, a.date, a.due,
+    a.return_date, a.renewals, TRUE AS archived
+FROM loans_archivedloan a
+"""
+DROP_LOAN_HISTORY_VIEW = "DROP VIEW loans_loanhistory"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0012_loanrenewal_archived_loan"),
+    ]
+
+    operations = [
+        migrations.RunSQL(DROP_LOAN_HISTORY_VIEW, LOAN_HISTORY_VIEW),
+        migrations.AlterField(
+            model_name="loan",
+            name="due",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="Vencimento"
+            ),
+        ),
+        migrations.RunSQL(LOAN_HISTORY_VIEW, DROP_LOAN_HISTORY_VIEW),
+    ]
@@ -1,21 +1,32 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
+from itertools import accumulate
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Case, Count, DurationField, F, Q, Sum, When
-from django.db.models.functions import Cast, ExtractWeekDay
-from django.db.models.lookups import In
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_save,
+)
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, db_task
 
 from books.models import Book, Classification, Collection, Location, Specimen
 from default_object.models import DefaultObjectMixin
 from site_configuration.models import SiteConfiguration
 
+from . import rules
+from .filters import invalidate_status_counts
+
 User = get_user_model()
 
 
@@ -130,14 +141,20 @@ class Period(DefaultObjectMixin, models.Model):
             for field, pks in compare
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_days = instance.__dict__.get("days")
+        return instance
+
     @classmethod
     def select_period(cls, specimen, user):
-        try:
-            return next(
-                p for p in cls.objects.all() if p.matches(specimen, user)
-            )
-        except StopIteration:
-            return cls.get_default()
+        return rules.select_periods([(specimen, user)])[0]
+
+    @classmethod
+    def select_periods(cls, pairs):
+        """Select the periods of many (specimen, user) pairs at once"""
+        return rules.select_periods(pairs)
 
     class Meta:
         verbose_name = _("Período")
@@ -172,6 +189,13 @@ class Renewal(models.Model):
         verbose_name=_("Ordem"),
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_days = instance.__dict__.get("days")
+        instance._loaded_order = instance.__dict__.get("order")
+        return instance
+
     class Meta:
         verbose_name = _("Renovação")
         verbose_name_plural = _("Renovações")
@@ -181,62 +205,208 @@ class Renewal(models.Model):
         return _("%s (%s dias)") % (self.description, self.days)
 
 
+def calc_due(exact_due, working_days, ending_hour):
+    """Move `exact_due` to the closing time of the first working day at
+    or after it
+    """
+    local = timezone.localtime(exact_due)
+    start = 0 if local.time() < ending_hour else 1
+    for i in range(start, start + 7):
+        day = local.date() + timedelta(days=i)
+        # Working days are numbered from sunday (1) to saturday (7)
+        if day.isoweekday() % 7 + 1 in working_days:
+            return timezone.make_aware(datetime.combine(day, ending_hour))
+
+    return exact_due
+
+
 class LoanManager(models.Manager):  # pylint: disable=too-few-public-methods
-    """Annotate due date (`due`), number of renovations
-    (`renewals__count`) and late bool (`late`) to resulting querysets
+    """Annotate returned bool (`returned`) and late bool (`late`) to
+    resulting querysets
     """
+
     def get_queryset(self, *args, **kwargs):
         qs = super().get_queryset(*args, **kwargs)
 
-        conf = SiteConfiguration.get_solo()
-        working_days = conf.get_working_days()
-
-        renewals = Sum("renewals__days", default=0)
-        duration = Cast(
-            timedelta(days=1) * (renewals + F("period__days")),
-            output_field=DurationField(),
-        )
-        qs = qs.annotate(exact_due=F("date") + duration)
-
-        diff = Cast(
-            (conf.ending_hour - F("exact_due__time")),
-            output_field=DurationField(),
+        qs = qs.annotate(returned=Q(return_date__isnull=False))
+        # In terms of the column, so filtering on it can use the index of
+        # open loans
+        qs = qs.annotate(
+            late=Q(return_date__isnull=True) & Q(due__lt=timezone.now())
         )
 
-        is_before = Q(exact_due__time__lt=conf.ending_hour)
-        is_after = Q(exact_due__time__gte=conf.ending_hour)
+        return qs
 
-        def is_in(i):
-            return In(
-                ExtractWeekDay(F("exact_due") + timedelta(days=i)),
-                working_days,
+    def update_due(self, queryset=None):
+        """Recompute the stored due date of the loans in `queryset`, or
+        of all of them. Returns how many changed
+        """
+        conf = SiteConfiguration.get_solo()
+        qs = self.all() if queryset is None else queryset
+        qs = qs.select_related("period")
+
+        changed = []
+        for loan in qs.iterator(chunk_size=1000):
+            due = loan.calc_due(conf)
+            if due != loan.due:
+                loan.due = due
+                changed.append(loan)
+
+        self.bulk_update(changed, ["due"], batch_size=1000)
+        if changed:
+            invalidate_status_counts()
+        return len(changed)
+
+    def update_renewal_days(self, period):
+        """Recompute the accumulated renewal days of the open, renewed
+        loans of `period`, from the days of its renewals in order, and
+        then the due dates of those whose days changed. Returned loans
+        keep the days they were renewed for
+        """
+        steps = list(
+            Renewal.objects.filter(period=period).values_list(
+                "days", flat=True
+            )
+        )
+        accumulated = list(accumulate(steps, initial=0))
+        base = self.model._base_manager.filter(
+            period=period, renewals_count__gt=0, return_date__isnull=True
+        )
+        counts = base.order_by().values_list("renewals_count", flat=True)
+        changed = []
+        for count in counts.distinct():
+            days = accumulated[min(count, len(steps))]
+            loans = base.filter(renewals_count=count).exclude(
+                renewal_days=days
             )
+            changed += loans.values_list("pk", flat=True)
+            loans.update(renewal_days=days)
+
+        if not changed:
+            return 0
+        return self.update_due(self.filter(pk__in=changed))
+
+    def checkout(self, user, specimens, date=None):
+        """Lend the `specimens` (pks) to `user` at once, checking their
+        availability with a single query and selecting their periods in
+        batch. Raises ValidationError listing the specimens that don't
+        exist or are already lent
+        """
+        pks = list(dict.fromkeys(specimens))
+        date = date or timezone.now()
+        conf = SiteConfiguration.get_solo()
 
-        due = Case(
-            *(
-                When(
-                    (is_before & is_in(i)),
-                    then=F("exact_due") + diff + timedelta(days=i),
+        with transaction.atomic():
+            available = dict(
+                Specimen.objects.select_for_update()
+                .filter(pk__in=pks)
+                .order_by()
+                .values_list("pk", "available")
+            )
+            errors = [
+                ValidationError(
+                    (
+                        _("Exemplar %(pk)s não existe")
+                        if pk not in available
+                        else _("Exemplar %(pk)s já está emprestado")
+                    ),
+                    params={"pk": pk},
                 )
-                for i in range(0, 7)
-            ),
-            *(
-                When(
-                    (is_after & is_in(i)),
-                    then=F("exact_due") + diff + timedelta(days=i),
+                for pk in pks
+                if not available.get(pk)
+            ]
+            if errors:
+                raise ValidationError(errors)
+
+            loans = [
+                self.model(
+                    user=user, specimen_id=pk, period=period, date=date
                 )
-                for i in range(1, 8)
-            ),
-            default="exact_due",
-            output_field=models.DateTimeField(),
+                for pk, period in zip(
+                    pks, Period.select_periods([(pk, user) for pk in pks])
+                )
+            ]
+            for loan in loans:
+                loan.due = loan.calc_due(conf)
+            self.bulk_create(loans)
+            Specimen.objects.update_availability(pks)
+            invalidate_status_counts()
+
+        return loans
+
+    def checkin(self, queryset, date=None):
+        """Return the loans of `queryset` not returned yet at once.
+        Returns them
+        """
+        date = date or timezone.now()
+        pks = list(
+            queryset.filter(return_date__isnull=True).values_list(
+                "pk", flat=True
+            )
         )
+        # The default manager's annotations can't be locked
+        base = self.model._base_manager.filter(
+            pk__in=pks, return_date__isnull=True
+        )
+        with transaction.atomic():
+            loans = list(base.select_for_update())
+            base.filter(pk__in=[loan.pk for loan in loans]).update(
+                return_date=date
+            )
+            Specimen.objects.update_availability(
+                [loan.specimen_id for loan in loans if loan.specimen_id]
+            )
+            invalidate_status_counts()
+
+        for loan in loans:
+            loan.return_date = date
+        return loans
+
+    def archive(self, before=None, batch_size=1000):
+        """Move the loans returned before `before`, by default
+        LOAN_ARCHIVE_AFTER_DAYS ago, and their renewal history, to
+        `ArchivedLoan`, `batch_size` at a time, each batch in its own
+        transaction. Returns how many. Setting LOAN_ARCHIVE_AFTER_DAYS to
+        None disables the default
+        """
+        if before is None:
+            days = getattr(settings, "LOAN_ARCHIVE_AFTER_DAYS", 730)
+            if days is None:
+                return 0
+            before = timezone.now() - timedelta(days=days)
+
+        count = 0
+        while True:
+            with transaction.atomic():
+                loans = list(
+                    self.filter(return_date__lt=before).order_by("pk")[
+                        :batch_size
+                    ]
+                )
+                if not loans:
+                    break
+
+                ArchivedLoan.objects.bulk_create(
+                    ArchivedLoan(
+                        id=loan.pk,
+                        specimen_id=loan.specimen_id,
+                        user_id=loan.user_id,
+                        period_id=loan.period_id,
+                        date=loan.date,
+                        due=loan.due,
+                        return_date=loan.return_date,
+                        renewals=loan.renewals_count,
+                    )
+                    for loan in loans
+                )
+                pks = [loan.pk for loan in loans]
+                LoanRenewal.objects.filter(loan__in=pks).update(
+                    archived_loan=F("loan"), loan=None
+                )
+                self.model._base_manager.filter(pk__in=pks).delete()
+            count += len(loans)
 
-        qs = qs.annotate(due=due)
-        qs = qs.annotate(Count("renewals"))
-        qs = qs.annotate(returned=Q(return_date__isnull=False))
-        qs = qs.annotate(late=Q(returned=False) & Q(due__lt=timezone.now()))
-
-        return qs
+        return count
 
 
 class Loan(models.Model):
@@ -254,11 +424,16 @@ class Loan(models.Model):
         verbose_name=_("Duração"),
         editable=False,
     )
-    renewals = models.ManyToManyField(
-        Renewal,
-        blank=True,
+    renewals_count = models.PositiveIntegerField(
+        verbose_name=_("Nº de renovações"),
+        default=0,
+        editable=False,
+    )
+    # Sum of the days of the period's first `renewals_count` renewals
+    renewal_days = models.PositiveIntegerField(
+        verbose_name=_("Dias de renovação"),
+        default=0,
         editable=False,
-        verbose_name=_("Renovações"),
     )
     date = models.DateTimeField(
         verbose_name=_("Data do empréstimo"),
@@ -275,6 +450,27 @@ class Loan(models.Model):
         null=True,
         blank=True,
     )
+    # Indexed for open loans only, in Meta.indexes
+    due = models.DateTimeField(
+        verbose_name=_("Vencimento"),
+        null=True,
+        editable=False,
+    )
+
+    @property
+    def exact_due(self):
+        """Due date before moving it to the closing time of a working
+        day
+        """
+        return self.date + timedelta(
+            days=self.period.days + self.renewal_days
+        )
+
+    def calc_due(self, conf=None):
+        conf = conf or SiteConfiguration.get_solo()
+        return calc_due(
+            self.exact_due, conf.get_working_days(), conf.ending_hour
+        )
 
     def clean(self):
         if (
@@ -284,42 +480,348 @@ class Loan(models.Model):
         ):
             raise ValidationError(_("Exemplar já está alugado"))
 
-    def renew(self):
-        renewals = list(self.renewals.all())
-        n = len(renewals)
+    def lock_renewals(self):
+        """Lock the loan's row and reload its renewals, so concurrent
+        renewals of the same loan apply one after the other. Must be
+        called inside a transaction
+        """
+        self.renewals_count, self.renewal_days = (
+            type(self)
+            ._base_manager.select_for_update()
+            .filter(pk=self.pk)
+            .values_list("renewals_count", "renewal_days")
+            .get()
+        )
 
-        # Disallow renewing if next renewal isn't due yet
-        if n > 0:
-            days = self.period.days + sum(r.days for r in renewals[:-1])
-            if timezone.now() < self.date + timedelta(days=days):
-                return _("última renovação ainda não começou")
+    def add_renewal(self, renewal, days, removed=False):
+        """Add, or remove, a renewal of `days` days, recording it in the
+        renewal history. A single row update of the loan, which must have
+        been locked with `lock_renewals` in the same transaction
+        """
+        self.renewals_count += -1 if removed else 1
+        self.renewal_days += -days if removed else days
+        self.due = self.calc_due()
+        with transaction.atomic():
+            type(self)._base_manager.filter(pk=self.pk).update(
+                renewals_count=self.renewals_count,
+                renewal_days=self.renewal_days,
+                due=self.due,
+            )
+            LoanRenewal.objects.create(
+                loan=self, renewal=renewal, days=days, removed=removed
+            )
+        invalidate_status_counts()
 
-        last_order = renewals[n - 1].order if n > 0 else -1
-        nxt = self.period.renewals.filter(order__gt=last_order).first()
+    def renew(self):
+        with transaction.atomic():
+            self.lock_renewals()
+            n = self.renewals_count
+            # The last renewal made and the next one, in a single query
+            steps = list(self.period.renewals.all()[max(n - 1, 0) : n + 1])
 
-        if not nxt:
-            return _("já fez todas as renovações possíveis")
+            # Disallow renewing if next renewal isn't due yet
+            if n > 0 and steps:
+                days = self.period.days + self.renewal_days - steps[0].days
+                if timezone.now() < self.date + timedelta(days=days):
+                    return _("última renovação ainda não começou")
 
-        self.renewals.add(nxt)
+            nxt = steps[-1] if steps and (n == 0 or len(steps) > 1) else None
+            if not nxt:
+                return _("já fez todas as renovações possíveis")
 
-        return None
+            self.add_renewal(nxt, nxt.days)
+            return None
 
     def unrenew(self):
-        renewal = self.renewals.all().last()
-        if not renewal:
-            return _("não há renovações para serem retiradas")
+        with transaction.atomic():
+            self.lock_renewals()
+            if self.renewals_count == 0:
+                return _("não há renovações para serem retiradas")
+
+            n = self.renewals_count
+            renewal = next(iter(self.period.renewals.all()[n - 1 : n]), None)
+            days = renewal.days if renewal else self.renewal_days
+            self.add_renewal(
+                renewal, min(days, self.renewal_days), removed=True
+            )
+            return None
 
-        self.renewals.remove(renewal)
-        return None
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_specimen_id = instance.__dict__.get("specimen_id")
+        return instance
 
     def save(self, *args, **kwargs):
         if self.period_id is None:
             self.period = Period.select_period(self.specimen, self.user)
+        self.due = self.calc_due()
         super().save(*args, **kwargs)
 
+        specimens = {
+            self.specimen_id,
+            getattr(self, "_loaded_specimen_id", None),
+        } - {None}
+        Specimen.objects.update_availability(specimens)
+        self._loaded_specimen_id = self.specimen_id
+
     class Meta:
         verbose_name = _("Empréstimo")
         verbose_name_plural = _("Empréstimos")
+        indexes = [
+            # Open loans by due date, for the status filter, the late
+            # and running notifications and specimens' availability
+            models.Index(
+                fields=["due"],
+                condition=Q(return_date__isnull=True),
+                name="loan_open_due_idx",
+            ),
+            models.Index(
+                fields=["specimen"],
+                condition=Q(return_date__isnull=True),
+                name="loan_open_specimen_idx",
+            ),
+            # A user's loans, most recent first
+            models.Index(fields=["user", "-date"], name="loan_user_date_idx"),
+            models.Index(fields=["-date"], name="loan_date_idx"),
+        ]
+
+    def __str__(self):
+        return _("Empréstimo de %s") % self.user
+
+
+class LoanRenewal(models.Model):
+    """Append-only history of the renewals added to and removed from a
+    loan
+    """
+
+    loan = models.ForeignKey(
+        Loan,
+        on_delete=models.CASCADE,
+        null=True,
+        verbose_name=_("Empréstimo"),
+        related_name="renewal_history",
+    )
+    # Set instead of `loan` when the loan is archived
+    archived_loan = models.ForeignKey(
+        "ArchivedLoan",
+        on_delete=models.CASCADE,
+        null=True,
+        editable=False,
+        verbose_name=_("Empréstimo arquivado"),
+        related_name="renewal_history",
+    )
+    renewal = models.ForeignKey(
+        Renewal,
+        on_delete=models.SET_NULL,
+        null=True,
+        verbose_name=_("Renovação"),
+    )
+    days = models.IntegerField(verbose_name=_("Número de dias"))
+    removed = models.BooleanField(verbose_name=_("Removida"), default=False)
+    date = models.DateTimeField(
+        verbose_name=_("Data"), default=timezone.now, editable=False
+    )
+
+    class Meta:
+        verbose_name = _("Histórico de renovação")
+        verbose_name_plural = _("Histórico de renovações")
+        ordering = ["date", "pk"]
+
+    def __str__(self):
+        return _("%s (%s dias)") % (self.renewal, self.days)
+
+
+class ArchivedLoan(models.Model):
+    """A returned loan moved out of `Loan` by `LoanManager.archive`, so
+    the loans table only holds the recent ones
+    """
+
+    # The loan's id, kept so the history doesn't repeat ids
+    id = models.BigIntegerField(primary_key=True)
+    specimen = models.ForeignKey(
+        Specimen,
+        on_delete=models.SET_NULL,
+        null=True,
+        verbose_name=_("Exemplar"),
+        related_name="archived_loans",
+    )
+    period = models.ForeignKey(
+        Period,
+        on_delete=models.SET_NULL,
+        null=True,
+        verbose_name=_("Duração"),
+        related_name="archived_loans",
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        verbose_name=_("Usuário"),
+        related_name="archived_loans",
+    )
+    date = models.DateTimeField(verbose_name=_("Data do empréstimo"))
+    due = models.DateTimeField(verbose_name=_("Vencimento"), null=True)
+    return_date = models.DateTimeField(verbose_name=_("Data de devolução"))
+    renewals = models.PositiveIntegerField(
+        verbose_name=_("Nº de renovações"), default=0
+    )
+
+    class Meta:
+        verbose_name = _("Empréstimo arquivado")
+        verbose_name_plural = _("Empréstimos arquivados")
+        indexes = [
+            models.Index(
+                fields=["user", "-date"], name="archivedloan_user_date_idx"
+            ),
+            models.Index(fields=["-date"], name="archivedloan_date_idx"),
+        ]
+
+    def __str__(self):
+        return _("Empréstimo de %s") % self.user
+
+
+class LoanHistoryManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().select_related("specimen__book", "user")
+
+
+class LoanHistory(models.Model):
+    """Every loan, live or archived, read from a database view joining
+    `Loan` and `ArchivedLoan`
+    """
+
+    objects = LoanHistoryManager()
+    id = models.BigIntegerField(primary_key=True)
+    specimen = models.ForeignKey(
+        Specimen,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        verbose_name=_("Exemplar"),
+        related_name="+",
+    )
+    period = models.ForeignKey(
+        Period,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        verbose_name=_("Duração"),
+        related_name="+",
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        verbose_name=_("Usuário"),
+        related_name="+",
+    )
+    date = models.DateTimeField(verbose_name=_("Data do empréstimo"))
+    due = models.DateTimeField(verbose_name=_("Vencimento"), null=True)
+    return_date = models.DateTimeField(
+        verbose_name=_("Data de devolução"), null=True
+    )
+    renewals = models.PositiveIntegerField(verbose_name=_("Nº de renovações"))
+    archived = models.BooleanField(verbose_name=_("Arquivado"))
+
+    class Meta:
+        managed = False
+        db_table = "loans_loanhistory"
+        verbose_name = _("Histórico de empréstimos")
+        verbose_name_plural = _("Histórico de empréstimos")
 
     def __str__(self):
         return _("Empréstimo de %s") % self.user
+
+
+@receiver(post_delete, sender=Loan)
+def update_availability_hook(sender, instance, *args, **kwargs):
+    # A returned loan, such as an archived one, doesn't hold its specimen
+    if instance.specimen_id and instance.return_date is None:
+        Specimen.objects.update_availability([instance.specimen_id])
+
+
+@receiver(post_save, sender=Loan)
+@receiver(post_delete, sender=Loan)
+def invalidate_status_counts_hook(sender, **kwargs):
+    invalidate_status_counts()
+
+
+@receiver(post_save, sender=Period)
+def update_period_due_hook(sender, instance, created, **kwargs):
+    changed = instance.days != getattr(instance, "_loaded_days", None)
+    if changed and not created:
+        pk = instance.pk
+        transaction.on_commit(lambda: update_due_task(pk))
+    instance._loaded_days = instance.days
+
+
+# Renewed loans count the days of their period's renewals by position,
+# which adding, removing, reordering or resizing a renewal may shift
+@receiver(post_save, sender=Renewal)
+def update_renewal_days_hook(sender, instance, created, **kwargs):
+    loaded = (
+        getattr(instance, "_loaded_days", None),
+        getattr(instance, "_loaded_order", None),
+    )
+    if created or loaded != (instance.days, instance.order):
+        Loan.objects.update_renewal_days(instance.period_id)
+    instance._loaded_days = instance.days
+    instance._loaded_order = instance.order
+
+
+@receiver(post_delete, sender=Renewal)
+def delete_renewal_days_hook(sender, instance, **kwargs):
+    Loan.objects.update_renewal_days(instance.period_id)
+
+
+@receiver(post_save, sender=Period)
+@receiver(post_delete, sender=Period)
+# Their primary keys are names, which may be reused
+@receiver(post_delete, sender=Location)
+@receiver(post_delete, sender=Classification)
+def invalidate_rules_hook(sender, **kwargs):
+    rules.invalidate()
+
+
+def invalidate_rules_m2m_hook(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        rules.invalidate()
+
+
+for field in rules.CONDITION_FIELDS:
+    m2m_changed.connect(
+        invalidate_rules_m2m_hook,
+        sender=getattr(Period, field).through,
+        dispatch_uid=f"invalidate_period_rules_{field}",
+    )
+
+
+@db_task()
+def update_due_task(period=None):
+    """Recompute the due dates of all loans or, given a period, of its
+    open loans
+    """
+    if period is None:
+        Loan.objects.update_due()
+    else:
+        Loan.objects.update_due(
+            Loan.objects.filter(period=period, return_date__isnull=True)
+        )
+
+
+@db_periodic_task(crontab(minute=0, hour=3))
+def archive_loans_task():
+    Loan.objects.archive()
+
+
+@receiver(pre_save, sender=SiteConfiguration)
+def check_working_hours_hook(sender, instance, **kwargs):
+    old = sender.objects.filter(pk=instance.pk).first()
+    instance._working_hours_changed = old is not None and (
+        set(old.get_working_days()) != set(instance.get_working_days())
+        or old.ending_hour != instance.ending_hour
+    )
+
+
+@receiver(post_save, sender=SiteConfiguration)
+def update_working_hours_due_hook(sender, instance, **kwargs):
+    # Queued once committed, so the worker reads the new working hours
+    if instance._working_hours_changed:
+        transaction.on_commit(update_due_task)
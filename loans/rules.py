@@ -0,0 +1,171 @@
+"""In-memory index of the periods' conditions.
+
+Selecting a loan's period used to test every period's conditions with
+queries. Here all periods and their conditions are loaded at once into a
+process-local cache, invalidated whenever a period or its conditions
+change, so periods are chosen without per-period queries.
+"""
+
+from copy import copy
+from dataclasses import dataclass
+
+from django.contrib.auth import get_user_model
+
+from books.models import Specimen
+from site_configuration.cache import VersionedCache
+
+User = get_user_model()
+
+CONDITION_FIELDS = [
+    "collections",
+    "locations",
+    "classifications",
+    "groups",
+    "users",
+    "books",
+    "specimens",
+]
+
+rules_cache = VersionedCache("period-rules")
+
+
+@dataclass
+class PeriodRule:
+    period: object
+    is_and: bool
+    # Primary keys of each condition field, only those with any
+    conditions: dict
+
+    def matches(self, keys):
+        """Whether the rule matches the objects of a loan, given as the
+        set of primary keys of each condition field
+        """
+        if self.is_and:
+            return bool(self.conditions) and all(
+                pks & keys[field] for field, pks in self.conditions.items()
+            )
+        return any(
+            pks & keys[field] for field, pks in self.conditions.items()
+        )
+
+
+class PeriodRules:
+    def __init__(self, rules, default):
+        self.rules = rules
+        self.default = default
+        self.fields = {f for rule in rules for f in rule.conditions}
+
+    @classmethod
+    def load(cls):
+        # Imported here, since models use this module
+        from .models import Period  # pylint: disable=import-outside-toplevel
+
+        periods = list(Period.objects.all())
+        conditions = {period.pk: {} for period in periods}
+        for field in CONDITION_FIELDS:
+            m2m = Period._meta.get_field(field)
+            pairs = m2m.remote_field.through.objects.values_list(
+                f"{m2m.m2m_field_name()}_id",
+                f"{m2m.m2m_reverse_field_name()}_id",
+            )
+            for period_id, pk in pairs:
+                conditions[period_id].setdefault(field, set()).add(pk)
+
+        rules = [
+            PeriodRule(
+                period,
+                period.logical_operator == Period.LogicalOperatorChoices.AND,
+                conditions[period.pk],
+            )
+            for period in periods
+        ]
+        default = next((p for p in periods if p.is_default), None)
+        return cls(rules, default or next(iter(periods), None))
+
+    def select(self, keys):
+        for rule in self.rules:
+            if rule.matches(keys):
+                return rule.period
+        return self.default
+
+
+def get_rules():
+    return rules_cache.get(PeriodRules.load)
+
+
+def invalidate():
+    rules_cache.invalidate()
+
+
+def get_keys(pairs, fields):
+    """Primary keys of each condition field for the (specimen, user)
+    `pairs`, with a query for specimens and one for groups. Only the
+    `fields` some period has conditions on are looked up
+    """
+    specimen_pks = {getattr(s, "pk", s) for s, _ in pairs} - {None}
+    user_pks = {getattr(u, "pk", u) for _, u in pairs} - {None}
+
+    specimens = {}
+    if fields & {"collections", "locations", "classifications", "books"}:
+        specimens = {
+            pk: rest
+            for pk, *rest in Specimen.objects.filter(pk__in=specimen_pks)
+            .order_by()
+            .values_list(
+                "pk",
+                "book__collection",
+                "book__classification__location",
+                "book__classification",
+                "book",
+            )
+        }
+
+    groups = {}
+    if "groups" in fields:
+        for user_id, group_id in User.groups.through.objects.filter(
+            user__in=user_pks
+        ).values_list("user", "group"):
+            groups.setdefault(user_id, set()).add(group_id)
+
+    keys = []
+    for specimen, user in pairs:
+        specimen_pk = getattr(specimen, "pk", specimen)
+        user_pk = getattr(user, "pk", user)
+        collection, location, classification, book = specimens.get(
+            specimen_pk, (None,) * 4
+        )
+        keys.append(
+            {
+                "collections": {collection},
+                "locations": {location},
+                "classifications": {classification},
+                "groups": groups.get(user_pk, set()),
+                "users": {user_pk},
+                "books": {book},
+                "specimens": {specimen_pk},
+            }
+        )
+
+    return keys
+
+
+def select_periods(pairs):
+    """Select the period of a loan of each (specimen, user) in `pairs`.
+    Specimens and users may be instances or primary keys
+    """
+    # Imported here, since models use this module
+    from .models import Period  # pylint: disable=import-outside-toplevel
+
+    pairs = list(pairs)
+    rules = get_rules()
+    if rules.fields:
+        periods = [rules.select(k) for k in get_keys(pairs, rules.fields)]
+    else:
+        periods = [rules.default] * len(pairs)
+
+    if None in periods:
+        default = Period.get_default()
+        periods = [p or default for p in periods]
+
+    # Copies, so changes to a loan's period don't leak to other loans
+    return [copy(period) for period in periods]
@@ -0,0 +1,58 @@
+from django.contrib.auth import get_user_model
+from rest_framework import serializers
+
+import csvio
+
+from .models import Loan, LoanHistory
+
+User = get_user_model()
+
+
+class LoanSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Loan
+        fields = [
+            "id",
+            "specimen",
+            "user",
+            "period",
+            "date",
+            "due",
+            "return_date",
+            "renewals_count",
+        ]
+
+
+class CheckinSerializer(serializers.Serializer):
+    specimens = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False
+    )
+
+
+class CheckoutSerializer(CheckinSerializer):
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+
+
+class LoanHistorySerializer(serializers.ModelSerializer):
+    title = serializers.CharField(
+        source="specimen.book.title", default=None, read_only=True
+    )
+    username = serializers.CharField(source="user.username", read_only=True)
+
+    class Meta:
+        model = LoanHistory
+        fields = [
+            "id",
+            "specimen",
+            "title",
+            "user",
+            "username",
+            "date",
+            "due",
+            "return_date",
+            "renewals",
+            "archived",
+        ]
+
+
+csvio.register(LoanHistory, LoanHistorySerializer, use_with="export")
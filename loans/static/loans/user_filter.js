@@ -0,0 +1,14 @@
+// Reload the changelist filtered by the user chosen in the user filter
+
+document.addEventListener("DOMContentLoaded", () => {
+  django.jQuery("#user-filter").on("change", function () {
+    const params = new URLSearchParams(window.location.search);
+    params.delete("p");
+    if (this.value) {
+      params.set(this.dataset.parameter, this.value);
+    } else {
+      params.delete(this.dataset.parameter);
+    }
+    window.location.search = params.toString();
+  });
+});
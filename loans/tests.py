@@ -1,9 +1,17 @@
 from datetime import datetime, time, timedelta
+from io import StringIO
 from random import choice
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from django.utils.timezone import localtime
 
@@ -12,10 +20,13 @@ from books.tests.test_catalog import create_test_catalog
 from profiles.tests import create_test_users
 from site_configuration.models import SiteConfiguration
 
-from .models import Loan, Period
+from .admin import make_returned
+from .filters import counts_cache, get_status_counts
+from .models import ArchivedLoan, Loan, LoanHistory, LoanRenewal, Period
 
 User = get_user_model()
 
+
 def create_test_period():
     default_period = Period.get_default()
     default_period.renewals.create(
@@ -33,6 +44,7 @@ def create_test_period():
 
     return default_period
 
+
 class EmptyDBTestCase(TestCase):
     def test_create_default_period(self):
         self.assertIsNotNone(Period.get_default())
@@ -145,6 +157,40 @@ class LoanAndPeriodTestCase(TestCase):
     def test_create_default(self):
         self.assertIsNotNone(Period.get_default())
 
+    def test_select_periods(self):
+        pairs = list(self.get_specimen_user())
+        for specimen, user in pairs[:5]:
+            period = Period.objects.create(description="Single")
+            period.specimens.add(specimen)
+            period.groups.add(*user.groups.all())
+            period.logical_operator = choice(
+                list(Period.LogicalOperatorChoices)
+            )
+            period.save()
+
+        expected = [
+            next(
+                (p for p in Period.objects.all() if p.matches(s, u)),
+                self.default_period,
+            )
+            for s, u in pairs
+        ]
+        self.assertEqual(Period.select_periods(pairs), expected)
+
+    def test_select_period_constant_queries(self):
+        specimen, user = next(self.get_specimen_user())
+        Period.objects.create(description="First").books.add(specimen.book)
+        with CaptureQueriesContext(connection) as few:
+            Period.select_period(specimen, user)
+
+        for _ in range(10):
+            period = Period.objects.create(description="More")
+            period.users.add(user)
+            period.books.add(specimen.book)
+
+        with self.assertNumQueries(len(few)):
+            Period.select_period(specimen, user)
+
     def test_loan(self):
         user = choice(User.objects.all())
         specimen = choice(Specimen.objects.all())
@@ -154,7 +200,8 @@ class LoanAndPeriodTestCase(TestCase):
         self.assertEqual(loan.period, self.default_period)
         self.assertIsNone(loan.renew())
         self.assertEqual(
-            loan.renewals.first(), self.default_period.renewals.first()
+            loan.renewal_history.get().renewal,
+            self.default_period.renewals.first(),
         )
         self.assertIsNotNone(loan.renew())
         loan.date -= timedelta(days=loan.period.days)
@@ -162,6 +209,13 @@ class LoanAndPeriodTestCase(TestCase):
         self.assertIsNone(loan.unrenew())
         self.assertIsNone(loan.unrenew())
         self.assertIsNotNone(loan.unrenew())
+        self.assertEqual(loan.renewal_history.count(), 4)
+        self.assertEqual(
+            Loan.objects.filter(
+                pk=loan.pk, renewals_count=0, renewal_days=0
+            ).count(),
+            1,
+        )
 
         loan.delete()
 
@@ -196,17 +250,11 @@ class LoanDueTestCase(TestCase):
             period=self.period,
             user=choice(self.users),
             date=date,
+            renewals_count=renewals,
+            renewal_days=15 * renewals,
         )
         loan.save()
 
-        for i in range(renewals):
-            loan.renewals.create(
-                description="ren.",
-                days=15,
-                period=self.period,
-                order=i + 1,
-            )
-
         loan = Loan.objects.get(pk=loan.pk)
         return loan
 
@@ -238,3 +286,436 @@ class LoanDueTestCase(TestCase):
             self.specimens = list(Specimen.objects.all())
             self.users = list(User.objects.all())
             Loan.objects.all().delete()
+
+    def assertDue(self, loan):
+        loan.refresh_from_db()
+        self.assertEqual(loan.due, loan.calc_due())
+        return loan.due
+
+    def test_stored_due(self):
+        loan = self.mk_loan()
+        due = self.assertDue(loan)
+
+        self.assertIsNone(loan.renew())
+        self.assertGreater(self.assertDue(loan), due)
+        self.assertIsNone(loan.unrenew())
+        self.assertEqual(self.assertDue(loan), due)
+
+        returned = self.mk_loan()
+        Loan.objects.checkin(Loan.objects.filter(pk=returned.pk))
+        returned.refresh_from_db()
+
+        self.period.days += 30
+        with self.captureOnCommitCallbacks(execute=True):
+            self.period.save()
+            # Recomputed by a task, once committed
+            self.assertEqual(Loan.objects.get(pk=loan.pk).due, due)
+        self.assertGreater(self.assertDue(loan), due)
+        # Returned loans keep their due date
+        self.assertEqual(Loan.objects.get(pk=returned.pk).due, returned.due)
+
+    def test_renewal_days_change(self):
+        loan = self.mk_loan()
+        self.assertIsNone(loan.renew())
+        due = self.assertDue(loan)
+
+        renewal = self.period.renewals.first()
+        renewal.days += 10
+        renewal.save()
+        self.assertGreater(self.assertDue(loan), due)
+        self.assertEqual(loan.renewal_days, renewal.days)
+
+        # The second renewal becomes the first
+        renewal.delete()
+        self.assertDue(loan)
+        self.assertEqual(loan.renewal_days, self.period.renewals.first().days)
+
+    def test_renew_stale_loan(self):
+        loan = self.mk_loan()
+        stale = Loan.objects.get(pk=loan.pk)
+        self.assertIsNone(loan.renew())
+
+        # Sees the renewal made through the other instance
+        self.assertIsNone(stale.unrenew())
+        loan.refresh_from_db()
+        self.assertEqual((loan.renewals_count, loan.renewal_days), (0, 0))
+        self.assertEqual(loan.renewal_history.count(), 2)
+        self.assertDue(loan)
+
+    def test_renewal_days_change_scope(self):
+        loan = self.mk_loan()
+        self.assertIsNone(loan.renew())
+        returned = self.mk_loan()
+        self.assertIsNone(returned.renew())
+        Loan.objects.checkin(Loan.objects.filter(pk=returned.pk))
+        days = returned.renewal_days
+
+        # Neither the days nor the order change
+        renewal = self.period.renewals.first()
+        renewal.description = "Outra descrição"
+        with self.assertNumQueries(1):
+            renewal.save()
+
+        renewal.days += 10
+        renewal.save()
+        loan.refresh_from_db()
+        returned.refresh_from_db()
+        self.assertEqual(loan.renewal_days, renewal.days)
+        self.assertEqual(returned.renewal_days, days)
+
+    def test_working_hours_change(self):
+        loan = self.mk_loan()
+        self.conf.ending_hour = time(12, 0)
+        self.conf.working_days = ["1", "7"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conf.save()
+            # Recomputed once the new working hours are committed
+            self.assertEqual(Loan.objects.get(pk=loan.pk).due, loan.due)
+
+        due = localtime(self.assertDue(loan))
+        self.assertEqual(due.time(), time(12, 0))
+        self.assertIn(due.isoweekday(), [6, 7])
+
+    def test_update_due_command(self):
+        loans = [self.mk_loan() for _ in range(3)]
+        Loan.objects.update(due=None)
+
+        out = StringIO()
+        call_command("update_due_dates", stdout=out)
+        self.assertIn("3", out.getvalue())
+        for loan in loans:
+            self.assertDue(loan)
+
+
+class SpecimenAvailabilityTestCase(TestCase):
+    def setUp(self):
+        create_test_catalog()
+        create_test_users()
+
+        self.user = User.objects.first()
+        self.specimen, self.other = Specimen.objects.all()[:2]
+
+    def assertAvailable(self, specimen, available=True):
+        specimen.refresh_from_db()
+        self.assertEqual(specimen.available, available)
+
+    def test_loan_lifecycle(self):
+        loan = Loan.objects.create(user=self.user, specimen=self.specimen)
+        self.assertAvailable(self.specimen, False)
+
+        with self.assertRaises(ValidationError):
+            Loan(user=self.user, specimen=self.specimen).clean()
+
+        loan.specimen = self.other
+        loan.save()
+        self.assertAvailable(self.specimen)
+        self.assertAvailable(self.other, False)
+
+        loan.return_date = timezone.now()
+        loan.save()
+        self.assertAvailable(self.other)
+
+        loan.return_date = None
+        loan.save()
+        self.assertAvailable(self.other, False)
+
+        Loan.objects.all().delete()
+        self.assertAvailable(self.other)
+
+    def test_make_returned(self):
+        Loan.objects.create(user=self.user, specimen=self.specimen)
+        Loan.objects.create(user=self.user, specimen=self.other)
+
+        make_returned(None, None, Loan.objects.all())
+
+        self.assertAvailable(self.specimen)
+        self.assertAvailable(self.other)
+
+    def test_update_availability_command(self):
+        Loan.objects.create(user=self.user, specimen=self.specimen)
+        Specimen.objects.update(available=True)
+        Loan.objects.filter(specimen=self.other).delete()
+        Specimen.objects.filter(pk=self.other.pk).update(available=False)
+
+        call_command("update_availability", stdout=StringIO())
+
+        self.assertAvailable(self.specimen, False)
+        self.assertAvailable(self.other)
+
+
+class BulkLoanTestCase(TestCase):
+    def setUp(self):
+        create_test_catalog()
+        create_test_users()
+
+        self.user = User.objects.first()
+        self.specimens = list(Specimen.objects.all())
+        self.admin = User.objects.create_superuser("bulk", "", "bulk")
+
+    def test_checkout(self):
+        pks = [s.pk for s in self.specimens[:5]]
+        loans = Loan.objects.checkout(self.user, pks)
+
+        self.assertEqual([loan.specimen_id for loan in loans], pks)
+        self.assertFalse(
+            Specimen.objects.filter(pk__in=pks, available=True).exists()
+        )
+        for loan in Loan.objects.filter(pk__in=[loan.pk for loan in loans]):
+            self.assertEqual(loan.due, loan.calc_due())
+
+        with self.assertRaises(ValidationError) as cm:
+            Loan.objects.checkout(self.user, [pks[0], self.specimens[5].pk])
+        self.assertEqual(len(cm.exception.messages), 1)
+        self.assertEqual(Loan.objects.count(), 5)
+
+    def test_checkout_constant_queries(self):
+        Loan.objects.checkout(self.user, [self.specimens[0].pk])
+        with CaptureQueriesContext(connection) as few:
+            Loan.objects.checkout(self.user, [self.specimens[1].pk])
+
+        with self.assertNumQueries(len(few)):
+            Loan.objects.checkout(
+                self.user, [s.pk for s in self.specimens[2:10]]
+            )
+
+    def test_checkin(self):
+        pks = [s.pk for s in self.specimens[:5]]
+        Loan.objects.checkout(self.user, pks)
+
+        loans = Loan.objects.checkin(Loan.objects.filter(specimen__in=pks))
+        self.assertEqual(len(loans), 5)
+        self.assertFalse(Loan.objects.filter(returned=False).exists())
+        self.assertEqual(
+            Specimen.objects.filter(pk__in=pks, available=True).count(), 5
+        )
+        self.assertEqual(Loan.objects.checkin(Loan.objects.all()), [])
+
+    def test_bulk_view(self):
+        self.client.force_login(self.admin)
+        url = reverse("admin:loans_loan_bulk")
+        pks = [str(s.pk) for s in self.specimens[:3]]
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.post(
+            url,
+            {
+                "user": self.user.pk,
+                "specimens": "\n".join(pks),
+                "_checkout": 1,
+            },
+        )
+        self.assertEqual(Loan.objects.filter(returned=False).count(), 3)
+
+        response = self.client.post(
+            url, {"user": self.user.pk, "specimens": pks[0], "_checkout": 1}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Loan.objects.count(), 3)
+
+        self.client.post(url, {"specimens": " ".join(pks), "_checkin": 1})
+        self.assertEqual(Loan.objects.filter(returned=False).count(), 0)
+
+    def test_api(self):
+        self.client.force_login(self.admin)
+        pks = [s.pk for s in self.specimens[:3]]
+
+        response = self.client.post(
+            reverse("checkout"),
+            {"user": self.user.pk, "specimens": pks},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()), 3)
+
+        response = self.client.post(
+            reverse("checkout"),
+            {"user": self.user.pk, "specimens": pks},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            reverse("checkin"),
+            {"specimens": pks},
+            content_type="application/json",
+        )
+        self.assertEqual(len(response.json()), 3)
+
+
+class LoanArchiveTestCase(TestCase):
+    def setUp(self):
+        # What's cached after the callbacks run is rolled back with the
+        # test
+        self.addCleanup(cache.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_test_catalog()
+            create_test_users()
+
+            self.user = User.objects.first()
+            self.specimens = list(Specimen.objects.all())
+            self.admin = User.objects.create_superuser(
+                "archive", "", "archive"
+            )
+            create_test_period()
+
+            now = timezone.now()
+            old = now - timedelta(days=1000)
+            self.old = Loan.objects.checkout(
+                self.user, [s.pk for s in self.specimens[:3]], date=old
+            )
+            self.old[0].renew()
+            Loan.objects.checkin(Loan.objects.all(), date=old + timedelta(5))
+            self.recent = Loan.objects.checkout(
+                self.user, [s.pk for s in self.specimens[:2]]
+            )
+
+    def test_archive(self):
+        self.assertEqual(LoanHistory.objects.count(), 5)
+        self.assertEqual(Loan.objects.archive(batch_size=2), 3)
+
+        self.assertEqual(
+            set(Loan.objects.values_list("pk", flat=True)),
+            {loan.pk for loan in self.recent},
+        )
+        archived = ArchivedLoan.objects.get(pk=self.old[0].pk)
+        self.assertEqual(archived.renewals, 1)
+        self.assertEqual(archived.specimen, self.specimens[0])
+
+        history = LoanHistory.objects.all()
+        self.assertEqual(history.count(), 5)
+        self.assertEqual(history.filter(archived=True).count(), 3)
+        self.assertEqual(history.get(pk=self.old[0].pk).renewals, 1)
+        self.assertEqual(archived.renewal_history.count(), 1)
+        self.assertFalse(
+            LoanRenewal.objects.filter(archived_loan=None, loan=None)
+        )
+        self.assertFalse(
+            Specimen.objects.get(pk=self.specimens[0].pk).available
+        )
+        self.assertTrue(
+            Specimen.objects.get(pk=self.specimens[2].pk).available
+        )
+        self.assertEqual(Loan.objects.archive(), 0)
+
+    def test_archive_queries(self):
+        with CaptureQueriesContext(connection) as few:
+            with self.captureOnCommitCallbacks(execute=True):
+                Loan.objects.archive()
+
+        Loan.objects.filter(pk__in=[loan.pk for loan in self.recent]).update(
+            return_date=timezone.now() - timedelta(days=1000)
+        )
+        with patch.object(counts_cache, "bump") as bump:
+            with self.assertNumQueries(len(few)):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(Loan.objects.archive(), 2)
+        # The status counts are invalidated once, not per loan
+        bump.assert_called_once()
+
+    def test_archive_command(self):
+        out = StringIO()
+        call_command("archive_loans", days=2000, stdout=out)
+        self.assertEqual(ArchivedLoan.objects.count(), 0)
+
+        call_command("archive_loans", stdout=out)
+        self.assertEqual(ArchivedLoan.objects.count(), 3)
+
+    def test_history_admin(self):
+        Loan.objects.archive()
+        self.client.force_login(self.admin)
+
+        response = self.client.get(
+            reverse("admin:loans_loanhistory_changelist")
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].result_count, 5)
+
+    def test_history_admin_owner(self):
+        Loan.objects.archive()
+        other = User.objects.exclude(pk=self.user.pk).first()
+        other.is_staff = True
+        other.save()
+        # Changing loans without lending them isn't managing them
+        other.user_permissions.set(
+            Permission.objects.filter(
+                codename__in=["change_loan", "view_loanhistory"]
+            )
+        )
+        Loan.objects.checkout(other, [self.specimens[3].pk])
+        self.client.force_login(other)
+
+        for name in ("loan", "loanhistory"):
+            response = self.client.get(
+                reverse(f"admin:loans_{name}_changelist"),
+                {"loan_status": "all"} if name == "loan" else {},
+            )
+            self.assertEqual(response.context["cl"].result_count, 1)
+
+
+class LoanStatusFilterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Committed, as far as the status counts are concerned
+        with self.captureOnCommitCallbacks(execute=True):
+            create_test_catalog()
+            create_test_users()
+
+            self.user = User.objects.first()
+            self.admin = User.objects.create_superuser("status", "", "status")
+            pks = list(Specimen.objects.values_list("pk", flat=True)[:4])
+            Loan.objects.checkout(self.user, pks)
+            # One late, one returned, two running
+            Loan.objects.filter(specimen=pks[0]).update(
+                due=timezone.now() - timedelta(hours=1)
+            )
+            Loan.objects.checkin(Loan.objects.filter(specimen=pks[1]))
+
+    def test_filter(self):
+        self.client.force_login(self.admin)
+        url = reverse("admin:loans_loan_changelist")
+        expected = {
+            "not_returned": 3,
+            "late": 1,
+            "running": 2,
+            "all": 4,
+            "returned": 1,
+        }
+        for status, count in expected.items():
+            response = self.client.get(url, {"loan_status": status})
+            self.assertEqual(response.context["cl"].result_count, count)
+            self.assertContains(response, f"({count})")
+
+    def test_counts_cached(self):
+        get_status_counts()
+        with self.assertNumQueries(0):
+            counts = get_status_counts()
+        self.assertEqual(counts["late"], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Loan.objects.checkin(Loan.objects.all())
+        self.assertEqual(get_status_counts()["returned"], 4)
+        self.assertEqual(get_status_counts(self.admin)["all"], 0)
+
+    def test_changelist_constant_queries(self):
+        self.client.force_login(self.admin)
+        url = reverse("admin:loans_loan_changelist")
+        params = {"loan_status": "all", "user": self.user.pk}
+        self.client.get(url, params)
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url, params)
+        self.assertEqual(response.context["cl"].result_count, 4)
+
+        Loan.objects.checkout(
+            self.user,
+            Specimen.objects.filter(available=True).values_list(
+                "pk", flat=True
+            )[:20],
+        )
+        with self.assertNumQueries(len(few)):
+            response = self.client.get(url, params)
+        self.assertEqual(
+            response.context["cl"].result_count, Loan.objects.count()
+        )
+        self.assertGreater(Loan.objects.count(), 10)
+        self.assertContains(response, 'id="user-filter"')
@@ -6,15 +6,20 @@ from .models import Notification, NotificationLog
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ["__str__", "trigger", "n_parameter"]
+    list_display = ["__str__", "trigger", "n_parameter", "digest"]
 
 
 @admin.register(NotificationLog)
 class NotificationLogAdmin(admin.ModelAdmin):
-    list_display = ["user", "book", "notification", "created"]
-    fields = ["user", "book", "notification", "loan", "created"]
+    list_display = ["profile", "book", "notification", "created"]
+    fields = ["profile", "book", "notification", "loan", "loans", "created"]
     readonly_fields = fields
     ordering = ["-created"]
+    list_select_related = [
+        "user__profile",
+        "loan__specimen__book",
+        "notification",
+    ]
 
     def has_change_permission(self, *args, **kwargs):
         return False
@@ -22,10 +27,12 @@ class NotificationLogAdmin(admin.ModelAdmin):
     def has_add_permission(self, *args, **kwargs):
         return False
 
-    @admin.display(description=_("Usuário"), ordering="loan__user")
-    def user(self, obj):
-        return obj.loan.user.profile
+    @admin.display(description=_("Usuário"), ordering="user")
+    def profile(self, obj):
+        return obj.user.profile
 
     @admin.display(description=_("Livro"), ordering="loan__specimen__book")
     def book(self, obj):
-        return obj.loan.specimen.book
+        if obj.loan and obj.loan.specimen:
+            return obj.loan.specimen.book
+        return None
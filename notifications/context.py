@@ -6,10 +6,15 @@ from django.utils.timezone import localtime
 from site_configuration.models import SiteConfiguration
 
 
-def get_context(loan=None, mailconf=None):
+def get_context(loan=None, mailconf=None, conf=None):
+    """Template context of a notification about `loan`. Pass the site
+    configuration as `conf` when building many of them
+    """
     fmt = "%d/%m/%y"
+    if loan and conf is None:
+        conf = SiteConfiguration.get_solo()
     values = {
-        "site_title": loan and SiteConfiguration.get_solo().site_title,
+        "site_title": loan and conf.site_title,
         "book": loan and loan.specimen.book,
         "author": loan and loan.specimen.book.author,
         "name": loan and f"{loan.user.first_name} {loan.user.last_name}",
@@ -23,3 +28,15 @@ def get_context(loan=None, mailconf=None):
     }
 
     return Context({k: mark_safe(v) for k, v in values.items()})
+
+
+def get_digest_context(loans, mailconf=None, conf=None):
+    """Template context of a notification about many `loans` of the same
+    user, those of the first loan and `loans`, the context of each loan
+    """
+    if conf is None:
+        conf = SiteConfiguration.get_solo()
+    contexts = [get_context(loan, mailconf, conf) for loan in loans]
+    context = contexts[0]
+    context["loans"] = [c.flatten() for c in contexts]
+    return context
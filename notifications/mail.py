@@ -1,20 +1,35 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from smtplib import SMTPException
 
-from bs4 import BeautifulSoup
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.mail.backends.smtp import EmailBackend
-from django.template import Template
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from huey import crontab
-from huey.contrib.djhuey import periodic_task, task
+from huey.contrib.djhuey import db_periodic_task, db_task, periodic_task
 
 from loans.models import Loan
-from site_configuration.models import EmailConfiguration
+from profiles.models import Email
+from site_configuration.models import EmailConfiguration, SiteConfiguration
 
-from .context import get_context
+from .context import get_context, get_digest_context
 from .models import Notification, NotificationLog
+from .rendering import html2text
 
 TriggerChoices = Notification.TriggerChoices
+RECEIPT_DEDUPLICATION_TIMEOUT = getattr(
+    settings, "RECEIPT_DEDUPLICATION_TIMEOUT", 24 * 60 * 60
+)
+NOTIFICATION_CONNECTIONS = getattr(settings, "NOTIFICATION_CONNECTIONS", 4)
+NOTIFICATION_RETRIES = getattr(settings, "NOTIFICATION_RETRIES", 2)
+
+logger = logging.getLogger(__name__)
 
 
 class DynamicSMPTEmailBackend(EmailBackend):
@@ -50,66 +65,184 @@ class DynamicSMPTEmailBackend(EmailBackend):
         )
 
 
-def html2text(html):
-    return BeautifulSoup(html, "lxml").get_text()
+def with_recipients(loans):
+    """`loans` with what their notifications read: their book, user and
+    the user's additional emails
+    """
+    return loans.select_related("specimen__book", "user").prefetch_related(
+        Prefetch(
+            "user__additional_emails",
+            queryset=Email.objects.filter(receive_notifications=True),
+            to_attr="notification_emails",
+        )
+    )
 
 
 def get_recipient_list(user):
-    return [
-        user.email,
-        *user.additional_emails.filter(
-            receive_notifications=True
-        ).values_list("email", flat=True),
-    ]
-
-
-@task()
-def send_notification(loan, notification):
-    mailconf = EmailConfiguration.get_solo()
-    context = get_context(loan, mailconf)
-    message = Template(notification.message).render(context)
-    subject = Template(notification.subject).render(context)
+    emails = getattr(user, "notification_emails", None)
+    if emails is None:
+        emails = user.additional_emails.filter(receive_notifications=True)
+    return [user.email, *(e.email for e in emails)]
 
-    # docs.djangoproject.com/en/5.0/topics/email/#preventing-header-injection
-    subject = subject.replace("\n", " ")
 
+def get_from_email(mailconf):
     if mailconf.from_name:
-        from_email = f"{mailconf.from_name} <{mailconf.from_email}>"
-    else:
-        from_email = mailconf.from_email
+        return f"{mailconf.from_name} <{mailconf.from_email}>"
+    return mailconf.from_email
 
-    recipient_list = get_recipient_list(loan.user)
 
-    send_mail(
-        subject,
+def make_email(subject, message, user, mailconf):
+    """The email with the html `message`, and its text version, to
+    `user`
+    """
+    email = EmailMultiAlternatives(
+        # docs.djangoproject.com/en/5.0/topics/email/#preventing-header-injection
+        subject.replace("\n", " "),
         html2text(message),
-        # recipient_list=recipient_list,
-        recipient_list=["joaoseckler@gmail.com"],
-        html_message=message,
-        fail_silently=False,
-        auth_user=mailconf.username,
-        auth_password=mailconf.password,
-        from_email=from_email,
+        get_from_email(mailconf),
+        get_recipient_list(user),
+    )
+    email.attach_alternative(message, "text/html")
+    return email
+
+
+def build_email(loan, notification, mailconf, conf=None):
+    context = get_context(loan, mailconf, conf)
+    return make_email(
+        notification.get_template("subject").render(context),
+        notification.get_template("message").render(context),
+        loan.user,
+        mailconf,
     )
-    NotificationLog.objects.create(loan=loan, notification=notification)
 
 
-def notify(querysets, notification, trigger):
+def build_digest_email(loans, notification, mailconf, conf=None):
+    context = get_digest_context(loans, mailconf, conf)
+    return make_email(
+        notification.get_template("subject").render(context),
+        notification.get_template("message").render(context),
+        loans[0].user,
+        mailconf,
+    )
+
+
+def send_email(connection, email):
+    """Send `email` through the open `connection`, trying again up to
+    NOTIFICATION_RETRIES times, after reconnecting. Returns the last
+    error, or None if sent
+    """
+    error = None
+    for _attempt in range(NOTIFICATION_RETRIES + 1):
+        try:
+            connection.send_messages([email])
+            return None
+        except (SMTPException, OSError) as e:
+            error = e
+            connection.close()
+            try:
+                connection.open()
+            except (SMTPException, OSError):
+                pass
+    return error
+
+
+def send_emails(emails):
+    """Send `emails` through at most NOTIFICATION_CONNECTIONS connections
+    at once, each kept open for its share of the emails. Returns the
+    error of each email, None for those sent. Never raises, so the sent
+    emails can always be logged
+    """
+    if not emails:
+        return []
+
+    n = min(NOTIFICATION_CONNECTIONS, len(emails))
+    # Created here, since the backend reads its configuration from the
+    # database
+    connections = [get_connection(fail_silently=False) for _ in range(n)]
+    errors = [None] * len(emails)
+
+    def send_share(i):
+        try:
+            connections[i].open()
+        except (SMTPException, OSError):
+            # Connecting is tried again for each email
+            pass
+        try:
+            for j in range(i, len(emails), n):
+                try:
+                    errors[j] = send_email(connections[i], emails[j])
+                except (
+                    Exception
+                ) as e:  # pylint: disable=broad-exception-caught
+                    # Such as a bad header, which retrying won't fix. The
+                    # other emails are still sent, and logged
+                    errors[j] = e
+        finally:
+            connections[i].close()
+
+    with ThreadPoolExecutor(n) as executor:
+        list(executor.map(send_share, range(n)))
+
+    return errors
+
+
+def notify(querysets, notification, trigger, mailconf=None):
+    """Send `notification` to the loans its `trigger` selects, in a batch:
+    an email per loan or, for digests, per user. Returns how many emails
+    were sent. Raises SMTPException if any email fails, after logging the
+    sent ones
+    """
+    mailconf = mailconf or EmailConfiguration.get_solo()
+    conf = SiteConfiguration.get_solo()
     n = notification.n_parameter
     log = NotificationLog.objects.filter(notification=notification)
 
-    count = 0
-    for loan in trigger.get_queryset(querysets, n, log):
-        try:
-            send_notification(loan, notification)
-        except SMTPException as e:
-            raise SMTPException(
-                _("Não consegui enviar email para %(user)s")
-                % {"user": loan.user.profile}
-            ) from e
-        count += 1
+    loans = with_recipients(trigger.get_queryset(querysets, n, log))
+    if notification.digest:
+        by_user = {}
+        for loan in loans.order_by("due", "pk"):
+            by_user.setdefault(loan.user_id, []).append(loan)
+        groups = list(by_user.values())
+        emails = [
+            build_digest_email(group, notification, mailconf, conf)
+            for group in groups
+        ]
+    else:
+        groups = [[loan] for loan in loans]
+        emails = [
+            build_email(group[0], notification, mailconf, conf)
+            for group in groups
+        ]
+
+    errors = send_emails(emails)
+    sent = [group for group, error in zip(groups, errors) if error is None]
+    logs = NotificationLog.objects.bulk_create(
+        NotificationLog(
+            loan=group[0], user_id=group[0].user_id, notification=notification
+        )
+        for group in sent
+    )
+    if notification.digest:
+        NotificationLog.loans.through.objects.bulk_create(
+            NotificationLog.loans.through(
+                notificationlog_id=log.pk, loan_id=loan.pk
+            )
+            for log, group in zip(logs, sent)
+            for loan in group
+        )
+
+    failed = [(group, e) for group, e in zip(groups, errors) if e is not None]
+    if failed:
+        raise SMTPException(
+            _("Não consegui enviar email para %(user)s")
+            % {
+                "user": ", ".join(
+                    str(group[0].user.profile) for group, _error in failed
+                )
+            }
+        ) from failed[0][1]
 
-    return count
+    return len(emails)
 
 
 def notify_all():
@@ -118,9 +251,12 @@ def notify_all():
     if not mailconf.activated:
         return None
 
+    now = timezone.now()
     querysets = {
-        "late": Loan.objects.filter(late=True),
-        "running": Loan.objects.filter(late=False, returned=False),
+        "late": Loan.objects.filter(return_date__isnull=True, due__lt=now),
+        "running": Loan.objects.filter(
+            return_date__isnull=True, due__gte=now
+        ),
     }
 
     errors = []
@@ -131,6 +267,7 @@ def notify_all():
                 querysets,
                 notification,
                 TriggerChoices(notification.trigger),
+                mailconf,
             )
         except SMTPException as e:
             errors.append(e)
@@ -145,21 +282,115 @@ def notify_all():
 def periodic_notify_all():
     notify_all()
 
-def receipt(loan, trigger):
-    loan = Loan.objects.get(pk=loan.pk) # Get manager's annotations
-    notifications = Notification.objects.filter(trigger=trigger)
 
-    for notification in notifications:
-        send_notification(loan, notification)
+@db_periodic_task(crontab(minute=30, hour=3))
+def compact_notification_logs_task():
+    NotificationLog.objects.compact()
+
+
+@db_task(retries=3, retry_delay=60)
+def send_combined_notification(loan_pks, notification_pk):
+    """Send a notification about many loans of the same user in a single
+    email, with the message rendered for each of them
+    """
+    notification = Notification.objects.filter(pk=notification_pk).first()
+    loans = list(
+        with_recipients(Loan.objects.filter(pk__in=loan_pks)).order_by("pk")
+    )
+    if notification is None or not loans:
+        return
+
+    mailconf = EmailConfiguration.get_solo()
+    conf = SiteConfiguration.get_solo()
+    contexts = [get_context(loan, mailconf, conf) for loan in loans]
+    template = notification.get_template("message")
+    message = "<hr>".join(template.render(c) for c in contexts)
+    subject = notification.get_template("subject").render(contexts[0])
+
+    make_email(subject, message, loans[0].user, mailconf).send(
+        fail_silently=False
+    )
+    NotificationLog.objects.bulk_create(
+        NotificationLog(
+            loan=loan, user_id=loan.user_id, notification=notification
+        )
+        for loan in loans
+    )
+
+
+@db_task()
+def send_receipts(loan_pks, trigger):
+    """Send the receipts of the loans, one email per notification of
+    `trigger` and user
+    """
+    by_user = {}
+    for pk, user in Loan.objects.filter(pk__in=loan_pks).values_list(
+        "pk", "user"
+    ):
+        by_user.setdefault(user, []).append(pk)
+
+    for notification_pk in Notification.objects.filter(
+        trigger=trigger
+    ).values_list("pk", flat=True):
+        for pks in by_user.values():
+            send_combined_notification(pks, notification_pk)
+
+
+def get_receipt_key(loans, trigger):
+    """Identify the receipt by the loans' state, so the same receipt
+    isn't queued twice, e.g. on a double submit, while the receipts of
+    a later return or renewal are
+    """
+    state = ";".join(
+        f"{loan.pk}:{loan.date}:{loan.return_date}:{loan.due}"
+        for loan in sorted(loans, key=lambda loan: loan.pk)
+    )
+    digest = sha1(state.encode(), usedforsecurity=False).hexdigest()
+    return f"receipt:{int(trigger)}:{digest}"
+
+
+def receipt(loans, trigger):
+    """Queue the receipts of `loans` when the current transaction
+    commits. Receipts are sent by the task queue, and failing to queue
+    them is logged, so saving loans never waits for nor fails because of
+    emails
+    """
+    loans = list(loans)
+    if not loans:
+        return
+    key = get_receipt_key(loans, trigger)
+    pks = [loan.pk for loan in loans]
+
+    def enqueue():
+        try:
+            if not cache.add(key, True, RECEIPT_DEDUPLICATION_TIMEOUT):
+                return
+            try:
+                send_receipts(pks, int(trigger))
+            except Exception:
+                cache.delete(key)
+                raise
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Couldn't queue receipts of loans %s", pks)
+
+    transaction.on_commit(enqueue)
 
 
 def loan_receipt(loan):
-    return receipt(loan, TriggerChoices.LOAN_RECEIPT)
+    return receipt([loan], TriggerChoices.LOAN_RECEIPT)
 
 
 def return_receipt(loan):
-    return receipt(loan, TriggerChoices.RETURN_RECEIPT)
+    return receipt([loan], TriggerChoices.RETURN_RECEIPT)
 
 
 def renewal_receipt(loan):
-    return receipt(loan, TriggerChoices.RENEWAL_RECEIPT)
+    return receipt([loan], TriggerChoices.RENEWAL_RECEIPT)
+
+
+def checkout_receipt(loans):
+    return receipt(loans, TriggerChoices.LOAN_RECEIPT)
+
+
+def checkin_receipt(loans):
+    return receipt(loans, TriggerChoices.RETURN_RECEIPT)
@@ -0,0 +1,208 @@
+import random
+from datetime import timedelta
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from books.models import Book, Specimen
+from loans.models import Loan, Period
+
+from ...models import Notification, NotificationLog
+
+User = get_user_model()
+TriggerChoices = Notification.TriggerChoices
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the notification triggers' exclusion of notified users, with "
+        "and without the log indexes, and compacting the log, on a large "
+        "synthetic log. Everything is rolled back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--logs", type=int, default=2_000_000)
+        parser.add_argument("--users", type=int, default=20_000)
+        parser.add_argument("--loans", type=int, default=5000)
+        parser.add_argument("--years", type=int, default=3)
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument(
+            "--plans", action="store_true", help="Show the query plans"
+        )
+
+    def populate(self, options):
+        start = perf_counter()
+        users = User.objects.bulk_create(
+            User(username=f"benchmark-{i}") for i in range(options["users"])
+        )
+        book = Book.objects.create(
+            title="Livro",
+            unaccent_title="Livro",
+            author_last_name="Silva",
+            unaccent_author="Silva",
+        )
+        specimens = Specimen.objects.bulk_create(
+            Specimen(book=book, number=i + 1) for i in range(options["loans"])
+        )
+        period = Period.get_default()
+
+        # Open loans, late by up to two months
+        now = timezone.now()
+        loans = []
+        for specimen in specimens:
+            due = now - timedelta(days=random.randrange(-10, 60))
+            loans.append(
+                Loan(
+                    specimen=specimen,
+                    user=random.choice(users),
+                    period=period,
+                    date=due - timedelta(days=period.days),
+                    due=due,
+                )
+            )
+        Loan.objects.bulk_create(loans, batch_size=options["batch_size"])
+
+        notifications = [
+            Notification.objects.create(
+                name=f"Benchmark {trigger.label}",
+                subject="subject",
+                message="message",
+                n_parameter=n,
+                trigger=trigger,
+            )
+            for trigger, n in (
+                (TriggerChoices.DUE_IN_N, 3),
+                (TriggerChoices.LATE_AFTER_N, 1),
+                (TriggerChoices.LATE_AFTER_EACH_N, 7),
+            )
+        ]
+
+        # Logs of loans long gone, as left by archiving. `created` is set
+        # on every add, so it's turned off to backdate them
+        span = options["years"] * 365 * 24 * 60 * 60
+        created = NotificationLog._meta.get_field("created")
+        created.auto_now_add = False
+        try:
+            batch = []
+            for i in range(options["logs"]):
+                batch.append(
+                    NotificationLog(
+                        notification=random.choice(notifications),
+                        user=random.choice(users),
+                        created=now
+                        - timedelta(seconds=random.randrange(span)),
+                    )
+                )
+                if len(batch) == options["batch_size"]:
+                    NotificationLog.objects.bulk_create(batch)
+                    batch = []
+            NotificationLog.objects.bulk_create(batch)
+        finally:
+            created.auto_now_add = True
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(
+            f"Created {options['logs']} logs in "
+            f"{perf_counter() - start:.1f}s"
+        )
+        return notifications
+
+    def get_queries(self, notifications):
+        """Name and queryset of each trigger's loans to notify"""
+        now = timezone.now()
+        querysets = {
+            "late": Loan.objects.filter(
+                return_date__isnull=True, due__lt=now
+            ),
+            "running": Loan.objects.filter(
+                return_date__isnull=True, due__gte=now
+            ),
+        }
+        return [
+            (
+                notification.get_trigger_display(),
+                TriggerChoices(notification.trigger).get_queryset(
+                    querysets,
+                    notification.n_parameter,
+                    NotificationLog.objects.filter(notification=notification),
+                ),
+            )
+            for notification in notifications
+        ]
+
+    def explain(self, queryset, label):
+        # The label keeps sqlite from reusing a cached statement, and so
+        # a plan from before dropping the indexes
+        sql, params = queryset.query.sql_with_params()
+        prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            cursor.execute(f"{prefix} /* {label} */ {sql}", params)
+            for row in cursor.fetchall():
+                self.stdout.write(" ".join(str(column) for column in row))
+
+    def run(self, notifications, options, label):
+        timings = {}
+        for name, queryset in self.get_queries(notifications):
+            times = []
+            for _ in range(options["runs"]):
+                start = perf_counter()
+                list(queryset.values_list("pk", flat=True))
+                times.append(perf_counter() - start)
+            timings[name] = median(times)
+
+            if options["plans"]:
+                self.stdout.write(self.style.MIGRATE_LABEL(name))
+                self.explain(queryset, label)
+        return timings
+
+    def drop_indexes(self):
+        with connection.cursor() as cursor:
+            for index in NotificationLog._meta.indexes:
+                cursor.execute(
+                    f"DROP INDEX {connection.ops.quote_name(index.name)}"
+                )
+
+    def compact(self):
+        before = NotificationLog.objects.count()
+        start = perf_counter()
+        NotificationLog.objects.compact()
+        seconds = perf_counter() - start
+        self.stdout.write(
+            f"Compacted {before} logs to "
+            f"{NotificationLog.objects.count()} in {seconds:.1f}s"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Database: {connection.vendor}")
+        with transaction.atomic():
+            notifications = self.populate(options)
+
+            self.stdout.write("Without indexes")
+            with transaction.atomic():
+                self.drop_indexes()
+                plain = self.run(notifications, options, "plain")
+                transaction.set_rollback(True)
+
+            self.stdout.write("With indexes")
+            indexed = self.run(notifications, options, "indexed")
+            self.compact()
+            self.stdout.write("Compacted")
+            compacted = self.run(notifications, options, "compacted")
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{'trigger':<35}{'plain (ms)':>12}{'indexed (ms)':>14}"
+            f"{'compacted (ms)':>16}"
+        )
+        for name, seconds in indexed.items():
+            self.stdout.write(
+                f"{name:<35}{plain[name] * 1000:>12.1f}"
+                f"{seconds * 1000:>14.1f}{compacted[name] * 1000:>16.1f}"
+            )
@@ -0,0 +1,121 @@
+from datetime import timedelta
+from statistics import median
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template import Template
+from django.utils import timezone
+
+from books.models import Book, Specimen
+from loans.models import Loan
+from site_configuration.models import EmailConfiguration, SiteConfiguration
+
+from ...context import get_context
+from ...models import Notification
+from ...rendering import html2text
+
+User = get_user_model()
+
+MESSAGE = """
+<p>Olá, {{ name }}!</p>
+<p>O empréstimo de <strong>{{ book }}</strong>, de {{ author }}, feito em
+{{ loan_date }}, venceu em {{ due }} e está atrasado há {{ late_days }}
+dias.</p>
+<p>Por favor, devolva o livro à biblioteca {{ site_title }}.</p>
+<ul>
+  <li>Empréstimo: {{ loan_date }}</li>
+  <li>Vencimento: {{ due }}</li>
+</ul>
+{{ signature }}
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Time rendering notification emails, compiling the templates and "
+        "parsing the html with BeautifulSoup for each one, and with the "
+        "cached templates and the lxml text path. Everything is rolled "
+        "back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=10_000)
+        parser.add_argument("--runs", type=int, default=3)
+
+    def get_loans(self, count):
+        """Unsaved loans, with everything the context reads"""
+        now = timezone.now()
+        book = Book(
+            title="Dom Casmurro",
+            author_first_names="Machado de",
+            author_last_name="Assis",
+        )
+        specimen = Specimen(book=book, number=1)
+        return [
+            Loan(
+                specimen=specimen,
+                user=User(first_name=f"Usuário {i}", last_name="Silva"),
+                date=now - timedelta(days=30 + i % 30),
+                due=now - timedelta(days=i % 30),
+            )
+            for i in range(count)
+        ]
+
+    def uncached(self, notification, loan, mailconf):
+        context = get_context(loan, mailconf)
+        Template(notification.subject).render(context)
+        message = Template(notification.message).render(context)
+        return BeautifulSoup(message, "lxml").get_text()
+
+    def cached(self, notification, loan, mailconf):
+        context = get_context(loan, mailconf)
+        notification.get_template("subject").render(context)
+        message = notification.get_template("message").render(context)
+        return html2text(message)
+
+    def time(self, render, notification, loans, mailconf, runs):
+        times = []
+        for _ in range(runs):
+            start = perf_counter()
+            for loan in loans:
+                render(notification, loan, mailconf)
+            times.append(perf_counter() - start)
+        return median(times)
+
+    def handle(self, *args, **options):
+        loans = self.get_loans(options["messages"])
+        # Created, if missing, outside of the transaction, so they're
+        # cached as usual
+        SiteConfiguration.get_solo()
+        mailconf = EmailConfiguration.get_solo()
+
+        with transaction.atomic():
+            mailconf.signature = "<p>Biblioteca</p>"
+            notification = Notification.objects.create(
+                name="Benchmark",
+                subject="Empréstimo de {{ book }} atrasado",
+                message=MESSAGE,
+                trigger=Notification.TriggerChoices.LATE_AFTER_N,
+                n_parameter=1,
+            )
+
+            timings = {
+                name: self.time(
+                    render, notification, loans, mailconf, options["runs"]
+                )
+                for name, render in (
+                    ("uncached, BeautifulSoup", self.uncached),
+                    ("cached, lxml", self.cached),
+                )
+            }
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'path':<30}{'total (s)':>12}{'msg/s':>12}")
+        for name, seconds in timings.items():
+            self.stdout.write(
+                f"{name:<30}{seconds:>12.2f}"
+                f"{options['messages'] / seconds:>12.0f}"
+            )
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from ...models import NotificationLog
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the notification logs older than "
+        "NOTIFICATION_LOG_RETENTION_DAYS, except the latest of each "
+        "notification and user"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Compact logs created more than this many days ago",
+        )
+        parser.add_argument("--batch-size", type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        before = None
+        if options["days"] is not None:
+            before = timezone.now() - timedelta(days=options["days"])
+        count = NotificationLog.objects.compact(before, options["batch_size"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("%(count)d registros de notificação removidos")
+                % {"count": count}
+            )
+        )
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.4 on 2026-10-18 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0011_loan_renewals_count"),
+        ("notifications", "0003_alter_notification_message_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="digest",
+            field=models.BooleanField(
+                default=False,
+                help_text="Enviar um único email por usuário, com todos os seus empréstimos em <code>{{ loans }}</code>, cada um com as variáveis acima",
+                verbose_name="Resumo",
+            ),
+        ),
+        migrations.AddField(
+            model_name="notificationlog",
+            name="loans",
+            field=models.ManyToManyField(
+                blank=True,
+                related_name="digest_logs",
+                to="loans.loan",
+                verbose_name="Empréstimos do resumo",
+            ),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.0.4 on 2026-10-18 02:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_user(apps, schema_editor):
+    Loan = apps.get_model("loans", "Loan")
+    NotificationLog = apps.get_model("notifications", "NotificationLog")
+
+    NotificationLog.objects.update(
+        user=Subquery(
+            Loan.objects.filter(pk=OuterRef("loan")).values("user")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0011_loan_renewals_count"),
+        ("notifications", "0004_notification_digest"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notificationlog",
+            name="user",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="Usuário",
+            ),
+        ),
+        migrations.RunPython(fill_user, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="notificationlog",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="Usuário",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="notificationlog",
+            name="loan",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="loans.loan",
+                verbose_name="Empréstimo",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notificationlog",
+            index=models.Index(
+                fields=["notification", "user"],
+                name="notificationlog_notif_user_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notificationlog",
+            index=models.Index(
+                fields=["notification", "created", "user"],
+                name="notificationlog_created_idx",
+            ),
+        ),
+    ]
@@ -1,7 +1,11 @@
 from datetime import timedelta
 
+from django.conf import settings
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.timezone import localtime
@@ -12,6 +16,7 @@ from tinymce.models import HTMLField
 from loans.models import Loan
 
 from .context import get_context
+from .rendering import template_cache
 
 
 class Notification(models.Model):
@@ -41,7 +46,7 @@ class Notification(models.Model):
                         due__lt=timezone.now() + timedelta(days=n)
                     )
                     qs = qs.exclude(
-                        user__in=log.values_list("loan__user", flat=True)
+                        user__in=log.values_list("user", flat=True)
                     )
 
                     return qs
@@ -50,7 +55,7 @@ class Notification(models.Model):
                         due__lt=timezone.now() - timedelta(days=n)
                     )
                     qs = qs.exclude(
-                        user__in=log.values_list("loan__user", flat=True)
+                        user__in=log.values_list("user", flat=True)
                     )
                     return qs
                 case self.LATE_AFTER_EACH_N:
@@ -60,13 +65,14 @@ class Notification(models.Model):
                     qs = qs.exclude(
                         user__in=log.filter(
                             created__gt=timezone.now() - timedelta(days=n)
-                        ).values_list("loan__user", flat=True)
+                        ).values_list("user", flat=True)
                     )
 
                     return qs
 
+                # Receipts are sent as loans change, not by the triggers
                 case _:
-                    return []
+                    return Loan.objects.none()
 
     name = models.CharField(max_length=100, verbose_name=_("Nome"))
     subject = models.CharField(max_length=100, verbose_name=_("Assunto"))
@@ -93,6 +99,23 @@ class Notification(models.Model):
         choices=TriggerChoices,
         verbose_name=_("tipo de gatilho"),
     )
+    digest = models.BooleanField(
+        default=False,
+        verbose_name=_("Resumo"),
+        help_text=format_html(
+            "{}<code>{}</code>{}",
+            _(
+                "Enviar um único email por usuário, com todos os seus "
+                "empréstimos em "
+            ),
+            "{{ loans }}",
+            _(", cada um com as variáveis acima"),
+        ),
+    )
+
+    def get_template(self, field):
+        """Compiled template of `field`, "subject" or "message" """
+        return template_cache.get(self.pk, field, getattr(self, field))
 
     def __str__(self):
         return self.name
@@ -102,23 +125,96 @@ class Notification(models.Model):
         verbose_name_plural = _("Notificações")
 
 
+class NotificationLogManager(models.Manager):
+    def compact(self, before=None, batch_size=10_000):
+        """Delete the logs created before `before`, by default
+        NOTIFICATION_LOG_RETENTION_DAYS ago, except the latest of each
+        notification and user, which is all the triggers look at. Deletes
+        `batch_size` at a time, each batch in its own transaction.
+        Returns how many
+        """
+        if before is None:
+            days = getattr(settings, "NOTIFICATION_LOG_RETENTION_DAYS", 365)
+            before = timezone.now() - timedelta(days=days)
+
+        latest = (
+            self.order_by()
+            .values("notification", "user")
+            .annotate(latest=Max("pk"))
+            .values("latest")
+        )
+        old = self.filter(created__lt=before).exclude(pk__in=latest)
+
+        count = 0
+        while True:
+            with transaction.atomic():
+                pks = list(old.values_list("pk", flat=True)[:batch_size])
+                if not pks:
+                    break
+                self.filter(pk__in=pks).delete()
+            count += len(pks)
+
+        return count
+
+
 class NotificationLog(models.Model):
+    objects = NotificationLogManager()
     created = models.DateTimeField(auto_now_add=True, verbose_name=_("Data"))
+    # Kept when the loan is archived, since `user` is all the triggers
+    # need
     loan = models.ForeignKey(
         Loan,
-        on_delete=models.CASCADE,
+        on_delete=models.SET_NULL,
+        null=True,
         verbose_name=_("Empréstimo"),
     )
+    # The loan's user, so triggers don't join the loans
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        verbose_name=_("Usuário"),
+        related_name="+",
+    )
     notification = models.ForeignKey(
         Notification, on_delete=models.CASCADE, verbose_name=_("Notificação")
     )
+    # Every loan of a digest, whose first loan is `loan`
+    loans = models.ManyToManyField(
+        Loan,
+        blank=True,
+        related_name="digest_logs",
+        verbose_name=_("Empréstimos do resumo"),
+    )
+
+    def save(self, *args, **kwargs):
+        if self.user_id is None and self.loan_id is not None:
+            self.user_id = self.loan.user_id
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return gettext("Registro: %(user)s | %(created)s") % {
-            "user": self.loan.user.profile,
+            "user": self.user.profile,
             "created": localtime(self.created).strftime("%d/%m/%y %H:%M"),
         }
 
     class Meta:
         verbose_name = _("Registro de notificação")
         verbose_name_plural = _("Registros de notificação")
+        indexes = [
+            # Users already notified, for each trigger's exclusion
+            models.Index(
+                fields=["notification", "user"],
+                name="notificationlog_notif_user_idx",
+            ),
+            # Users notified since some date, for LATE_AFTER_EACH_N
+            models.Index(
+                fields=["notification", "created", "user"],
+                name="notificationlog_created_idx",
+            ),
+        ]
+
+
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def invalidate_templates_hook(sender, instance, **kwargs):
+    template_cache.invalidate(instance.pk)
@@ -0,0 +1,55 @@
+"""Compiled notification templates and the plain text of emails.
+
+Compiling a notification's templates for every email, and parsing every
+rendered body into a tree to get its text, dominated periodic runs over
+many loans. Compiled templates are kept per notification, keyed by a hash
+of their source, and text is extracted with lxml directly.
+"""
+
+from hashlib import sha1
+from threading import Lock
+
+import lxml.html
+from django.template import Template
+
+
+class TemplateCache:
+    """Process-local compiled templates of each notification field. A
+    template is compiled again when its source changes, even if saved by
+    another process, and forgotten when its notification is saved or
+    deleted here
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.lock = Lock()
+
+    def get(self, pk, field, source):
+        digest = sha1(source.encode(), usedforsecurity=False).hexdigest()
+        cached = self.templates.get((pk, field))
+        if cached is None or cached[0] != digest:
+            cached = (digest, Template(source))
+            if pk is not None:
+                with self.lock:
+                    self.templates[(pk, field)] = cached
+        return cached[1]
+
+    def invalidate(self, pk):
+        with self.lock:
+            for key in [k for k in self.templates if k[0] == pk]:
+                del self.templates[key]
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+template_cache = TemplateCache()
+
+
+def html2text(html):
+    """Text of `html`, without scripts and styles"""
+    root = lxml.html.fragment_fromstring(html, create_parent="div")
+    for element in root.xpath("//script|//style"):
+        element.drop_tree()
+    return root.text_content()
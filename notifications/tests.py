@@ -1,16 +1,22 @@
 from datetime import timedelta
 from io import StringIO
 from random import choice, randint, sample, shuffle
-from unittest.mock import Mock
+from smtplib import SMTPException
+from threading import Lock
+from unittest.mock import Mock, patch
 
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth import get_user_model
 from django.contrib.messages import get_messages
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.core import mail
+from django.core.mail import BadHeaderError, EmailMultiAlternatives
+from django.core.mail.backends import locmem
 from django.core.management import call_command
-from django.db.models import F
-from django.test import RequestFactory, TestCase
+from django.db import connection
+from django.db.models import F, Max
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
@@ -21,8 +27,18 @@ from loans.models import Loan, Period
 from profiles.tests import create_test_users
 from site_configuration.models import EmailConfiguration
 
-from .mail import DynamicSMPTEmailBackend, send_notification
+from .mail import (
+    NOTIFICATION_CONNECTIONS,
+    DynamicSMPTEmailBackend,
+    build_email,
+    checkout_receipt,
+    get_recipient_list,
+    loan_receipt,
+    notify_all,
+    send_emails,
+)
 from .models import Notification, NotificationLog
+from .rendering import html2text, template_cache
 
 User = get_user_model()
 TriggerChoices = Notification.TriggerChoices
@@ -61,6 +77,182 @@ class EmailBackendTestCase(TestCase):
             )
 
 
+class CountingEmailBackend(locmem.EmailBackend):
+    """Local memory backend counting the connections opened. While
+    `failures` is positive, sending fails and decrements it
+    """
+
+    opened = 0
+    failures = 0
+    lock = Lock()
+
+    def open(self):
+        with self.lock:
+            CountingEmailBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        with self.lock:
+            if CountingEmailBackend.failures > 0:
+                CountingEmailBackend.failures -= 1
+                raise SMTPException("Failing on purpose")
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND="notifications.tests.CountingEmailBackend")
+class SendEmailsTestCase(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.failures = 0
+        self.emails = [
+            EmailMultiAlternatives(f"subject {i}", "body", to=["a@b.com"])
+            for i in range(50)
+        ]
+
+    def test_reuse_connections(self):
+        self.assertEqual(send_emails(self.emails), [None] * 50)
+        self.assertEqual(len(mail.outbox), 50)
+        self.assertEqual(
+            CountingEmailBackend.opened, NOTIFICATION_CONNECTIONS
+        )
+
+    def test_retries(self):
+        # Within the retries of any email
+        CountingEmailBackend.failures = 2
+        self.assertEqual(send_emails(self.emails), [None] * 50)
+        self.assertEqual(len(mail.outbox), 50)
+        self.assertEqual(
+            CountingEmailBackend.opened, NOTIFICATION_CONNECTIONS + 2
+        )
+
+    def test_invalid_email(self):
+        # A newline in the subject is refused when the message is built
+        self.emails[7].subject = "subject\nBcc: x@y.com"
+        errors = send_emails(self.emails)
+        self.assertIsInstance(errors[7], BadHeaderError)
+        self.assertEqual(errors.count(None), 49)
+        self.assertEqual(len(mail.outbox), 49)
+
+    def test_failures(self):
+        CountingEmailBackend.failures = 1000
+        errors = send_emails(self.emails)
+        self.assertTrue(all(isinstance(e, SMTPException) for e in errors))
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class RenderingTestCase(TestCase):
+    def setUp(self):
+        template_cache.clear()
+
+    def test_template_cache(self):
+        notification = Notification.objects.create(
+            name="Notification",
+            subject="Subject {{ name }}",
+            message="<p>Message</p>",
+            trigger=TriggerChoices.LATE_AFTER_N,
+        )
+        template = notification.get_template("subject")
+        self.assertIs(notification.get_template("subject"), template)
+
+        # Changed by another process
+        Notification.objects.update(subject="Other {{ name }}")
+        notification.refresh_from_db()
+        self.assertIsNot(notification.get_template("subject"), template)
+
+        notification.save()
+        self.assertEqual(template_cache.templates, {})
+
+    def test_html2text(self):
+        self.assertEqual(
+            html2text(
+                "<p>Olá <b>mundo</b>&nbsp;&amp;</p><style>p {}</style>"
+                "<!-- comment --><script>x</script>tail"
+            ),
+            "Olá mundo\xa0&tail",
+        )
+        self.assertEqual(html2text(""), "")
+
+
+class NotificationLogTestCase(TestCase):
+    def setUp(self):
+        create_test_catalog()
+        create_test_users()
+
+        self.users = list(User.objects.all()[:2])
+        specimens = list(Specimen.objects.values_list("pk", flat=True))
+        self.loans = [
+            loan
+            for i, user in enumerate(self.users)
+            for loan in Loan.objects.checkout(user, specimens[2 * i :][:2])
+        ]
+        self.notifications = [
+            Notification.objects.create(
+                name=f"Notification {trigger}",
+                subject="subject",
+                message="message",
+                n_parameter=1,
+                trigger=trigger,
+            )
+            for trigger in (
+                TriggerChoices.LATE_AFTER_N,
+                TriggerChoices.LATE_AFTER_EACH_N,
+            )
+        ]
+
+    def notified(self):
+        return {
+            n.pk: set(
+                NotificationLog.objects.filter(notification=n).values_list(
+                    "user", flat=True
+                )
+            )
+            for n in self.notifications
+        }
+
+    def test_compact(self):
+        for notification in self.notifications:
+            for loan in self.loans:
+                NotificationLog.objects.create(
+                    loan=loan, notification=notification
+                )
+        old = timezone.now() - timedelta(days=400)
+        NotificationLog.objects.update(created=old)
+        recent = NotificationLog.objects.create(
+            loan=self.loans[0], notification=self.notifications[0]
+        )
+        notified = self.notified()
+        latest = set(
+            NotificationLog.objects.order_by()
+            .values("notification", "user")
+            .annotate(Max("pk"))
+            .values_list("pk__max", flat=True)
+        )
+
+        # Two old logs of each notification and user, and a recent one
+        # which is now the latest of its notification and user
+        self.assertEqual(NotificationLog.objects.compact(batch_size=3), 5)
+        self.assertEqual(self.notified(), notified)
+        self.assertEqual(
+            set(NotificationLog.objects.values_list("pk", flat=True)),
+            latest,
+        )
+        self.assertIn(recent.pk, latest)
+        self.assertEqual(NotificationLog.objects.compact(), 0)
+
+    def test_user(self):
+        log = NotificationLog.objects.create(
+            loan=self.loans[0], notification=self.notifications[0]
+        )
+        self.assertEqual(log.user, self.users[0])
+
+        Loan.objects.filter(pk=self.loans[0].pk).delete()
+        log.refresh_from_db()
+        self.assertIsNone(log.loan)
+        self.assertEqual(
+            self.notified()[self.notifications[0].pk], {log.user_id}
+        )
+
+
 class NotificationTestCase(TestCase):
     def setUp(self):
         self.mailconf = example_mailconf()
@@ -81,6 +273,13 @@ class NotificationTestCase(TestCase):
             "admin",
         )
 
+    def commit(self, function, *args, **kwargs):
+        """Call `function` and run what it registered for when the
+        transaction commits, such as queuing receipts
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            return function(*args, **kwargs)
+
     def test_not_activated(self):
         call_command("notify", stdout=self.out)
         self.assertIn(_("Ignorando"), self.out.getvalue())
@@ -91,21 +290,15 @@ class NotificationTestCase(TestCase):
             period=self.period,
             user=choice(self.users),
             date=date,
+            renewals_count=renewals,
+            renewal_days=15 * renewals,
         )
         loan.save()
 
-        for i in range(renewals):
-            loan.renewals.create(
-                description="ren.",
-                days=15,
-                period=self.period,
-                order=i + 1,
-            )
-
         loan = Loan.objects.get(pk=loan.pk)
         return loan
 
-    def test_send_notification(self):
+    def test_build_email(self):
         self.mk_loan()
         loan = Loan.objects.first()
 
@@ -116,20 +309,124 @@ class NotificationTestCase(TestCase):
             trigger=1,
             n_parameter=5,
         )
-        send_notification(loan, notification)
+        build_email(loan, notification, self.mailconf).send()
 
         self.assertEqual(len(mail.outbox), 1)
         sent = mail.outbox[0]
         self.assertIn(self.mailconf.signature, sent.alternatives[0][0])
         self.assertIn(notification.subject, sent.subject)
 
-        emails = {
-            *loan.user.additional_emails.all().values_list(
-                "email", flat=True
+        self.assertEqual(
+            set(get_recipient_list(loan.user)), set(sent.recipients())
+        )
+
+    def test_checkout_receipt(self):
+        Notification.objects.create(
+            name="Receipt",
+            subject="Receipt",
+            message="<p>{{ book }}</p>",
+            trigger=TriggerChoices.LOAN_RECEIPT,
+        )
+        specimens = self.specimens[:3]
+        loans = Loan.objects.checkout(
+            self.users[0], [s.pk for s in specimens]
+        )
+        self.commit(checkout_receipt, loans)
+
+        self.assertEqual(len(mail.outbox), 1)
+        for specimen in specimens:
+            self.assertIn(specimen.book.title, mail.outbox[0].body)
+        self.assertEqual(NotificationLog.objects.count(), 3)
+
+    def test_receipt_queuing(self):
+        Notification.objects.create(
+            name="Receipt",
+            subject="Receipt",
+            message="<p>{{ book }}</p>",
+            trigger=TriggerChoices.LOAN_RECEIPT,
+        )
+        loan = self.mk_loan()
+
+        with patch(
+            "notifications.mail.send_receipts", side_effect=ConnectionError
+        ), self.assertLogs("notifications.mail", "ERROR"):
+            self.commit(loan_receipt, loan)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.commit(loan_receipt, loan)
+        self.commit(loan_receipt, loan)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_notify_constant_queries(self):
+        self.mailconf.activated = True
+        self.mailconf.save()
+        Notification.objects.create(
+            name="Late",
+            subject="Late {{ book }}",
+            message="<p>{{ name }}, {{ author }}</p>{{ signature }}",
+            n_parameter=1,
+            trigger=TriggerChoices.LATE_AFTER_N,
+        )
+        late = timezone.now() - timedelta(days=self.period.days + 5)
+
+        self.mk_loan(late)
+        with CaptureQueriesContext(connection) as few:
+            call_command("notify", stdout=self.out)
+        self.assertEqual(len(mail.outbox), 1)
+
+        NotificationLog.objects.all().delete()
+        mail.outbox = []
+        for user in self.users:
+            user.additional_emails.create(email=f"{user.pk}@example.com")
+        for _ in range(8):
+            self.mk_loan(late)
+
+        with self.assertNumQueries(len(few)):
+            call_command("notify", stdout=self.out)
+        self.assertEqual(
+            sorted(sorted(sent.to) for sent in mail.outbox),
+            sorted(
+                sorted(get_recipient_list(loan.user))
+                for loan in Loan.objects.all()
             ),
-            loan.user.email,
-        }
-        self.assertEqual(emails, set(sent.recipients()))
+        )
+
+    def test_digest(self):
+        self.mailconf.activated = True
+        self.mailconf.save()
+        notification = Notification.objects.create(
+            name="Late",
+            subject="{{ loans|length }} late loans",
+            message=(
+                "<p>{{ name }}</p>"
+                "{% for loan in loans %}<p>{{ loan.book }}</p>{% endfor %}"
+            ),
+            n_parameter=1,
+            trigger=TriggerChoices.LATE_AFTER_N,
+            digest=True,
+        )
+        late = timezone.now() - timedelta(days=self.period.days + 5)
+        user, other = self.users[:2]
+        self.users = [user]
+        loans = [self.mk_loan(late) for _ in range(3)]
+        self.users = [other]
+        self.mk_loan(late)
+
+        call_command("notify", stdout=self.out)
+        self.assertEqual(len(mail.outbox), 2)
+        sent = next(m for m in mail.outbox if user.email in m.to)
+        self.assertEqual(sent.subject, "3 late loans")
+        for loan in loans:
+            self.assertIn(str(loan.specimen.book), sent.body)
+
+        log = NotificationLog.objects.get(loan__user=user)
+        self.assertEqual(log.notification, notification)
+        self.assertEqual(set(log.loans.all()), set(loans))
+        self.assertEqual(NotificationLog.objects.count(), 2)
+
+        mail.outbox = []
+        call_command("notify", stdout=self.out)
+        self.assertEqual(len(mail.outbox), 0)
 
     def test_send_notification_due_in_n(self):
         self.mailconf.activated = True
@@ -210,6 +507,28 @@ class NotificationTestCase(TestCase):
             Notification.objects.all().delete()
             mail.outbox = []
 
+    def test_notify_all_with_receipts(self):
+        self.mailconf.activated = True
+        self.mailconf.save()
+        for trigger in (
+            TriggerChoices.LOAN_RECEIPT,
+            TriggerChoices.LATE_AFTER_N,
+        ):
+            Notification.objects.create(
+                name=f"notification_{trigger}",
+                subject=f"subject {trigger}",
+                message=f"<p>message {trigger}</p>",
+                n_parameter=1,
+                trigger=trigger,
+            )
+        loan = self.mk_loan(timezone.now() - timedelta(days=60))
+
+        self.assertEqual(notify_all(), 1)
+        self.assertEqual(
+            mail.outbox[0].subject, f"subject {TriggerChoices.LATE_AFTER_N}"
+        )
+        self.assertEqual(NotificationLog.objects.get().user, loan.user)
+
     def test_send_notification_late_after_n(self):
         self.mailconf.activated = True
         self.mailconf.save()
@@ -366,7 +685,8 @@ class NotificationTestCase(TestCase):
         n = 3
 
         for __ in range(n):
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=self.mk_loan(),
                 request=None,
                 form=Mock(initial={"return_date": None}),
@@ -387,7 +707,8 @@ class NotificationTestCase(TestCase):
         )
 
         for __ in range(n):
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=self.mk_loan(),
                 request=None,
                 form=Mock(initial={"return_date": None}),
@@ -397,7 +718,8 @@ class NotificationTestCase(TestCase):
 
         Loan.objects.all().update(date=F("date") - timedelta(days=3))
         for loan in Loan.objects.all():
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": loan.return_date}),
@@ -418,8 +740,12 @@ class NotificationTestCase(TestCase):
         n = 3
 
         for __ in range(n):
-            loan_admin.save_model(
-                obj=self.mk_loan(), request=None, form=None, change=None
+            self.commit(
+                loan_admin.save_model,
+                obj=self.mk_loan(),
+                request=None,
+                form=None,
+                change=None,
             )
         self.assertEqual(len(mail.outbox), 0)
 
@@ -438,7 +764,8 @@ class NotificationTestCase(TestCase):
         )
 
         for __ in range(n):
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=self.mk_loan(),
                 request=None,
                 form=Mock(initial={"return_date": None}),
@@ -453,7 +780,8 @@ class NotificationTestCase(TestCase):
                 if loan.return_date
                 else timezone.now()
             )
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": prev_rd}),
@@ -468,7 +796,8 @@ class NotificationTestCase(TestCase):
                 if loan.return_date
                 else timezone.now()
             )
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": prev_rd}),
@@ -494,7 +823,8 @@ class NotificationTestCase(TestCase):
                 if loan.return_date
                 else timezone.now()
             )
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": prev_rd}),
@@ -532,12 +862,16 @@ class NotificationTestCase(TestCase):
 
         for __ in range(n):
             loan = self.mk_loan()
-            loan_admin.save_model(
-                obj=loan, request=None, form=None, change=None
+            self.commit(
+                loan_admin.save_model,
+                obj=loan,
+                request=None,
+                form=None,
+                change=None,
             )
             loan = Loan.objects.get(pk=loan.pk)
             request = self.get_request()
-            loan_admin.renew_view(request, loan)
+            self.commit(loan_admin.renew_view, request, loan)
             self.assertNotIn(error_msg, self.getmsg(request))
 
         self.assertEqual(len(mail.outbox), 0)
@@ -554,7 +888,8 @@ class NotificationTestCase(TestCase):
 
         for __ in range(n):
             loan = self.mk_loan()
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": None}),
@@ -562,20 +897,19 @@ class NotificationTestCase(TestCase):
             )
             loan = Loan.objects.get(pk=loan.pk)
             request = self.get_request()
-            loan_admin.renew_view(request, loan)
+            self.commit(loan_admin.renew_view, request, loan)
             self.assertNotIn(error_msg, self.getmsg(request))
         self.assertEqual(len(mail.outbox), n)
 
         for loan in Loan.objects.all():
             loan = Loan.objects.get(pk=loan.pk)
             request = self.get_request()
-            loan_admin.renew_view(request, loan)
+            self.commit(loan_admin.renew_view, request, loan)
             self.assertIn(error_msg, self.getmsg(request))
-            days = sum(loan.renewals.all().values_list("days", flat=True))
-            loan.date = loan.date - timedelta(days=days)
+            loan.date = loan.date - timedelta(days=loan.renewal_days)
             loan.save()
             request = self.get_request()
-            loan_admin.renew_view(request, loan)
+            self.commit(loan_admin.renew_view, request, loan)
             self.assertNotIn(error_msg, self.getmsg(request))
         self.assertEqual(len(mail.outbox), 2 * n)
 
@@ -587,7 +921,8 @@ class NotificationTestCase(TestCase):
                 if loan.return_date
                 else timezone.now()
             )
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": prev_rd}),
@@ -613,7 +948,8 @@ class NotificationTestCase(TestCase):
                 if loan.return_date
                 else timezone.now()
             )
-            loan_admin.save_model(
+            self.commit(
+                loan_admin.save_model,
                 obj=loan,
                 request=None,
                 form=Mock(initial={"return_date": prev_rd}),
@@ -0,0 +1,91 @@
+from threading import local
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+class Invalidation:
+    """Bumps the version of `versioned` when its transaction commits.
+    Every invalidation of a transaction queues one, and the first to run
+    bumps for all of them, since any of them may have been dropped by a
+    savepoint rollback
+    """
+
+    def __init__(self, versioned):
+        self.versioned = versioned
+        self.done = False
+
+    def __call__(self):
+        if not self.done:
+            self.done = True
+            self.versioned.bump()
+
+
+class VersionedCache:
+    """Process-local cache of a value, valid while a version key in the
+    shared cache doesn't change. Invalidating bumps the version when the
+    transaction commits, so every process reloads on its next access.
+
+    While an invalidation is waiting for its transaction, loaded values
+    aren't kept, since they may hold data that will be rolled back
+    """
+
+    def __init__(self, name):
+        self.key = f"version:{name}"
+        self.value = None
+        # The invalidation waiting for this thread's transaction
+        self.local = local()
+
+    def version(self):
+        version = cache.get(self.key)
+        if version is None:
+            cache.add(self.key, uuid4().hex, timeout=None)
+            version = cache.get(self.key)
+        return version
+
+    def get_invalidation(self):
+        """The invalidation queued by the current transaction, if any.
+        One that didn't run when there's no transaction any more was
+        rolled back
+        """
+        invalidation = getattr(self.local, "invalidation", None)
+        if invalidation is None or invalidation.done:
+            return None
+        if not transaction.get_connection().in_atomic_block:
+            self.local.invalidation = None
+            return None
+        return invalidation
+
+    def pending(self):
+        """Whether the current transaction has invalidated the value"""
+        return self.get_invalidation() is not None
+
+    def get(self, load):
+        cached = self.value
+        version = self.version()
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        while True:
+            value = load()
+            # Loading may save, and so invalidate, what's loaded
+            current = self.version()
+            if current == version:
+                break
+            version = current
+
+        if not self.pending():
+            self.value = (version, value)
+        return value
+
+    def invalidate(self):
+        self.value = None
+        invalidation = self.get_invalidation()
+        if invalidation is None:
+            invalidation = self.local.invalidation = Invalidation(self)
+        transaction.on_commit(invalidation)
+
+    def bump(self):
+        self.value = None
+        cache.set(self.key, uuid4().hex, timeout=None)
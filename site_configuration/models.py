@@ -1,10 +1,11 @@
+from copy import copy
 from datetime import time
 from pathlib import Path
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils.html import format_html
 from django.utils.translation import gettext
@@ -16,13 +17,35 @@ from tinymce.models import HTMLField
 from dynamic_admin_site.models import site_configuration_factory
 
 from .backups import BACKUP_PATH, get_version
+from .cache import VersionedCache
 
 SiteConfigurationModel = site_configuration_factory(
     "site_title", "site_header", "index_title"
 )
 
 
-class SiteConfiguration(SiteConfigurationModel):
+class CachedSingletonMixin:
+    """Keep the singleton in a process-local cache, invalidated across
+    processes when it's saved or deleted
+    """
+
+    @classmethod
+    def get_solo_cache(cls):
+        if "_solo_cache" not in cls.__dict__:
+            cls._solo_cache = VersionedCache(f"solo:{cls._meta.label_lower}")
+        return cls._solo_cache
+
+    @classmethod
+    def get_solo(cls):
+        # A copy, so changes that aren't saved don't leak to other callers
+        return copy(cls.get_solo_cache().get(super().get_solo))
+
+    @classmethod
+    def invalidate_solo(cls):
+        cls.get_solo_cache().invalidate()
+
+
+class SiteConfiguration(CachedSingletonMixin, SiteConfigurationModel):
     administration_header = models.CharField(
         max_length=255,
         blank=True,
@@ -76,7 +99,7 @@ class SiteConfiguration(SiteConfigurationModel):
         verbose_name = _("Configuração do site")
 
 
-class EmailConfiguration(SingletonModel):
+class EmailConfiguration(CachedSingletonMixin, SingletonModel):
     activated = models.BooleanField(
         default=False,
         verbose_name=_("Email está ativado?"),
@@ -149,6 +172,14 @@ class EmailConfiguration(SingletonModel):
         verbose_name = _("Configurações de email")
 
 
+@receiver(post_save, sender=SiteConfiguration)
+@receiver(post_delete, sender=SiteConfiguration)
+@receiver(post_save, sender=EmailConfiguration)
+@receiver(post_delete, sender=EmailConfiguration)
+def invalidate_solo_hook(sender, *args, **kwargs):
+    sender.invalidate_solo()
+
+
 class DocumentationPage(models.Model):
     order = models.PositiveIntegerField(
         default=0,
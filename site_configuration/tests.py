@@ -4,8 +4,10 @@ from pathlib import Path
 
 from ddf import G
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 
 from .admin import background_dump, restore_from_pk
 from .backups import (
@@ -14,7 +16,7 @@ from .backups import (
     MEDIA_FILENAME,
     VERSION_FILENAME,
 )
-from .models import Backup, SiteConfiguration
+from .models import Backup, EmailConfiguration, SiteConfiguration
 
 
 class BackupTestCase(TestCase):
@@ -112,3 +114,66 @@ class BackupTestCase(TestCase):
             n_backup_files,
             len(list(Path(settings.MEDIA_ROOT / BACKUP_PATH).iterdir())),
         )
+
+
+class CachedSingletonTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_get_solo(self):
+        SiteConfiguration.get_solo()
+        EmailConfiguration.get_solo()
+        with self.assertNumQueries(0):
+            conf = SiteConfiguration.get_solo()
+            EmailConfiguration.get_solo()
+
+        conf.administration_header = "Biblioteca"
+        self.assertNotEqual(
+            SiteConfiguration.get_solo().administration_header, "Biblioteca"
+        )
+
+        conf.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                SiteConfiguration.get_solo().administration_header,
+                "Biblioteca",
+            )
+
+    def test_saved_by_other_process(self):
+        SiteConfiguration.get_solo()
+
+        # Another process updates the row and bumps the shared version
+        SiteConfiguration.objects.update(administration_header="Outra")
+        with self.assertNumQueries(0):
+            SiteConfiguration.get_solo()
+        cache.set(SiteConfiguration.get_solo_cache().key, "other")
+
+        self.assertEqual(
+            SiteConfiguration.get_solo().administration_header, "Outra"
+        )
+
+    def test_rolled_back_save(self):
+        with transaction.atomic():
+            conf = SiteConfiguration.get_solo()
+            conf.administration_header = "Desfeito"
+            conf.save()
+            # Not kept, it may be rolled back
+            SiteConfiguration.get_solo()
+            with self.assertNumQueries(1):
+                SiteConfiguration.get_solo()
+            transaction.set_rollback(True)
+
+        SiteConfiguration.get_solo()
+        with self.assertNumQueries(0):
+            conf = SiteConfiguration.get_solo()
+        self.assertNotEqual(conf.administration_header, "Desfeito")
+
+    def test_rolled_back_savepoint(self):
+        versioned = SiteConfiguration.get_solo_cache()
+        version = versioned.version()
+        with transaction.atomic():
+            with transaction.atomic():
+                versioned.invalidate()
+                transaction.set_rollback(True)
+            versioned.invalidate()
+        self.assertNotEqual(versioned.version(), version)